@@ -1,9 +1,22 @@
 from __future__ import absolute_import
 
 import json
+import random
+import socket
 import time
+from multiprocessing.pool import ThreadPool
 from salt.exceptions import CommandExecutionError
 
+# note: do not import caasp modules other than caasp_log
+from caasp_log import warn
+
+try:
+    import grpc
+except ImportError:
+    _grpc_available = False
+else:
+    _grpc_available = True
+
 try:
     from salt.exceptions import InvalidConfigError
 except ImportError:
@@ -19,9 +32,48 @@ class CRIRuntimeException(Exception):
     pass
 
 
+class CRIUnimplementedException(CRIRuntimeException):
+    '''
+    The CRI runtime does not implement our gRPC service (or version)
+    '''
+    pass
+
+
 _ROLES_REQUIRING_DOCKER = ('admin', 'ca')
 _SUPPORTED_CRIS = ('docker', 'crio')
 
+# gRPC service (and version) of the CRI runtime
+_CRI_SERVICE = '/runtime.v1alpha2.RuntimeService/'
+
+# labels set by the kubelet in all the containers
+_CONTAINER_NAME_LABEL = 'io.kubernetes.container.name'
+_POD_NAMESPACE_LABEL = 'io.kubernetes.pod.namespace'
+
+# `ContainerState.CONTAINER_RUNNING` in the CRI API
+_CONTAINER_RUNNING = 1
+
+# timeout (in seconds) for requests to the CRI runtime
+_CRI_TIMEOUT = 10
+
+# intervals (in seconds) between checks when waiting for containers:
+# we start checking quite often, and then we back off exponentially
+_WAIT_INITIAL_INTERVAL = 0.1
+_WAIT_MAX_INTERVAL = 2.0
+
+# maximum number of containers stopped in parallel
+_MAX_STOP_THREADS = 8
+
+# key in the `__context__` for the gRPC channel to the CRI runtime,
+# so we use just one connection in the same run
+_CHANNEL_KEY = 'caasp_cri.channel'
+
+# ... and for remembering the CRI socket is ready
+_SOCKET_READY_KEY = 'caasp_cri.socket_ready'
+
+# ... and for remembering the runtime does not implement `_CRI_SERVICE`
+# (so we use crictl for the rest of the run)
+_USE_CRICTL_KEY = 'caasp_cri.use_crictl'
+
 
 def __virtual__():
     return "caasp_cri"
@@ -42,6 +94,211 @@ def cri_name():
     return __salt__['pillar.get']('cri:chosen', 'docker').lower()
 
 
+# note: we do not have the Python bindings generated for the CRI API,
+#       so we encode/decode the (few) protobuf messages we need by hand
+
+def _pb_varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if not value:
+            out.append(bits)
+            return bytes(out)
+        out.append(bits | 0x80)
+
+
+def _pb_uint(num, value):
+    return _pb_varint(num << 3) + _pb_varint(value)
+
+
+def _pb_bytes(num, value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return _pb_varint(num << 3 | 2) + _pb_varint(len(value)) + value
+
+
+def _pb_map(num, items):
+    return b''.join(_pb_bytes(num, _pb_bytes(1, k) + _pb_bytes(2, v))
+                    for (k, v) in sorted(items.items()))
+
+
+def _pb_read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _pb_decode(data):
+    '''
+    Decode a protobuf message as a map of <field number>:<list of values>,
+    where values are integers (varints) or bytes (everything else).
+    '''
+    data = bytearray(data)
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = _pb_read_varint(data, pos)
+        num, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _pb_read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _pb_read_varint(data, pos)
+            value = bytes(data[pos:pos + length])
+            pos += length
+        elif wire_type in (1, 5):
+            length = 8 if wire_type == 1 else 4
+            value = bytes(data[pos:pos + length])
+            pos += length
+        else:
+            raise CRIRuntimeException('unsupported protobuf wire type {}'.format(wire_type))
+        fields.setdefault(num, []).append(value)
+    return fields
+
+
+def _pb_decode_str(fields, num):
+    return fields.get(num, [b''])[0].decode('utf-8')
+
+
+def _pb_decode_map(fields, num):
+    res = {}
+    for entry in fields.get(num, []):
+        entry = _pb_decode(entry)
+        res[_pb_decode_str(entry, 1)] = _pb_decode_str(entry, 2)
+    return res
+
+
+def _use_grpc():
+    return _grpc_available and not __context__.get(_USE_CRICTL_KEY)
+
+
+def _get_channel():
+    if _CHANNEL_KEY not in __context__:
+        endpoint = cri_runtime_endpoint()
+        if not endpoint.startswith('unix:'):
+            endpoint = 'unix://' + endpoint
+        __context__[_CHANNEL_KEY] = grpc.insecure_channel(endpoint)
+    return __context__[_CHANNEL_KEY]
+
+
+def _call(method, request, timeout=_CRI_TIMEOUT):
+    '''
+    Invoke `method` in the CRI runtime with an (encoded) `request`,
+    returning the (decoded) response.
+    '''
+    stub = _get_channel().unary_unary(_CRI_SERVICE + method)
+    try:
+        return _pb_decode(stub(request, timeout=timeout))
+    except grpc.RpcError as e:
+        if getattr(e, 'code', None) and e.code() == grpc.StatusCode.UNIMPLEMENTED:
+            # ie, a runtime with another version of the CRI API
+            warn('%s not implemented by the CRI runtime: using crictl', _CRI_SERVICE + method)
+            __context__[_USE_CRICTL_KEY] = True
+            raise CRIUnimplementedException('{} not implemented: {}'.format(method, e))
+        # the runtime could have been restarted: check the socket again
+        __context__.pop(_SOCKET_READY_KEY, None)
+        raise CRIRuntimeException('{} failed: {}'.format(method, e))
+
+
+def _list_running_containers(labels):
+    '''
+    Get the running containers with some `labels` (filtered by the
+    CRI runtime), as a list of dictionaries with the `id`, `name`
+    and `labels` of the container.
+    '''
+    container_filter = _pb_bytes(2, _pb_uint(1, _CONTAINER_RUNNING)) + _pb_map(4, labels)
+    response = _call('ListContainers', _pb_bytes(1, container_filter))
+
+    res = []
+    for container in response.get(1, []):
+        container = _pb_decode(container)
+        metadata = _pb_decode(container.get(3, [b''])[0])
+        res.append({'id': _pb_decode_str(container, 1),
+                    'name': _pb_decode_str(metadata, 1),
+                    'labels': _pb_decode_map(container, 8)})
+    return res
+
+
+def _crictl(args):
+    cmd = "crictl --runtime-endpoint {socket} {args}".format(
+        socket=cri_runtime_endpoint(),
+        args=args
+    )
+    return __salt__['cmd.run_all'](cmd,
+                                   output_loglevel='trace',
+                                   python_shell=False)
+
+
+def _list_containers(labels=None):
+    '''
+    Get the running containers with some (optional) `labels`, filtered by
+    the CRI runtime, as a list of dictionaries with the `id`, `name`,
+    `namespace` and `labels` of the container.
+    '''
+    labels = labels or {}
+
+    __wait_CRI_socket()
+
+    containers = None
+    if _use_grpc():
+        try:
+            containers = _list_running_containers(labels)
+        except CRIUnimplementedException:
+            pass
+
+    if containers is None:
+        args = ' '.join(['ps -o json'] + ['--label {}={}'.format(k, v)
+                                          for (k, v) in sorted(labels.items())])
+        result = _crictl(args)
+        if result['retcode'] != 0:
+            __context__.pop(_SOCKET_READY_KEY, None)
+            raise CommandExecutionError(
+                'Could not invoke crictl',
+                info={'errors': [result['stderr']]}
+            )
+
+        try:
+            ps_data = json.loads(result['stdout'])
+        except Exception as e:
+            raise CRIRuntimeException('Cannot parse `crictl ps` json output: {}'.
+                                      format(e))
+
+        # note: 'containers' is missing when no containers are running
+        containers = [{'id': container['id'],
+                       'name': container['metadata']['name'],
+                       'labels': container.get('labels', {})}
+                      for container in ps_data.get('containers', [])]
+
+    for container in containers:
+        container['namespace'] = container['labels'].get(_POD_NAMESPACE_LABEL, '')
+    return containers
+
+
+def _stop_container_id(container_id):
+    '''
+    Stop the container with ID `container_id`, returning an error
+    message (or ``None`` if it has been stopped).
+    '''
+    if _use_grpc():
+        try:
+            _call('StopContainer', _pb_bytes(1, container_id) + _pb_uint(2, 0))
+            return None
+        except CRIUnimplementedException:
+            pass
+        except CRIRuntimeException as e:
+            return str(e)
+
+    result = _crictl('stop {}'.format(container_id))
+    if result['retcode'] != 0:
+        return result['stderr']
+    return None
+
+
 def get_container_id(name, namespace):
     '''
     Return the ID of the running container named ``name`` running inside of
@@ -63,34 +320,10 @@ def get_container_id(name, namespace):
         salt '*' caasp_cri.get_container_id name='haproxy' namespace='kube-system'
     '''
 
-    __wait_CRI_socket()
-    cmd = "crictl --runtime-endpoint {socket} ps -o json".format(
-        socket=cri_runtime_endpoint()
-    )
-
-    result = __salt__['cmd.run_all'](cmd,
-                                     output_loglevel='trace',
-                                     python_shell=False)
-
-    if result['retcode'] != 0:
-        raise CommandExecutionError(
-            'Could not invoke crictl',
-            info={'errors': [result['stderr']]}
-        )
-
-    try:
-        ps_data = json.loads(result['stdout'])
-    except Exception as e:
-        raise CRIRuntimeException('Cannot parse `crictl ps` json output: {}'.
-                                  format(e.message))
-
-    if 'containers' not in ps_data:
-        # this happens when no containers are running
-        return None
-
-    for container in ps_data['containers']:
-        if container['metadata']['name'] == name and \
-           container['labels']['io.kubernetes.pod.namespace'] == namespace:
+    containers = _list_containers({_CONTAINER_NAME_LABEL: name,
+                                   _POD_NAMESPACE_LABEL: namespace})
+    for container in containers:
+        if container['name'] == name and container['namespace'] == namespace:
             return container['id']
 
     return None
@@ -131,18 +364,11 @@ def stop_container(name, namespace, ignore_errors=True):
     if container_id is None:
         return False
 
-    cmd = "crictl --runtime-endpoint {socket} stop {container_id}".format(
-        socket=cri_runtime_endpoint(),
-        container_id=container_id
-    )
-    result = __salt__['cmd.run_all'](cmd,
-                                     output_loglevel='trace',
-                                     python_shell=False)
-
-    if result['retcode'] != 0 and not ignore_errors:
+    error = _stop_container_id(container_id)
+    if error and not ignore_errors:
         raise CommandExecutionError(
             'Something went wrong while stopping the container',
-            info={'errors': [result['stderr']]}
+            info={'errors': [error]}
         )
 
     return True
@@ -172,14 +398,169 @@ def wait_for_container(name, namespace, timeout):
 
         salt '*' caasp_cri.wait_for__container name='haproxy' namespace='kube-system'
     '''
-    expire = time.time() + timeout
+    return wait_for_container_running(name, namespace, timeout)['running']
 
-    while time.time() < expire:
-        if get_container_id(name, namespace):
-            return True
-        time.sleep(0.3)
 
-    return False
+def wait_for_container_running(name, namespace, timeout):
+    '''
+    Wait for a container to be up and running, returning a dictionary with
+
+      * ``running``: ``True`` if the container is up and running
+      * ``id``: the ID of the running container (or ``None``)
+      * ``time``: the seconds we have been waiting
+      * ``checks``: the number of times we have checked the container
+
+    The CRI runtime is checked with an exponential backoff (with jitter),
+    starting at 0.1 seconds, so a container that is restarted quickly is
+    detected almost immediately, but we do not flood the runtime with
+    requests when it takes longer.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_cri.wait_for_container_running name='haproxy' namespace='kube-system' timeout=60
+    '''
+    start = time.time()
+    expire = start + timeout
+    interval = _WAIT_INITIAL_INTERVAL
+    res = {'running': False, 'id': None, 'time': 0, 'checks': 0}
+
+    while True:
+        res['checks'] += 1
+        res['id'] = get_container_id(name, namespace)
+        now = time.time()
+        res['time'] = now - start
+        if res['id']:
+            res['running'] = True
+            return res
+        if now >= expire:
+            return res
+
+        # "equal jitter": sleep somewhere between interval/2 and interval
+        time.sleep(min(expire - now, interval / 2 + random.uniform(0, interval / 2)))
+        interval = min(interval * 2, _WAIT_MAX_INTERVAL)
+
+
+def _parse_selectors(containers):
+    # accept both [{'name': ..., 'namespace': ...}, ...]
+    # and [(<name>, <namespace>), ...]
+    res = []
+    for container in containers:
+        if isinstance(container, dict):
+            res.append((container['name'], container['namespace']))
+        else:
+            res.append(tuple(container))
+    return res
+
+
+def _selector_key(name, namespace):
+    return '{namespace}.{name}'.format(namespace=namespace, name=name)
+
+
+def _get_container_ids(selectors):
+    # list the runtime just once for all the `selectors`
+    namespaces = set(namespace for (_, namespace) in selectors)
+    labels = {}
+    if len(namespaces) == 1:
+        labels[_POD_NAMESPACE_LABEL] = namespaces.pop()
+
+    found = {}
+    for container in _list_containers(labels):
+        found.setdefault((container['name'], container['namespace']), container['id'])
+    return dict((selector, found.get(selector)) for selector in selectors)
+
+
+def stop_containers(containers, ignore_errors=True):
+    '''
+    Stop all the running ``containers``, a list of ``name``/``namespace``
+    selectors.
+
+    The runtime is listed only once, and all the containers found are
+    stopped in parallel. Returns a dictionary of ``<namespace>.<name>``
+    with the ``stopped`` status, the container ``id``, the ``time`` taken
+    and the ``error`` (if any) for every container.
+
+    Raises an exception when some container cannot be stopped, unless
+    ``ignore_errors`` is set to ``True``.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_cri.stop_containers '[{name: haproxy, namespace: kube-system}]'
+    '''
+    selectors = _parse_selectors(containers)
+    ids = _get_container_ids(selectors)
+
+    def stop(selector):
+        res = {'stopped': False, 'id': ids[selector], 'time': 0, 'error': None}
+        if res['id']:
+            start = time.time()
+            res['error'] = _stop_container_id(res['id'])
+            res['stopped'] = res['error'] is None
+            res['time'] = time.time() - start
+        return (_selector_key(*selector), res)
+
+    found = [selector for selector in selectors if ids[selector]]
+    results = dict(stop(selector) for selector in selectors if not ids[selector])
+    if found:
+        pool = ThreadPool(min(len(found), _MAX_STOP_THREADS))
+        try:
+            results.update(pool.map(stop, found))
+        finally:
+            pool.close()
+
+    errors = [r['error'] for r in results.values() if r['error']]
+    if errors and not ignore_errors:
+        raise CommandExecutionError(
+            'Something went wrong while stopping the containers',
+            info={'errors': errors}
+        )
+
+    return results
+
+
+def wait_for_containers(containers, timeout):
+    '''
+    Wait for all the ``containers`` (a list of ``name``/``namespace``
+    selectors) to be up and running.
+
+    All the containers are checked together, with only one listing of the
+    runtime every time, with an exponential backoff (with jitter).
+    Returns a dictionary of ``<namespace>.<name>`` with the ``running``
+    status, the ``id`` and the ``time`` it took for every container.
+
+    CLI example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_cri.wait_for_containers '[{name: haproxy, namespace: kube-system}]' 60
+    '''
+    selectors = _parse_selectors(containers)
+    start = time.time()
+    expire = start + timeout
+    interval = _WAIT_INITIAL_INTERVAL
+
+    results = dict((_selector_key(*selector), {'running': False, 'id': None, 'time': 0})
+                   for selector in selectors)
+    pending = list(selectors)
+
+    while True:
+        ids = _get_container_ids(pending)
+        now = time.time()
+        for selector in list(pending):
+            result = results[_selector_key(*selector)]
+            result['time'] = now - start
+            if ids[selector]:
+                result.update({'running': True, 'id': ids[selector]})
+                pending.remove(selector)
+
+        if not pending or now >= expire:
+            return results
+
+        time.sleep(min(expire - now, interval / 2 + random.uniform(0, interval / 2)))
+        interval = min(interval * 2, _WAIT_MAX_INTERVAL)
 
 
 def cri_runtime_endpoint():
@@ -191,6 +572,41 @@ def cri_runtime_endpoint():
     return __pillar__['cri'][cri_name()]['socket']
 
 
+def _socket_path():
+    endpoint = cri_runtime_endpoint()
+    for prefix in ('unix://', 'unix:'):
+        if endpoint.startswith(prefix):
+            return endpoint[len(prefix):]
+    return endpoint
+
+
+def _probe_CRI_socket():
+    '''
+    Check if the CRI runtime is answering, returning an error
+    message (or ``None`` if it is ready).
+    '''
+    if _use_grpc():
+        # a lightweight RPC: the runtime is really serving requests
+        try:
+            _call('Version', b'', timeout=1)
+            return None
+        except CRIUnimplementedException:
+            pass
+        except CRIRuntimeException as e:
+            return str(e)
+
+    # just check something is accepting connections in the socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1)
+    try:
+        sock.connect(_socket_path())
+        return None
+    except socket.error as e:
+        return 'could not connect to {}: {}'.format(_socket_path(), e)
+    finally:
+        sock.close()
+
+
 def __wait_CRI_socket():
     '''
     Ensures the CRI socket is ready before executing the decorated function.
@@ -199,23 +615,23 @@ def __wait_CRI_socket():
     CRI socket is ready. This can lead to some edge cases
     at bootstrap time, where the CRI is not yet running
     but some state interacting with it is applied.
+
+    Once the socket is ready, we do not check it again in the same run.
     '''
+    if __context__.get(_SOCKET_READY_KEY):
+        return
+
     timeout = int(__salt__['pillar.get']('cri:socket_timeout', '20'))
     expire = time.time() + timeout
     errors = {'attempts': []}
 
     while time.time() < expire:
-        cmd = "crictl --runtime-endpoint {socket} info".format(
-            socket=cri_runtime_endpoint()
-        )
-
-        result = __salt__['cmd.run_all'](cmd,
-                                         output_loglevel='trace',
-                                         python_shell=False)
-        if result['retcode'] == 0:
+        error = _probe_CRI_socket()
+        if error is None:
+            __context__[_SOCKET_READY_KEY] = True
             return
 
-        errors['attempts'].append(result)
+        errors['attempts'].append(error)
 
         time.sleep(0.3)
 
@@ -1,6 +1,23 @@
 from __future__ import absolute_import
 
-import subprocess
+import base64
+import glob
+import hashlib
+import itertools
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import http.client as http_client
+    from urllib.parse import urlparse
+except ImportError:
+    import httplib as http_client
+    from urlparse import urlparse
 
 # note: do not import caasp modules other than caasp_log
 from caasp_log import debug, error, warn
@@ -11,6 +28,49 @@ MIN_RECOMMENDED_MEMBER_COUNT = 3
 # port where etcd listens for clients
 ETCD_CLIENT_PORT = 2379
 
+# prefix for the etcd v3 API in the gRPC gateway (JSON)
+# note: 'v3beta' is supported in etcd 3.3 and 3.4, so all the functions
+#       using the v3 API (the members list with etcd3, health_report(),
+#       compact(), defragment(), snapshot()...) require etcd >= 3.3
+ETCD_API_PREFIX = '/v3beta'
+
+# timeout (in seconds) for requests to the etcd API
+ETCD_API_TIMEOUT = 10
+
+# timeout (in seconds) for a defragmentation (the member is
+# blocked while defragmenting, and it can take a while)
+ETCD_DEFRAG_TIMEOUT = 300
+
+# number of revisions we keep when compacting the history
+DEFAULT_KEEP_REVISIONS = 10000
+
+# where we store snapshots of the etcd database
+DEFAULT_SNAPSHOT_DIR = '/var/lib/etcd-backup'
+
+# ... and how many of them we keep
+DEFAULT_SNAPSHOT_KEEP = 5
+
+# size of the chunks read from a (streamed) snapshot
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+# etcd appends a sha256 of the database to the snapshots
+SNAPSHOT_HASH_SIZE = hashlib.sha256().digest_size
+
+# mine function with the RTTs between nodes (see caasp_net.peer_rtts())
+PEER_RTTS_GRAIN = 'peer_rtts'
+
+# upper limit for the number of candidates considered for a
+# latency-aware placement (we try all the combinations)
+MAX_PLACEMENT_CANDIDATES = 12
+
+# key in the `__context__` for the (cached) members table
+_MEMBERS_KEY = 'caasp_etcd.members'
+
+# connections to etcd endpoints (and a lock for each one of them),
+# kept alive between calls so we do not pay for a new TLS handshake
+_connections = {}
+_connections_lock = threading.Lock()
+
 
 def __virtual__():
     return "caasp_etcd"
@@ -20,10 +80,20 @@ class NoEtcdServersException(Exception):
     pass
 
 
+class EtcdApiException(Exception):
+    pass
+
+
 def api_version():
     return __salt__['pillar.get']('etcd_version', 'etcd3')
 
 
+def _check_v3_api(what):
+    # the maintenance API has no equivalent in the v2 API
+    if api_version() == 'etcd2':
+        raise EtcdApiException('{} is not supported with etcd2 (requires etcd >= 3.3)'.format(what))
+
+
 def _optimal_etcd_number(num_nodes):
     if num_nodes >= 7:
         return 7
@@ -49,6 +119,7 @@ def get_cluster_size(**kwargs):
 
       * `masters`: list of current kubernetes masters
       * `minions`: list of current kubernetes minions
+      * `view`: a `ClusterView` (instead of the lists of masters/minions)
 
     '''
     member_count = __salt__['pillar.get']('etcd:masters', None)
@@ -109,6 +180,12 @@ def get_additional_etcd_members(num_wanted=None, **kwargs):
 
       * `etcd_members`: list of current etcd members
       * `excluded`: list of nodes to exclude
+      * `view`: a `ClusterView` (instead of the lists of etcd members, etc)
+
+    When the `etcd:placement:latency_aware` pillar is enabled, we consider
+    some extra candidates (`etcd:placement:spare_candidates`) and then
+    we choose the ones with the lowest RTT for reaching a quorum, using
+    the RTTs between nodes published in the mine by `caasp_net.peer_rtts()`.
     '''
     excluded = kwargs.get('excluded', [])
 
@@ -139,11 +216,32 @@ def get_additional_etcd_members(num_wanted=None, **kwargs):
     #       2) is a master
     #       3) is a minion
     #
+    latency_aware = __salt__['caasp_pillar.get']('etcd:placement:latency_aware', False)
+    if latency_aware:
+        # get some spare candidates (still in priority order) and choose
+        # the best ones with `_place_by_latency()`
+        spare = int(__salt__['caasp_pillar.get']('etcd:placement:spare_candidates', 0))
+        num_candidates = min(num_additional_etcd_members + spare,
+                             max(num_additional_etcd_members, MAX_PLACEMENT_CANDIDATES))
+    else:
+        num_candidates = num_additional_etcd_members
+
     new_etcd_members = __salt__['caasp_nodes.get_with_prio_for_role'](
-        num_additional_etcd_members, 'etcd',
+        num_candidates, 'etcd',
         unassigned=False,
         excluded=current_etcd_members + excluded)
 
+    if latency_aware and len(new_etcd_members) > num_additional_etcd_members:
+        rtts = __salt__['caasp_grains.get']('*', grain=PEER_RTTS_GRAIN, type='glob')
+        if not any(rtts.values()):
+            warn('get_additional_etcd_members: no %s in the mine (see pillar/mine.sls)',
+                 PEER_RTTS_GRAIN)
+        new_etcd_members = _place_by_latency(num_additional_etcd_members,
+                                             current_etcd_members, new_etcd_members,
+                                             rtts)
+    else:
+        new_etcd_members = new_etcd_members[:num_additional_etcd_members]
+
     if len(new_etcd_members) < num_additional_etcd_members:
         error('get_additional_etcd_members: cannot satisfy the %s members missing',
               num_additional_etcd_members)
@@ -151,6 +249,52 @@ def get_additional_etcd_members(num_wanted=None, **kwargs):
     return new_etcd_members
 
 
+def _rtt_between(a, b, rtts):
+    # use the worst of the two measurements (a->b and b->a), or
+    # an infinite RTT when there are no measurements
+    measured = [x for x in (rtts.get(a, {}).get(b), rtts.get(b, {}).get(a))
+                if x is not None]
+    return max(measured) if measured else float('inf')
+
+
+def _quorum_rtt(nodes, rtts):
+    '''
+    Get the worst-case RTT needed for committing something in a etcd
+    cluster made of `nodes`: for every possible leader, the RTT to the
+    slowest follower it needs for reaching a quorum.
+    '''
+    needed = len(nodes) // 2
+    if needed == 0:
+        return 0
+    worst = 0
+    for leader in nodes:
+        to_followers = sorted(_rtt_between(leader, follower, rtts)
+                              for follower in nodes if follower != leader)
+        worst = max(worst, to_followers[needed - 1])
+    return worst
+
+
+def _place_by_latency(num, current, candidates, rtts):
+    '''
+    Choose `num` nodes from `candidates` (a list in priority order) that,
+    together with the `current` members, minimize the worst-case
+    quorum RTT (see `_quorum_rtt()`). Ties are resolved by priority,
+    so we get the same choice as without RTTs when we have no measurements.
+    '''
+    best = None
+    best_key = None
+    for chosen in itertools.combinations(range(len(candidates)), num):
+        nodes = current + [candidates[i] for i in chosen]
+        key = (_quorum_rtt(nodes, rtts), chosen)
+        if best_key is None or key < best_key:
+            best, best_key = chosen, key
+
+    res = [candidates[i] for i in best]
+    debug('latency-aware placement: %s (quorum RTT: %s ms, out of %s)',
+          res, best_key[0], candidates)
+    return res
+
+
 def get_endpoints(with_id=False, skip_this=False, skip_removed=False, port=ETCD_CLIENT_PORT, sep=','):
     '''
     Build a comma-separated list of etcd endpoints
@@ -208,6 +352,531 @@ def get_etcdctl_args_str(**kwargs):
     return " ".join(get_etcdctl_args(**kwargs))
 
 
+def _get_ssl_context():
+    context = ssl.create_default_context(cafile=__salt__['pillar.get']('ssl:ca_file'))
+    context.load_cert_chain(__salt__['pillar.get']('ssl:crt_file'),
+                            __salt__['pillar.get']('ssl:key_file'))
+    return context
+
+
+def _get_connection(endpoint):
+    with _connections_lock:
+        if endpoint not in _connections:
+            _connections[endpoint] = [threading.Lock(), None]
+        return _connections[endpoint]
+
+
+def _request(endpoint, path, body=None, method='POST', timeout=ETCD_API_TIMEOUT):
+    '''
+    Send a request to the etcd server at `endpoint` (ie, https://node:2379),
+    reusing the connection to that endpoint if possible, and
+    return the decoded response.
+    '''
+    url = urlparse(endpoint)
+    headers = {'Content-Type': 'application/json'}
+    data = json.dumps(body) if body is not None else None
+
+    connection = _get_connection(endpoint)
+    with connection[0]:
+        for attempt in range(2):
+            if connection[1] is None:
+                connection[1] = http_client.HTTPSConnection(url.hostname,
+                                                            url.port or ETCD_CLIENT_PORT,
+                                                            timeout=timeout,
+                                                            context=_get_ssl_context())
+            elif connection[1].sock is not None:
+                connection[1].sock.settimeout(timeout)
+            try:
+                connection[1].request(method, path, body=data, headers=headers)
+                response = connection[1].getresponse()
+                content = response.read()
+                break
+            except (socket.error, http_client.HTTPException) as e:
+                # the connection could have been closed by the server
+                # while idle, so we try again (once) with a new one
+                connection[1].close()
+                connection[1] = None
+                if attempt > 0:
+                    raise EtcdApiException('{} {}{} failed: {}'.format(method, endpoint, path, e))
+
+    if response.status != 200:
+        raise EtcdApiException('{} {}{} failed with status {}: {}'.format(
+            method, endpoint, path, response.status, content))
+
+    return json.loads(content.decode('utf-8')) if content else {}
+
+
+def api(path, body=None, endpoints=None, skip_this=False,
+        prefix=ETCD_API_PREFIX, method='POST', **kwargs):
+    '''
+    Send a request to the etcd v3 API (ie, `/cluster/member/list`),
+    trying all the etcd `endpoints` (by default, all the etcd members)
+    until one of them succeeds.
+
+    Other APIs can be used with some other `prefix` (ie, `/v2`) and `method`.
+    '''
+    if endpoints is None:
+        endpoints = get_endpoints(skip_this=skip_this).split(',')
+
+    if method == 'POST':
+        body = body or {}
+
+    errors = []
+    for endpoint in endpoints:
+        try:
+            return _request(endpoint, prefix + path, body=body, method=method, **kwargs)
+        except EtcdApiException as e:
+            debug('etcd API request failed: %s', e)
+            errors.append(str(e))
+
+    raise EtcdApiException('all the etcd endpoints failed: {}'.format('; '.join(errors)))
+
+
+def _member_id_to_str(member_id):
+    # the API returns the uint64 IDs as decimal strings,
+    # while etcdctl uses hexadecimal numbers
+    return '{:x}'.format(int(member_id))
+
+
+def _member_id_from_str(member_id):
+    return str(int(member_id, 16))
+
+
+def _decode_member(member):
+    if 'ID' in member:
+        member_id = _member_id_to_str(member['ID'])
+    else:
+        # the v2 API already uses hexadecimal IDs
+        member_id = member['id']
+    return {'id': member_id,
+            'name': member.get('name', ''),
+            'peer_urls': member.get('peerURLs', []),
+            'client_urls': member.get('clientURLs', [])}
+
+
+def member_list(**kwargs):
+    '''
+    Get the list of members of the etcd cluster, as a list of dictionaries
+    with `id`, `name`, `peer_urls` and `client_urls`
+    '''
+    if api_version() == 'etcd2':
+        res = api('/members', prefix='/v2', method='GET', **kwargs)
+    else:
+        res = api('/cluster/member/list', **kwargs)
+    return [_decode_member(m) for m in res.get('members', [])]
+
+
+def members(refresh=False, **kwargs):
+    '''
+    Get a table with all the members of the etcd cluster, indexed by
+    `by_id`, `by_name`, `by_peer_url` and `by_client_url` (as
+    well as the full list in `members`).
+
+    The table is obtained with just one query, and it is cached for the
+    rest of the run (unless `refresh=True`).
+    '''
+    if refresh or _MEMBERS_KEY not in __context__:
+        table = {'members': member_list(**kwargs),
+                 'by_id': {},
+                 'by_name': {},
+                 'by_peer_url': {},
+                 'by_client_url': {}}
+        for member in table['members']:
+            table['by_id'][member['id']] = member
+            if member['name']:
+                table['by_name'][member['name']] = member
+            for url in member['peer_urls']:
+                table['by_peer_url'][url] = member
+            for url in member['client_urls']:
+                table['by_client_url'][url] = member
+
+        __context__[_MEMBERS_KEY] = table
+
+    return __context__[_MEMBERS_KEY]
+
+
+def clear_members_cache():
+    '''
+    Invalidate the members table cached in this run
+    '''
+    __context__.pop(_MEMBERS_KEY, None)
+
+
+def member_add(peer_urls, **kwargs):
+    '''
+    Add a new member (with `peer_urls`) to the etcd cluster.
+    Returns the new member.
+    '''
+    try:
+        res = api('/cluster/member/add', {'peerURLs': peer_urls}, **kwargs)
+    finally:
+        clear_members_cache()
+    return _decode_member(res['member'])
+
+
+def member_remove(member_id, **kwargs):
+    '''
+    Remove the member with ID `member_id` from the etcd cluster
+    '''
+    try:
+        api('/cluster/member/remove', {'ID': _member_id_from_str(member_id)}, **kwargs)
+    finally:
+        clear_members_cache()
+    return True
+
+
+def endpoint_health(endpoint, timeout=ETCD_API_TIMEOUT):
+    '''
+    Check the health of the etcd server at `endpoint`
+    '''
+    try:
+        res = _request(endpoint, '/health', method='GET', timeout=timeout)
+    except EtcdApiException as e:
+        debug('%s is unhealthy: %s', endpoint, e)
+        return False
+    return str(res.get('health')).lower() == 'true'
+
+
+def _probe(endpoint, timeout):
+    start = time.time()
+    res = {'endpoint': endpoint,
+           'healthy': False,
+           'rtt': None,
+           'leader': False,
+           'member_id': '',
+           'raft_index': None,
+           'db_size': None,
+           'error': ''}
+    try:
+        status = _request(endpoint, ETCD_API_PREFIX + '/maintenance/status', body={},
+                          timeout=timeout)
+        res['rtt'] = time.time() - start
+        res['member_id'] = _member_id_to_str(status['header']['member_id'])
+        res['leader'] = (status.get('leader') == status['header']['member_id'])
+        res['raft_index'] = int(status.get('raftIndex', 0))
+        res['db_size'] = int(status.get('dbSize', 0))
+        res['healthy'] = not status.get('errors')
+        res['error'] = ','.join(status.get('errors', []))
+    except Exception as e:
+        res['error'] = str(e)
+    return res
+
+
+def health_report(timeout=ETCD_API_TIMEOUT, wait_all=False, **kwargs):
+    '''
+    Probe all the etcd endpoints in parallel and get a report on their
+    health, with the status, round-trip time (in seconds), leader flag
+    and raft index of each member.
+
+    Unless `wait_all=True`, we return as soon as a quorum of healthy members
+    has been confirmed, and members that have not answered yet will be
+    reported as `pending`. Every endpoint has a deadline of `timeout` seconds.
+
+    Returns a dictionary with
+
+      * `healthy`: True if a quorum of members is healthy
+      * `quorum`: the number of members needed for a quorum
+      * `members`: a map of <endpoint>:<report> for every member
+
+    This uses the v3 API, so it requires etcd >= 3.3 (with etcd2,
+    an `EtcdApiException` is raised).
+    '''
+    _check_v3_api('the health report')
+
+    endpoints = get_endpoints(**kwargs).split(',')
+    quorum = len(endpoints) // 2 + 1
+
+    members = dict((e, {'endpoint': e, 'pending': True}) for e in endpoints)
+    num_healthy = 0
+
+    deadline = time.time() + timeout
+    pool = ThreadPool(len(endpoints))
+    try:
+        results = pool.imap_unordered(lambda e: _probe(e, timeout), endpoints)
+        for _ in endpoints:
+            try:
+                member = results.next(max(0, deadline - time.time()))
+            except Exception:
+                # (multiprocessing.TimeoutError) no more answers in time
+                break
+            members[member['endpoint']] = member
+            if member['healthy']:
+                num_healthy += 1
+                if num_healthy >= quorum and not wait_all:
+                    break
+    finally:
+        # do not wait for slow members: their threads will finish
+        # (at most) after `timeout` seconds
+        pool.close()
+
+    for member in members.values():
+        debug('etcd member %s: %s', member['endpoint'], member)
+
+    return {'healthy': num_healthy >= quorum,
+            'quorum': quorum,
+            'members': members}
+
+
+def compact(keep_revisions=DEFAULT_KEEP_REVISIONS, physical=True, **kwargs):
+    '''
+    Compact the etcd revision history, discarding all the revisions
+    but the last `keep_revisions`. With `physical=True`, we wait until
+    the compaction has been applied to the backend database.
+
+    Returns a dictionary with the current `revision` and the
+    `compacted` revision (or `None` if there was nothing to compact).
+
+    Like all the maintenance functions, this requires etcd >= 3.3.
+    '''
+    _check_v3_api('compaction')
+
+    status = api('/maintenance/status', **kwargs)
+    revision = int(status['header']['revision'])
+    res = {'revision': revision, 'compacted': None}
+
+    target = revision - int(keep_revisions)
+    if target <= 0:
+        debug('nothing to compact at revision %d', revision)
+        return res
+
+    try:
+        api('/kv/compaction', {'revision': target, 'physical': physical},
+            timeout=ETCD_DEFRAG_TIMEOUT, **kwargs)
+    except EtcdApiException as e:
+        if 'required revision has been compacted' not in str(e):
+            raise
+        debug('revision %d was already compacted', target)
+        return res
+
+    res['compacted'] = target
+    debug('etcd history compacted at revision %d (current: %d)', target, revision)
+    return res
+
+
+def _defragment_member(member, timeout):
+    endpoint = member['endpoint']
+    start = time.time()
+    _request(endpoint, ETCD_API_PREFIX + '/maintenance/defragment', body={},
+             timeout=timeout)
+    elapsed = time.time() - start
+
+    after = _probe(endpoint, ETCD_API_TIMEOUT)
+    res = {'endpoint': endpoint,
+           'leader': member['leader'],
+           'healthy': after['healthy'],
+           'db_size_before': member['db_size'],
+           'db_size_after': after['db_size'],
+           'reclaimed': 0,
+           'time': elapsed}
+    if member['db_size'] is not None and after['db_size'] is not None:
+        res['reclaimed'] = member['db_size'] - after['db_size']
+
+    debug('etcd member %s defragmented in %.3fs: %s bytes reclaimed',
+          endpoint, elapsed, res['reclaimed'])
+    return res
+
+
+def defragment(timeout=ETCD_DEFRAG_TIMEOUT, **kwargs):
+    '''
+    Defragment the backend database of all the etcd members, one at a time:
+    first the followers and then the leader.
+
+    A member is blocked while it is being defragmented, so we only
+    defragment a follower when the rest of the cluster still has a quorum
+    (checked with a fresh health report before each member), we stop
+    when a member is not healthy after its defragmentation, and we never
+    defragment the leader while some follower is unhealthy.
+
+    Returns a dictionary with
+
+      * `result`: True if all the members have been defragmented
+      * `reclaimed`: the total number of bytes reclaimed
+      * `members`: a list of reports, with the endpoint, the database size
+                   before and after, the bytes reclaimed and the time taken
+                   (or the reason why it was `skipped`)
+    '''
+    report = health_report(wait_all=True, **kwargs)
+    healthy = [m for m in report['members'].values() if m.get('healthy')]
+    followers = sorted((m for m in healthy if not m['leader']), key=lambda m: m['endpoint'])
+    leaders = [m for m in healthy if m['leader']]
+
+    res = {'result': True, 'reclaimed': 0, 'members': []}
+
+    def skip(endpoint, reason):
+        warn('not defragmenting etcd member %s: %s', endpoint, reason)
+        res['result'] = False
+        res['members'].append({'endpoint': endpoint, 'skipped': reason})
+
+    for member in report['members'].values():
+        if not member.get('healthy'):
+            skip(member['endpoint'], 'unhealthy member')
+
+    for (i, member) in enumerate(followers):
+        endpoint = member['endpoint']
+
+        # the member will not be available while defragmenting, so check
+        # the rest of the cluster has a quorum (the previous member could
+        # still be recovering)
+        report = health_report(wait_all=True, **kwargs)
+        member = report['members'][endpoint]
+        if not member.get('healthy'):
+            skip(endpoint, 'unhealthy member')
+            continue
+        others = [m for m in report['members'].values()
+                  if m.get('healthy') and m['endpoint'] != endpoint]
+        if len(others) < report['quorum']:
+            skip(endpoint, 'the cluster would lose its quorum')
+            continue
+
+        done = _defragment_member(member, timeout)
+        res['reclaimed'] += done['reclaimed']
+        res['members'].append(done)
+
+        if not done['healthy']:
+            error('etcd member %s is not healthy after its defragmentation', endpoint)
+            res['result'] = False
+            for m in followers[i + 1:] + leaders:
+                skip(m['endpoint'], '{} is not healthy after its defragmentation'.format(endpoint))
+            return res
+
+    for member in leaders:
+        # check the followers are fine after all the defragmentations
+        # (and use fresh data, as the leadership could have changed)
+        report = health_report(wait_all=True, **kwargs)
+        if not all(m.get('healthy') for m in report['members'].values()):
+            skip(member['endpoint'], 'some followers are not healthy')
+            continue
+        done = _defragment_member(report['members'][member['endpoint']], timeout)
+        res['reclaimed'] += done['reclaimed']
+        res['members'].append(done)
+
+    return res
+
+
+def _stream_request(endpoint, path, body=None, timeout=ETCD_API_TIMEOUT):
+    '''
+    Send a request to a streaming API at `endpoint`, yielding
+    the (decoded) messages as they arrive.
+
+    We use a new connection (instead of the shared one), as streams
+    can take a long time and they cannot be interleaved with other requests.
+    '''
+    url = urlparse(endpoint)
+    connection = http_client.HTTPSConnection(url.hostname,
+                                             url.port or ETCD_CLIENT_PORT,
+                                             timeout=timeout,
+                                             context=_get_ssl_context())
+    try:
+        connection.request('POST', path, body=json.dumps(body or {}),
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        if response.status != 200:
+            raise EtcdApiException('POST {}{} failed with status {}: {}'.format(
+                endpoint, path, response.status, response.read()))
+
+        # the gateway sends newline-delimited JSON messages
+        pending = b''
+        while True:
+            chunk = response.read(SNAPSHOT_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        if pending.strip():
+            yield json.loads(pending.decode('utf-8'))
+    except (socket.error, http_client.HTTPException) as e:
+        raise EtcdApiException('POST {}{} failed: {}'.format(endpoint, path, e))
+    finally:
+        connection.close()
+
+
+def _get_snapshot_endpoint(**kwargs):
+    # the healthiest member: the most up-to-date, preferring followers
+    # (so we do not load the leader) and then the fastest one
+    report = health_report(wait_all=True, **kwargs)
+    healthy = [m for m in report['members'].values() if m.get('healthy')]
+    if not healthy:
+        raise EtcdApiException('no healthy etcd members found')
+    best = min(healthy, key=lambda m: (-m['raft_index'], m['leader'], m['rtt']))
+    return best['endpoint']
+
+
+def _rotate_snapshots(directory, keep):
+    snapshots = sorted(glob.glob(os.path.join(directory, 'etcd-snapshot-*.db')))
+    removed = snapshots[:max(0, len(snapshots) - keep)]
+    for path in removed:
+        debug('removing old etcd snapshot %s', path)
+        os.remove(path)
+    return removed
+
+
+def snapshot(directory=DEFAULT_SNAPSHOT_DIR, keep=DEFAULT_SNAPSHOT_KEEP,
+             timeout=ETCD_DEFRAG_TIMEOUT, **kwargs):
+    '''
+    Save a snapshot of the etcd database in `directory`, keeping only the
+    latest `keep` snapshots.
+
+    The snapshot is streamed (in chunks) from the healthiest member and
+    written straight to disk, verifying the sha256 etcd appends to it
+    while streaming. Partial or corrupted snapshots are discarded.
+
+    Returns a dictionary with the `path`, `size`, `sha256`, the
+    `endpoint` used, the `time` taken and the snapshots `removed`.
+    '''
+    endpoint = _get_snapshot_endpoint(**kwargs)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    path = os.path.join(directory, 'etcd-snapshot-{}.db'.format(
+        time.strftime('%Y%m%d%H%M%S', time.gmtime())))
+    tmp_path = path + '.part'
+
+    debug('streaming etcd snapshot from %s to %s', endpoint, path)
+    start = time.time()
+    sha = hashlib.sha256()
+    # the last bytes we have seen, that could be the trailing hash
+    tail = b''
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for message in _stream_request(endpoint, ETCD_API_PREFIX + '/maintenance/snapshot',
+                                           timeout=timeout):
+                if 'error' in message:
+                    raise EtcdApiException('snapshot failed: {}'.format(message['error']))
+                blob = base64.b64decode(message.get('result', {}).get('blob', ''))
+                f.write(blob)
+                size += len(blob)
+
+                data = tail + blob
+                sha.update(data[:-SNAPSHOT_HASH_SIZE])
+                tail = data[-SNAPSHOT_HASH_SIZE:]
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        if len(tail) != SNAPSHOT_HASH_SIZE or sha.digest() != tail:
+            raise EtcdApiException('snapshot from {} is corrupted (checksum mismatch)'.format(endpoint))
+
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    res = {'path': path,
+           'size': size,
+           'sha256': sha.hexdigest(),
+           'endpoint': endpoint,
+           'time': time.time() - start,
+           'removed': _rotate_snapshots(directory, int(keep))}
+    debug('etcd snapshot saved at %s: %d bytes in %.3fs', path, size, res['time'])
+    return res
+
+
 def get_member_id(nodename=None):
     '''
     Return the member ID (different from the node ID) for
@@ -219,28 +888,15 @@ def get_member_id(nodename=None):
                   want the ID for. if no name is provided (or empty),
                   the local node will be used.
     '''
-    command = ["etcdctl"] + get_etcdctl_args() + ["member", "list"]
-    if api_version() == 'etcd2':
-        command_env = {"ETCDCTL_API": "2"}
-    else:
-        command_env = {"ETCDCTL_API": "3"}
-
     target_nodename = nodename or __salt__['caasp_net.get_nodename']()
+    target_url = 'https://{}:{}'.format(target_nodename, ETCD_CLIENT_PORT)
 
-    debug("getting etcd member ID with: %s", command)
-    members_output = ''
+    debug("getting etcd member ID for %s", target_url)
     try:
-        target_url = 'https://{}:{}'.format(target_nodename, ETCD_CLIENT_PORT)
-        members_output = subprocess.check_output(command, env=command_env)
-        for member_line in members_output.splitlines():
-            if target_url in member_line:
-                if api_version() == 'etcd2':
-                    return member_line.split(':')[0]
-                else:
-                    return member_line.split(',')[0]
-
+        member = members()['by_client_url'].get(target_url)
+        if member:
+            return member['id']
     except Exception as e:
-        error('cannot get member ID for "%s": %s', e, target_nodename)
-        error('output: %s', members_output)
+        error('cannot get member ID for "%s": %s', target_nodename, e)
 
     return ''
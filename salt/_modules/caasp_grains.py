@@ -1,5 +1,11 @@
 from __future__ import absolute_import
 
+import fnmatch
+import re
+
+# note: do not import caasp modules other than caasp_log
+from caasp_log import debug
+
 
 def __virtual__():
     return "caasp_grains"
@@ -8,8 +14,30 @@ def __virtual__():
 # an exported (to the mine) grain used for getting ids
 DEFAULT_GRAIN = 'nodename'
 
+# an exported (to the mine) function with all the grains we use for
+# targeting nodes (see pillar/mine.sls). It is used for resolving
+# compound expressions locally, with just one query to the mine.
+TARGETING_GRAIN = 'targeting_grains'
+
+# key in the `__context__` for the mine cache. The `__context__` is
+# shared by all the functions called in the same run (ie, a highstate,
+# the rendering of an orchestration...), and it is cleared after that,
+# so the cache will not live longer than that.
+_CACHE_KEY = 'caasp_grains.cache'
+
+
+def _get_cache():
+    if _CACHE_KEY not in __context__:
+        __context__[_CACHE_KEY] = {'entries': {}, 'hits': 0, 'misses': 0}
+    return __context__[_CACHE_KEY]
+
 
-def get(expr, grain=DEFAULT_GRAIN, type='compound'):
+def _normalize_expr(expr):
+    # 'G@roles:etcd  and  not G@a:b' == 'G@roles:etcd and not G@a:b'
+    return ' '.join(str(expr).split())
+
+
+def _mine_get(expr, grain, type):
     if __opts__['__role'] == 'master':
         # 'mine.get' is not available in the master: it returns nothing
         # in that case, we should use "saltutil.runner"... uh?
@@ -18,3 +46,203 @@ def get(expr, grain=DEFAULT_GRAIN, type='compound'):
                                            fun=grain, tgt_type=type)
     else:
         return __salt__['mine.get'](expr, grain, expr_form=type)
+
+
+class UnsupportedExpression(Exception):
+    pass
+
+
+def _match_value(value, pattern, regex):
+    # mimic what Salt does when matching grains: case insensitive
+    # globs (G@) or regular expressions (P@), where a list matches
+    # when any of its items matches
+    if isinstance(value, (list, tuple)):
+        return any(_match_value(v, pattern, regex) for v in value)
+    value = str(value).lower()
+    pattern = pattern.lower()
+    if regex:
+        return re.match(pattern, value) is not None
+    return fnmatch.fnmatch(value, pattern)
+
+
+def _match_word(word, grains, minion_id):
+    if word.startswith('G@') or word.startswith('P@'):
+        key, sep, pattern = word[2:].partition(':')
+        if not sep or key not in grains:
+            return False
+        return _match_value(grains[key], pattern, regex=word.startswith('P@'))
+    elif word.startswith('L@'):
+        return minion_id in [x for x in word[2:].split(',') if x]
+    elif word.startswith('E@'):
+        return re.match(word[2:], minion_id) is not None
+    elif '@' in word:
+        raise UnsupportedExpression('unsupported matcher in "{}"'.format(word))
+    return fnmatch.fnmatch(minion_id, word)
+
+
+def match(expr, grains, minion_id):
+    '''
+    Check if a node (with id `minion_id` and some `grains`)
+    matches the compound expression `expr`.
+
+    Only grains (G@), grains PCRE (P@), list (L@), PCRE (E@) and
+    glob matches can be evaluated (with `and`, `or`, `not` and
+    ` ( ... ) ` groups), raising an `UnsupportedExpression` otherwise.
+    '''
+    tokens = expr.split()
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+
+    def parse_or():
+        res = parse_and()
+        while peek() == 'or':
+            take()
+            # note: do not short-circuit: all the tokens must be consumed
+            res = parse_and() or res
+        return res
+
+    def parse_and():
+        res = parse_not()
+        while peek() == 'and':
+            take()
+            res = parse_not() and res
+        return res
+
+    def parse_not():
+        if peek() == 'not':
+            take()
+            return not parse_not()
+        return parse_atom()
+
+    def parse_atom():
+        word = peek()
+        if word is None or word in ('and', 'or', ')'):
+            raise UnsupportedExpression('unexpected "{}" in "{}"'.format(word, expr))
+        take()
+        if word == '(':
+            res = parse_or()
+            if peek() != ')':
+                raise UnsupportedExpression('unbalanced parenthesis in "{}"'.format(expr))
+            take()
+            return res
+        return _match_word(word, grains, minion_id)
+
+    res = parse_or()
+    if peek() is not None:
+        raise UnsupportedExpression('unexpected "{}" in "{}"'.format(peek(), expr))
+    return res
+
+
+def is_supported(expr):
+    '''
+    Check if `match()` can evaluate the compound expression `expr`
+    (so modules that cannot catch an `UnsupportedExpression` can check
+    it before matching).
+    '''
+    try:
+        # all the words are evaluated, whatever the grains
+        match(expr, {}, '')
+        return True
+    except UnsupportedExpression as e:
+        debug('"%s" cannot be matched locally: %s', expr, e)
+        return False
+
+
+def get_snapshot():
+    '''
+    Get a map of <id>:<grains> for all the nodes in the cluster, with
+    all the grains used for targeting (obtained in one mine query).
+    '''
+    return get('*', grain=TARGETING_GRAIN, type='glob', local=False)
+
+
+def _local_get(expr, grain):
+    snapshot = get_snapshot()
+    if not snapshot:
+        raise UnsupportedExpression('no "{}" found in the mine'.format(TARGETING_GRAIN))
+
+    matched = [node_id for (node_id, grains) in snapshot.items()
+               if match(expr, grains, node_id)]
+
+    # mine.get only returns nodes that have exported `grain`
+    data = get('*', grain=grain, type='glob', local=False)
+    return dict((node_id, data[node_id]) for node_id in matched if node_id in data)
+
+
+def get(expr, grain=DEFAULT_GRAIN, type='compound', cached=True, local=None):
+    '''
+    Get a map of <id>:<grain> for all the nodes matching `expr`
+    (from the mine).
+
+    Results are cached for the current run (unless `cached=False`),
+    so repeated queries with the same (expr, grain, type) will not
+    hit the mine again.
+
+    Compound expressions are resolved locally when `local=True` (the
+    default is the `targeting:local` pillar): we get all the grains
+    used for targeting in one (bulk) mine query and then we evaluate
+    the expression in-process.
+    '''
+    if local is None:
+        local = __salt__['caasp_pillar.get']('targeting:local', False)
+
+    if local and type == 'compound':
+        try:
+            return _local_get(expr, grain)
+        except UnsupportedExpression as e:
+            debug('cannot resolve "%s" locally (%s): using the mine', expr, e)
+
+    if not cached:
+        return _mine_get(expr, grain, type)
+
+    cache = _get_cache()
+    key = (_normalize_expr(expr), grain, type)
+    if key in cache['entries']:
+        cache['hits'] += 1
+    else:
+        cache['misses'] += 1
+        cache['entries'][key] = _mine_get(key[0], grain, type)
+
+    # return a copy: callers should not modify our cached data
+    return dict(cache['entries'][key])
+
+
+def clear_cache():
+    '''
+    Invalidate all the mine data cached in this run.
+    '''
+    cache = _get_cache()
+    debug('invalidating %d cached mine queries', len(cache['entries']))
+    cache['entries'] = {}
+
+
+def cache_stats():
+    '''
+    Get some statistics about the mine cache (entries, hits and misses).
+    '''
+    cache = _get_cache()
+    return {'entries': len(cache['entries']),
+            'hits': cache['hits'],
+            'misses': cache['misses']}
+
+
+def update_mine(clear=False, mine_functions=None):
+    '''
+    Run a 'mine.update' and invalidate the mine cache, as all the
+    data we have cached could be stale after that.
+
+    Note: the cache lives in the `__context__` of the current run, so this
+    is only useful for code that updates the mine and reads it in the same
+    run: a `salt.function` step in an orchestration is a run of its own, so
+    it should use a plain `mine.update`.
+    '''
+    try:
+        return __salt__['mine.update'](clear=clear, mine_functions=mine_functions)
+    finally:
+        clear_cache()
@@ -12,15 +12,63 @@ This has been implemented in Salt 2018.3.0 version:
 https://github.com/saltstack/salt/commit/f72c2820f2d68f50e0919327a677f4ad8a5584b5
 
 FIXME: Remove after we update to at least Salt 2018.3.0
+
+Waiting for a successful response uses its own (pooled, keep-alive)
+HTTP client, with a timeout for every request and some backoff between them.
 '''
 from __future__ import absolute_import
 
 # Import system libs
+import base64
+import random
+import re
+import socket
+import ssl
+import threading
 import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import http.client as http_client
+    from urllib.parse import urlencode, urlparse
+except ImportError:
+    import httplib as http_client
+    from urllib import urlencode
+    from urlparse import urlparse
 
 # Import salt libs
 import salt.utils.http
 
+# note: do not import caasp modules other than caasp_log
+from caasp_log import debug
+
+# default timeout (in seconds) for every request in `pooled_query()`
+DEFAULT_TIMEOUT = 30
+
+# default interval (in seconds) between queries when waiting for a
+# successful response: it is doubled after every failure, up to
+# DEFAULT_MAX_INTERVAL, with some random jitter
+DEFAULT_INTERVAL = 0.5
+DEFAULT_MAX_INTERVAL = 10
+
+# maximum number of idle connections we keep for every server
+MAX_IDLE_CONNECTIONS = 4
+
+# maximum number of URLs waited for in parallel in `wait_for_all()`
+MAX_WAIT_THREADS = 8
+
+# arguments of `query()` supported by `pooled_query()`
+POOLED_QUERY_ARGS = ('method', 'data', 'header_dict', 'params', 'ca_bundle', 'verify_ssl',
+                     'cert', 'username', 'password', 'auth')
+
+# arguments of `query()` that only select what is returned (we
+# always return the status, text and headers in `pooled_query()`)
+POOLED_QUERY_IGNORED_ARGS = ('opts', 'test', 'status', 'text', 'headers', 'decode', 'decode_type')
+
+# idle (keep-alive) connections, by (scheme, host, port, TLS options)
+_pool = {}
+_pool_lock = threading.Lock()
+
 
 def __virtual__():
     return "caasp_http"
@@ -42,7 +90,8 @@ def query(url, **kwargs):
         salt '*' http.query http://somelink.com/ method=POST \
             data='<xml>somecontent</xml>'
     '''
-    opts = __opts__
+    # do not modify the minion's global configuration
+    opts = dict(__opts__)
     if 'opts' in kwargs:
         opts.update(kwargs['opts'])
         del kwargs['opts']
@@ -50,32 +99,257 @@ def query(url, **kwargs):
     return salt.utils.http.query(url=url, opts=opts, **kwargs)
 
 
-def wait_for_successful_query(url, wait_for=300, **kwargs):
+def _get_ssl_context(ca_bundle, verify_ssl, cert=None):
+    if not verify_ssl:
+        context = ssl._create_unverified_context()
+    else:
+        context = ssl.create_default_context(cafile=ca_bundle)
+    if cert:
+        # a client certificate: a file (with the key) or a [cert, key]
+        if isinstance(cert, (list, tuple)):
+            context.load_cert_chain(cert[0], cert[1])
+        else:
+            context.load_cert_chain(cert)
+    return context
+
+
+def _acquire(key, url, ca_bundle, verify_ssl, cert, timeout):
+    with _pool_lock:
+        idle = _pool.get(key, [])
+        connection = idle.pop() if idle else None
+
+    if connection is None:
+        if url.scheme == 'https':
+            connection = http_client.HTTPSConnection(url.hostname, url.port or 443,
+                                                     timeout=timeout,
+                                                     context=_get_ssl_context(ca_bundle, verify_ssl, cert))
+        else:
+            connection = http_client.HTTPConnection(url.hostname, url.port or 80,
+                                                    timeout=timeout)
+        return connection, False
+
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+    return connection, True
+
+
+def _release(key, connection):
+    with _pool_lock:
+        idle = _pool.setdefault(key, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(connection)
+            return
+    connection.close()
+
+
+def pooled_query(url, method='GET', data=None, header_dict=None, params=None,
+                 ca_bundle=None, verify_ssl=True, cert=None, username=None, password=None,
+                 auth=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+    '''
+    Query a resource, reusing (keep-alive) connections to the same server.
+
+    Returns a dictionary with the ``status``, ``text`` and ``headers``
+    of the response, as well as the ``time`` (in seconds) the query took,
+    or an ``error`` when the query fails (or the status is >= 400).
+
+    Unlike ``query()``, every request has a ``timeout`` (in seconds), and
+    the minion's configuration is not used or modified. Only the arguments
+    in ``POOLED_QUERY_ARGS`` are supported: ``params`` (a dictionary)
+    are added to the query string, ``cert`` is a client certificate (a file
+    or a ``[cert, key]`` list) and ``username``/``password`` (or an ``auth``
+    tuple) are sent with basic authentication.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_http.pooled_query https://localhost:444/_health verify_ssl=False
+    '''
+    start = time.time()
+    parsed = urlparse(url)
+    cert = tuple(cert) if isinstance(cert, list) else cert
+    key = (parsed.scheme, parsed.hostname, parsed.port, ca_bundle, verify_ssl, cert)
+    path = parsed.path or '/'
+    query_string = '&'.join(q for q in (parsed.query, urlencode(params or {})) if q)
+    if query_string:
+        path += '?' + query_string
+
+    headers = dict(header_dict or {})
+    if auth is not None:
+        username, password = auth
+    if username is not None:
+        credentials = '{}:{}'.format(username, password or '').encode('utf-8')
+        headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+    res = {}
+    for attempt in range(2):
+        connection, reused = _acquire(key, parsed, ca_bundle, verify_ssl, cert, timeout)
+        try:
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            res['text'] = response.read().decode('utf-8', 'replace')
+            res['status'] = response.status
+            res['headers'] = dict(response.getheaders())
+        except (socket.error, ssl.SSLError, http_client.HTTPException) as e:
+            connection.close()
+            # a kept-alive connection could have been closed by the
+            # server while idle, so we try again (once) with a new one
+            if reused and attempt == 0:
+                continue
+            res['error'] = str(e)
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            _release(key, connection)
+
+        if res['status'] >= 400:
+            res['error'] = 'HTTP {} {}'.format(res['status'], response.reason)
+        break
+
+    res['time'] = time.time() - start
+    return res
+
+
+def _check(result, expected_status=None, match=None, match_type='string'):
+    if result.get('Error') or result.get('error'):
+        return False
+    if expected_status is not None and result.get('status') != expected_status:
+        return False
+    if match is not None:
+        text = result.get('text', '')
+        if match_type == 'pcre':
+            return re.search(match, text) is not None
+        return match in text
+    return True
+
+
+def wait_for_successful_query(url, wait_for=300, expected_status=None, match=None, match_type='string',
+                              interval=DEFAULT_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                              timeout=None, **kwargs):
     '''
     Query a resource until a successful response, and decode the return data
 
+    The resource is queried (reusing connections) until we get a response
+    with no errors (and with the ``expected_status`` and/or text that
+    ``match``-es, if provided) or ``wait_for`` seconds have elapsed.
+    Queries are separated by an exponential backoff, starting at ``interval``
+    seconds and up to ``max_interval``, with some random jitter.
+
+    Every query has a ``timeout`` (by default, the ``http_request_timeout``
+    in ``opts``, or 30 seconds). The last result is returned, with
+    the ``status``/``error`` and ``time`` of all the ``attempts``.
+
+    Queries are done with ``pooled_query()``, unless some argument it
+    does not support (ie, ``cookies``) is provided: then we fall back
+    to ``query()``, with a new connection for every query.
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' http.wait_for_successful_query http://somelink.com/ wait_for=160
     '''
+    if kwargs.get('test'):
+        return salt.utils.http.query(url=url, opts=dict(__opts__), test=True)
 
-    starttime = time.time()
+    if timeout is None:
+        timeout = kwargs.get('opts', {}).get('http_request_timeout', DEFAULT_TIMEOUT)
+
+    unsupported = [k for k in kwargs
+                   if k not in POOLED_QUERY_ARGS and k not in POOLED_QUERY_IGNORED_ARGS]
+    if unsupported:
+        debug('%s not supported in pooled queries: using query() for %s',
+              ','.join(sorted(unsupported)), url)
+
+        def do_query(timeout):
+            start = time.time()
+            opts = dict(kwargs.get('opts', {}), http_request_timeout=timeout)
+            args = dict(kwargs, opts=opts, status=True, text=True)
+            result = query(url, **args)
+            result['error'] = result.get('error') or result.get('Error')
+            result['time'] = time.time() - start
+            return result
+    else:
+        query_args = dict((k, v) for (k, v) in kwargs.items() if k in POOLED_QUERY_ARGS)
+
+        def do_query(timeout):
+            return pooled_query(url, timeout=timeout, **query_args)
+
+    deadline = time.time() + wait_for
+    attempts = []
 
     while True:
-        caught_exception = None
-        result = None
-        try:
-            result = query(url=url, **kwargs)
-            if not result.get('Error') and not result.get('error'):
-                return result
-        except Exception as exc:
-            caught_exception = exc
+        # do not wait for a response beyond the deadline
+        remaining = max(deadline - time.time(), 1)
+        result = do_query(min(timeout, remaining))
+        attempts.append({'status': result.get('status'),
+                         'error': result.get('error'),
+                         'time': result['time']})
+        result['attempts'] = attempts
 
-        if time.time() > starttime + wait_for:
-            if not result and caught_exception:
-                # workaround pylint bug https://www.logilab.org/ticket/3207
-                raise caught_exception  # pylint: disable=E0702
+        if _check(result, expected_status, match, match_type):
+            return result
 
+        now = time.time()
+        if now >= deadline:
             return result
+
+        time.sleep(min(deadline - now, interval / 2 + random.uniform(0, interval / 2)))
+        interval = min(interval * 2, max_interval)
+
+
+def wait_for_all(urls, wait_for=300, **kwargs):
+    '''
+    Wait (in parallel) for successful responses from all the ``urls``,
+    or until ``wait_for`` seconds have elapsed.
+
+    ``urls`` is a list of URLs, or dictionaries with the ``url`` and
+    any of the arguments of ``wait_for_successful_query()`` (ie,
+    ``expected_status``, ``match``, ``ca_bundle``...). Other arguments
+    are used as defaults for all the URLs.
+
+    Returns a dictionary with the result for every URL: ``ok``, the last
+    ``status``/``error``, the number of ``attempts``, the ``latency`` of
+    the last query and the ``time`` we have been waiting for it.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_http.wait_for_all '[http://localhost:10248/healthz, https://localhost:444/_health]' \
+            expected_status=200 verify_ssl=False
+    '''
+    queries = []
+    for url in urls:
+        args = dict(kwargs)
+        if isinstance(url, dict):
+            args.update(url)
+            url = args.pop('url')
+        queries.append((url, args))
+
+    start = time.time()
+
+    def wait(query):
+        url, args = query
+        result = wait_for_successful_query(url, wait_for=wait_for, **args)
+        attempts = result.get('attempts', [])
+        return (url, {'ok': _check(result,
+                                   args.get('expected_status'),
+                                   args.get('match'),
+                                   args.get('match_type', 'string')),
+                      'status': result.get('status'),
+                      'error': result.get('error'),
+                      'attempts': len(attempts),
+                      'latency': result.get('time'),
+                      'time': time.time() - start})
+
+    if not queries:
+        return {}
+
+    pool = ThreadPool(min(len(queries), MAX_WAIT_THREADS))
+    try:
+        return dict(pool.map(wait, queries))
+    finally:
+        pool.close()
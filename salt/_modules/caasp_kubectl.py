@@ -0,0 +1,1007 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import random
+import os
+import socket
+import ssl
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import http.client as http_client
+    from urllib.parse import urlencode, urlparse
+except ImportError:
+    import httplib as http_client
+    from urllib import urlencode
+    from urlparse import urlparse
+
+import yaml
+
+# note: do not import caasp modules other than caasp_log
+from caasp_log import debug, info
+
+# timeout (in seconds) for requests to the API server
+KUBE_API_TIMEOUT = 60
+
+# API for deployments (see the addons manifests)
+DEPLOYMENTS_API = '/apis/apps/v1beta2'
+
+# default timeout (in seconds) when waiting for a deployment
+DEFAULT_WAIT_TIMEOUT = 600
+
+# interval (in seconds) between reconnections when the API server
+# is not available (doubled after every failure, with some jitter)
+RECONNECT_INTERVAL = 0.5
+RECONNECT_MAX_INTERVAL = 10
+
+# maximum number of deployments waited for in parallel
+MAX_WAIT_THREADS = 8
+
+# maximum number of idle connections we keep to the API server
+MAX_IDLE_CONNECTIONS = 4
+
+# annotation where `kubectl apply` stores the last applied configuration
+LAST_APPLIED_ANNOTATION = 'kubectl.kubernetes.io/last-applied-configuration'
+
+# content types for the different kinds of patches
+PATCH_CONTENT_TYPES = {
+    'strategic': 'application/strategic-merge-patch+json',
+    'merge': 'application/merge-patch+json',
+    'json': 'application/json-patch+json',
+}
+
+# kinds applied (in this order) before any other objects in a batched
+# apply, as other objects depend on them. Objects in every "wave"
+# are applied in parallel.
+APPLY_WAVES = [
+    ['Namespace', 'CustomResourceDefinition', 'PodSecurityPolicy',
+     'StorageClass', 'PriorityClass'],
+    ['ServiceAccount', 'ClusterRole', 'Role', 'ConfigMap', 'Secret'],
+    ['ClusterRoleBinding', 'RoleBinding'],
+]
+
+# default number of objects applied in parallel
+DEFAULT_APPLY_CONCURRENCY = 8
+
+# default timeout (in seconds) for draining a node
+DEFAULT_DRAIN_TIMEOUT = 600
+
+# default number of pods evicted in parallel
+DEFAULT_DRAIN_CONCURRENCY = 8
+
+# interval (in seconds) between evictions refused because of a
+# PodDisruptionBudget (doubled after every failure, with some jitter),
+# and between checks for evicted pods to be gone
+EVICTION_INTERVAL = 1
+EVICTION_MAX_INTERVAL = 10
+
+# key in the `__context__` for the (parsed) kubeconfig
+_CONFIG_KEY = 'caasp_kubectl.config'
+
+# key in the `__context__` for the (cached) API discovery
+_DISCOVERY_KEY = 'caasp_kubectl.discovery'
+
+# key in the `__context__` for the manifests queued for a batched apply
+_QUEUE_KEY = 'caasp_kubectl.queue'
+
+# idle (keep-alive) connections to the API server, and the TLS contexts,
+# by (server, credentials), kept between runs so we do not pay for a new
+# TLS handshake (and we do not read the certificates) in every call
+_pool = {}
+_ssl_contexts = {}
+_pool_lock = threading.Lock()
+
+
+def __virtual__():
+    return "caasp_kubectl"
+
+
+class KubeApiException(Exception):
+
+    def __init__(self, msg, status=None):
+        super(KubeApiException, self).__init__(msg)
+        self.status = status
+
+
+def _get_config():
+    '''
+    Get the API server and credentials from the kubeconfig
+    (`paths:kubeconfig` in the pillar), using the current context.
+    '''
+    if _CONFIG_KEY not in __context__:
+        path = __salt__['pillar.get']('paths:kubeconfig')
+        try:
+            with open(path) as f:
+                kubeconfig = yaml.safe_load(f)
+        except (IOError, yaml.YAMLError) as e:
+            raise KubeApiException('could not load {}: {}'.format(path, e))
+
+        def find(section, name):
+            for item in kubeconfig.get(section) or []:
+                if item['name'] == name:
+                    return item
+            raise KubeApiException('{} "{}" not found in {}'.format(section, name, path))
+
+        try:
+            context = find('contexts', kubeconfig['current-context'])['context']
+            cluster = find('clusters', context['cluster'])['cluster']
+            user = find('users', context['user'])['user']
+            __context__[_CONFIG_KEY] = {
+                'server': cluster['server'],
+                'ca_file': cluster.get('certificate-authority'),
+                'cert_file': user.get('client-certificate'),
+                'key_file': user.get('client-key'),
+            }
+        except (KeyError, TypeError, AttributeError) as e:
+            # a missing (or malformed) entry
+            raise KubeApiException('invalid kubeconfig {}: {!r}'.format(path, e))
+    return __context__[_CONFIG_KEY]
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+
+def _get_key():
+    # connections (and TLS contexts) are not reused when the
+    # certificates change (ie, after they have been renewed)
+    config = _get_config()
+    return (config['server'], config['ca_file'], config['cert_file'], config['key_file'],
+            _mtime(config['cert_file']))
+
+
+def _new_connection(timeout):
+    key = _get_key()
+    with _pool_lock:
+        if key not in _ssl_contexts:
+            try:
+                context = ssl.create_default_context(cafile=key[1])
+                if key[2]:
+                    context.load_cert_chain(key[2], key[3])
+            except (IOError, OSError, ssl.SSLError) as e:
+                raise KubeApiException('could not load the certificates for {}: {}'.format(key[0], e))
+            _ssl_contexts[key] = context
+        context = _ssl_contexts[key]
+    url = urlparse(key[0])
+    return http_client.HTTPSConnection(url.hostname, url.port or 443,
+                                       timeout=timeout, context=context)
+
+
+def _acquire(timeout):
+    key = _get_key()
+    with _pool_lock:
+        idle = _pool.get(key, [])
+        connection = idle.pop() if idle else None
+
+    if connection is None:
+        return _new_connection(timeout), False
+
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+    return connection, True
+
+
+def _release(connection):
+    key = _get_key()
+    with _pool_lock:
+        idle = _pool.setdefault(key, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(connection)
+            return
+    connection.close()
+
+
+def _path(path, **params):
+    params = dict((k, v) for (k, v) in params.items() if v is not None)
+    return path + ('?' + urlencode(sorted(params.items())) if params else '')
+
+
+def _request(method, path, body=None, content_type='application/json', timeout=KUBE_API_TIMEOUT):
+    '''
+    Send a request to the API server, reusing (keep-alive) connections,
+    and return the decoded response.
+    '''
+    headers = {'Accept': 'application/json'}
+    data = None
+    if body is not None:
+        headers['Content-Type'] = content_type
+        data = json.dumps(body)
+
+    for attempt in range(2):
+        connection, reused = _acquire(timeout)
+        try:
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (socket.error, ssl.SSLError, http_client.HTTPException) as e:
+            connection.close()
+            # a kept-alive connection could have been closed by the
+            # server while idle, so we try again (once) with a new one
+            if reused and attempt == 0:
+                continue
+            raise KubeApiException('{} {} failed: {}'.format(method, path, e))
+
+        if response.will_close:
+            connection.close()
+        else:
+            _release(connection)
+        break
+
+    if response.status >= 400:
+        raise KubeApiException('{} {} failed with status {}: {}'.format(
+            method, path, response.status, content), status=response.status)
+
+    return json.loads(content.decode('utf-8')) if content else {}
+
+
+def _watch(path, timeout, **params):
+    '''
+    Watch some resources (at `path`), yielding the events
+    (ie, `{'type': 'MODIFIED', 'object': {...}}`) as they arrive,
+    until the server closes the stream (after `timeout` seconds).
+    '''
+    params.update({'watch': 'true', 'timeoutSeconds': int(timeout)})
+    # watches can take a long time: do not use a pooled connection
+    connection = _new_connection(timeout + KUBE_API_TIMEOUT)
+    try:
+        connection.request('GET', _path(path, **params),
+                           headers={'Accept': 'application/json'})
+        response = connection.getresponse()
+        if response.status != 200:
+            raise KubeApiException('watch on {} failed with status {}: {}'.format(
+                path, response.status, response.read()), status=response.status)
+
+        # one JSON event per line
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+    except (socket.error, http_client.HTTPException) as e:
+        raise KubeApiException('watch on {} failed: {}'.format(path, e))
+    finally:
+        connection.close()
+
+
+def get(path, **params):
+    '''
+    Get some object from the API server (ie, `/api/v1/nodes/node1`),
+    with some optional query `params` (ie, `labelSelector`).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.get /api/v1/namespaces/kube-system/pods
+    '''
+    return _request('GET', _path(path, **params))
+
+
+def delete(path, ignore_missing=True, propagation='Background'):
+    '''
+    Delete some object in the API server (ie, `/api/v1/nodes/node1`),
+    returning `False` if it did not exist (and `ignore_missing`).
+
+    Dependent objects (ie, the replica sets of a deployment) are
+    removed too, like `kubectl delete` does.
+    '''
+    try:
+        _request('DELETE', path, body={'kind': 'DeleteOptions',
+                                       'apiVersion': 'v1',
+                                       'propagationPolicy': propagation})
+    except KubeApiException as e:
+        if e.status == 404 and ignore_missing:
+            return False
+        raise
+    return True
+
+
+def patch(path, body, patch_type='strategic'):
+    '''
+    Patch some object in the API server, with a `strategic`,
+    `merge` or `json` patch.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.patch /api/v1/nodes/node1 '{"spec": {"unschedulable": true}}'
+    '''
+    return _request('PATCH', path, body=body,
+                    content_type=PATCH_CONTENT_TYPES[patch_type])
+
+
+def _api_prefix(api_version):
+    return '/api/' + api_version if '/' not in api_version else '/apis/' + api_version
+
+
+def _discover(api_version):
+    # get the resources in an API (cached in this run)
+    discovery = __context__.setdefault(_DISCOVERY_KEY, {})
+    if api_version not in discovery:
+        resources = _request('GET', _api_prefix(api_version)).get('resources', [])
+        discovery[api_version] = dict((r['kind'], (r['name'], r.get('namespaced', False)))
+                                      for r in resources if '/' not in r['name'])
+    return discovery[api_version]
+
+
+def _get_resource(api_version, kind):
+    # get the (plural) name of the resource for a `kind`, and if it is namespaced
+    try:
+        return _discover(api_version)[kind]
+    except KeyError:
+        raise KubeApiException('unknown kind {} in {}'.format(kind, api_version))
+
+
+def _object_path(obj, named=True):
+    resource, namespaced = _get_resource(obj['apiVersion'], obj['kind'])
+    path = _api_prefix(obj['apiVersion'])
+    if namespaced:
+        path += '/namespaces/' + obj['metadata'].get('namespace', 'default')
+    path += '/' + resource
+    if named:
+        path += '/' + obj['metadata']['name']
+    return path
+
+
+def _object_id(obj):
+    metadata = obj.get('metadata', {})
+    if metadata.get('namespace'):
+        return '{}/{}/{}'.format(obj['kind'], metadata['namespace'], metadata['name'])
+    return '{}/{}'.format(obj['kind'], metadata['name'])
+
+
+def load_manifests(manifest):
+    '''
+    Load all the objects in a `manifest`: a (multi-document) YAML
+    or JSON file, or a directory with some of them (like `kubectl apply -f`).
+    '''
+    if os.path.isdir(manifest):
+        files = [os.path.join(manifest, f) for f in sorted(os.listdir(manifest))
+                 if os.path.splitext(f)[1] in ('.yaml', '.yml', '.json')]
+    else:
+        files = [manifest]
+
+    objs = []
+    for filename in files:
+        with open(filename) as f:
+            for doc in yaml.safe_load_all(f):
+                if not doc:
+                    continue
+                if doc.get('kind', '').endswith('List') and 'items' in doc:
+                    objs.extend(doc['items'])
+                else:
+                    objs.append(doc)
+    return objs
+
+
+def _with_deletions(obj, last):
+    # a copy of `obj` where keys in `last` (but not in `obj`) are `None`
+    if not isinstance(obj, dict) or not isinstance(last, dict):
+        return obj
+    res = dict((k, _with_deletions(v, last.get(k))) for (k, v) in obj.items())
+    for k in last:
+        if k not in obj:
+            res[k] = None
+    return res
+
+
+def _to_apply(obj, namespace):
+    # a copy of `obj` (in `namespace`, if it has none) with the
+    # annotation we set, and the content of that annotation
+    obj = json.loads(json.dumps(obj))
+    metadata = obj.setdefault('metadata', {})
+    if namespace and 'namespace' not in metadata and \
+            _get_resource(obj['apiVersion'], obj['kind'])[1]:
+        metadata['namespace'] = namespace
+    metadata.setdefault('annotations', {}).pop(LAST_APPLIED_ANNOTATION, None)
+    applied = json.dumps(obj, sort_keys=True)
+    obj['metadata']['annotations'][LAST_APPLIED_ANNOTATION] = applied
+    return obj, applied
+
+
+def apply_object(obj, namespace=None):
+    '''
+    Create or update an object (like `kubectl apply` does, keeping the
+    last applied configuration in an annotation), returning `created`,
+    `configured` or `unchanged`. Namespaced objects with no namespace
+    are created in `namespace` (if provided).
+    '''
+    obj, applied = _to_apply(obj, namespace)
+
+    try:
+        current = _request('GET', _object_path(obj))
+    except KubeApiException as e:
+        if e.status != 404:
+            raise
+        _request('POST', _object_path(obj, named=False), body=obj)
+        return 'created'
+
+    annotations = current['metadata'].get('annotations') or {}
+    if annotations.get(LAST_APPLIED_ANNOTATION) == applied:
+        return 'unchanged'
+
+    # a three-way merge: keys we applied last time but that are not in
+    # the object anymore must be removed (with a `null` in the patch)
+    try:
+        last = json.loads(annotations.get(LAST_APPLIED_ANNOTATION) or '{}')
+    except ValueError:
+        last = {}
+    _request('PATCH', _object_path(obj), body=_with_deletions(obj, last),
+             content_type=PATCH_CONTENT_TYPES['merge'])
+    return 'configured'
+
+
+def apply(manifest, namespace=None):
+    '''
+    Apply all the objects in a `manifest` (a file or a directory, see
+    `load_manifests()`, or a list of objects), returning a dictionary
+    with what has been done with every object (see `apply_object()`).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.apply /etc/kubernetes/addons/dns
+    '''
+    objs = load_manifests(manifest) if not isinstance(manifest, list) else manifest
+    return dict((_object_id(obj), apply_object(obj, namespace=namespace)) for obj in objs)
+
+
+def get_node(name):
+    '''
+    Get the node `name`, or `None` if it does not exist.
+    '''
+    try:
+        return _request('GET', '/api/v1/nodes/' + name)
+    except KubeApiException as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+def is_cordoned(name, ignore_errors=False):
+    '''
+    Check if the node `name` is unschedulable (or `False`
+    when it cannot be obtained and `ignore_errors`).
+    '''
+    try:
+        node = get_node(name) or {}
+    except KubeApiException as e:
+        if not ignore_errors:
+            raise
+        debug('could not get node %s: %s', name, e)
+        return False
+    return bool(node.get('spec', {}).get('unschedulable', False))
+
+
+def cordon(name, unschedulable=True):
+    '''
+    Mark the node `name` as unschedulable (or schedulable,
+    with `unschedulable=False`), returning `True` if it has changed.
+    '''
+    if is_cordoned(name) == unschedulable:
+        return False
+    patch('/api/v1/nodes/' + name, {'spec': {'unschedulable': unschedulable}})
+    return True
+
+
+def uncordon(name):
+    '''
+    Mark the node `name` as schedulable, returning `True` if it has changed.
+    '''
+    return cordon(name, unschedulable=False)
+
+
+def label_node(name, labels):
+    '''
+    Set some `labels` (a dictionary) in the node `name` (`None` values
+    remove the label), returning the labels that have changed.
+    '''
+    current = (get_node(name) or {}).get('metadata', {}).get('labels') or {}
+    changed = dict((k, v) for (k, v) in labels.items() if current.get(k) != v)
+    if changed:
+        patch('/api/v1/nodes/' + name, {'metadata': {'labels': changed}})
+    return changed
+
+
+def taint_node(name, key, value='', effect='NoSchedule', present=True):
+    '''
+    Add (or remove, with `present=False`) a taint in the node `name`,
+    returning `True` if the taints have changed.
+    '''
+    node = get_node(name) or {}
+    taints = node.get('spec', {}).get('taints') or []
+    others = [t for t in taints if t['key'] != key]
+    wanted = others + [{'key': key, 'value': value, 'effect': effect}] if present else others
+
+    def normalize(ts):
+        return sorted((t['key'], t.get('value', ''), t['effect']) for t in ts)
+
+    if normalize(wanted) == normalize(taints):
+        return False
+    # taints are not merged by key: we must send the whole list
+    patch('/api/v1/nodes/' + name, {'spec': {'taints': wanted}})
+    return True
+
+
+def evict(name, namespace, grace_period=None):
+    '''
+    Evict the pod `name` (respecting any PodDisruptionBudget),
+    raising a `KubeApiException` with status 429 when the eviction is
+    not allowed right now.
+    '''
+    body = {'apiVersion': 'policy/v1beta1',
+            'kind': 'Eviction',
+            'metadata': {'name': name, 'namespace': namespace}}
+    if grace_period is not None:
+        body['deleteOptions'] = {'gracePeriodSeconds': int(grace_period)}
+    try:
+        _request('POST', '/api/v1/namespaces/{}/pods/{}/eviction'.format(namespace, name),
+                 body=body)
+    except KubeApiException as e:
+        if e.status == 404:
+            return False
+        raise
+    return True
+
+
+def deployment_status(deployment):
+    '''
+    Get the rollout status of a `deployment` object: the desired
+    and `ready`, `available` and `updated` replicas, and if the rollout
+    is `complete` (all of them are the desired ones, and the controller
+    has seen the latest generation of the deployment).
+    '''
+    spec = deployment.get('spec', {})
+    status = deployment.get('status', {})
+    desired = spec.get('replicas', 1)
+    res = {
+        'replicas': desired,
+        'ready': status.get('readyReplicas', 0),
+        'available': status.get('availableReplicas', 0),
+        'updated': status.get('updatedReplicas', 0),
+        'observed': status.get('observedGeneration', 0) >= deployment['metadata'].get('generation', 0),
+    }
+    res['complete'] = res['observed'] and \
+        res['ready'] == res['available'] == res['updated'] == desired
+    return res
+
+
+def wait_for_deployment(name, namespace='kube-system', timeout=DEFAULT_WAIT_TIMEOUT):
+    '''
+    Wait until the rollout of the deployment `name` is complete
+    (see `deployment_status()`), or `timeout` seconds.
+
+    The deployment is read once and then we watch it, so we are
+    notified as soon as its status changes (the watch is restarted
+    when it expires or when the API server is not available).
+
+    Returns a dictionary with the last `status` of the deployment, if it
+    is `ready`, the `time` we waited and the number of `events` received
+    (or an `error` if it did not become ready).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.wait_for_deployment kube-dns
+    '''
+    collection = '{}/namespaces/{}/deployments'.format(DEPLOYMENTS_API, namespace)
+    start = time.time()
+    expire = start + timeout
+    res = {'ready': False, 'status': None, 'events': 0}
+    interval = RECONNECT_INTERVAL
+    version = None
+    last_error = None
+
+    while True:
+        try:
+            if version is None:
+                try:
+                    deployment = _request('GET', '{}/{}'.format(collection, name))
+                except KubeApiException as e:
+                    if e.status != 404:
+                        raise
+                    # not created yet: the watch will tell us
+                    debug('deployment %s/%s not found: waiting', namespace, name)
+                    version = ''
+                else:
+                    res['status'] = deployment_status(deployment)
+                    version = deployment['metadata'].get('resourceVersion', '')
+
+            if res['status'] and res['status']['complete']:
+                res['ready'] = True
+                break
+
+            remaining = expire - time.time()
+            if remaining <= 0:
+                break
+
+            for event in _watch(collection, max(1, remaining),
+                                fieldSelector='metadata.name=' + name,
+                                resourceVersion=version or None):
+                res['events'] += 1
+                interval = RECONNECT_INTERVAL
+                if event['type'] == 'ERROR':
+                    # ie, the resource version is too old: get it again
+                    debug('watch on %s/%s failed: %s', namespace, name, event['object'])
+                    version = None
+                    break
+                version = event['object']['metadata'].get('resourceVersion', version)
+                if event['type'] == 'DELETED':
+                    res['status'] = None
+                    continue
+                res['status'] = deployment_status(event['object'])
+                if res['status']['complete']:
+                    break
+        except KubeApiException as e:
+            debug('waiting for deployment %s/%s: %s', namespace, name, e)
+            last_error = e
+            delay = min(interval / 2.0 + random.uniform(0, interval / 2.0), expire - time.time())
+            if delay <= 0:
+                break
+            time.sleep(delay)
+            interval = min(interval * 2, RECONNECT_MAX_INTERVAL)
+            version = None
+
+    res['time'] = time.time() - start
+    if not res['ready']:
+        res['error'] = 'timeout after {}s (status: {}, last error: {})'.format(
+            timeout, res['status'], last_error)
+    return res
+
+
+def _parse_deployment(deployment, namespace):
+    # "name", "namespace/name" or {'name': ..., 'namespace': ...}
+    if isinstance(deployment, dict):
+        return deployment.get('namespace', namespace), deployment['name']
+    if '/' in deployment:
+        return tuple(deployment.split('/', 1))
+    return namespace, deployment
+
+
+def wait_for_deployments(deployments, namespace='kube-system', timeout=DEFAULT_WAIT_TIMEOUT):
+    '''
+    Wait (in parallel) until the rollout of all the `deployments`
+    is complete, or `timeout` seconds.
+
+    `deployments` is a list of names (in `namespace`), `namespace/name`
+    strings or dictionaries with the `name` and `namespace`.
+
+    Returns a dictionary with the result of `wait_for_deployment()` for
+    every `namespace/name`, so it is easy to see which one is blocking us
+    (and for how long).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.wait_for_deployments '[kube-dns, dex]'
+    '''
+    targets = [_parse_deployment(d, namespace) for d in deployments]
+    if not targets:
+        return {}
+
+    # load the kubeconfig once, before we use it from many threads
+    _get_config()
+
+    def wait(target):
+        ns, name = target
+        return ('{}/{}'.format(ns, name),
+                wait_for_deployment(name, namespace=ns, timeout=timeout))
+
+    pool = ThreadPool(min(len(targets), MAX_WAIT_THREADS))
+    try:
+        return dict(pool.map(wait, targets))
+    finally:
+        pool.close()
+
+
+def _object_hash(obj, namespace):
+    content = json.dumps([obj, namespace], sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _applied_cache_path():
+    return os.path.join(__opts__['cachedir'], 'caasp_kubectl', 'applied.json')
+
+
+def _load_applied_cache(cluster_id):
+    # the hashes of the objects applied in this cluster (as identified
+    # by the uid of the `kube-system` namespace, so we do not trust our
+    # cache after the cluster has been re-created)
+    try:
+        with open(_applied_cache_path()) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return cache.get('hashes', {}) if cache.get('cluster') == cluster_id else {}
+
+
+def _save_applied_cache(cluster_id, hashes):
+    path = _applied_cache_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.part', 'w') as f:
+        json.dump({'cluster': cluster_id, 'hashes': hashes}, f)
+    os.rename(path + '.part', path)
+
+
+def _apply_wave(kind):
+    for (num, kinds) in enumerate(APPLY_WAVES):
+        if kind in kinds:
+            return num
+    return len(APPLY_WAVES)
+
+
+def _live_unchanged(objs):
+    '''
+    Get the ids of the objects in `objs` (a map of <id>:(<obj>, <namespace>))
+    that exist in the cluster with the same last applied configuration,
+    with just one LIST for every kind (and namespace).
+    '''
+    collections = {}
+    for (obj_id, (obj, ns)) in objs.items():
+        try:
+            obj, applied = _to_apply(obj, ns)
+            path = _object_path(obj, named=False)
+        except KubeApiException as e:
+            debug('cannot check %s: %s', obj_id, e)
+            continue
+        collections.setdefault(path, []).append((obj_id, obj['metadata']['name'], applied))
+
+    res = set()
+    for (path, items) in collections.items():
+        try:
+            live = _request('GET', path).get('items') or []
+        except KubeApiException as e:
+            debug('could not list %s: %s', path, e)
+            continue
+        annotations = dict((o['metadata']['name'],
+                            (o['metadata'].get('annotations') or {}).get(LAST_APPLIED_ANNOTATION))
+                           for o in live)
+        res.update(obj_id for (obj_id, name, applied) in items
+                   if annotations.get(name) == applied)
+    return res
+
+
+def queue_apply(manifest, namespace=None):
+    '''
+    Queue a `manifest` for a batched apply (see `apply_batch()`)
+    later on in this run, returning the number of manifests queued.
+    '''
+    queue = __context__.setdefault(_QUEUE_KEY, [])
+    queue.append({'manifest': manifest, 'namespace': namespace})
+    return len(queue)
+
+
+def pop_queue():
+    '''
+    Get (and clear) the manifests queued in this run.
+    '''
+    return __context__.pop(_QUEUE_KEY, [])
+
+
+def apply_batch(manifests, namespace=None, concurrency=DEFAULT_APPLY_CONCURRENCY, force=False):
+    '''
+    Apply all the objects in some `manifests` (a list of files/directories,
+    or dictionaries with the `manifest` and its `namespace`), with up to
+    `concurrency` objects in parallel.
+
+    Objects that have not changed since the last time we applied them
+    (as we remember from a hash of their content) are skipped, unless
+    `force`-d, but only after checking (with one LIST per kind) they still
+    exist in the cluster with the same last applied configuration: objects
+    deleted or re-applied by someone else are applied again. Namespaces,
+    RBAC rules and so on are applied before any other objects
+    (see `APPLY_WAVES`).
+
+    Returns a dictionary with what has been done with every object
+    (`applied`), the number of `skipped` objects and the `errors`.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.apply_batch '[/etc/kubernetes/addons/dns, /etc/kubernetes/addons/dex]'
+    '''
+    objs = {}
+    for item in manifests:
+        if not isinstance(item, dict):
+            item = {'manifest': item}
+        ns = item.get('namespace') or namespace
+        for obj in load_manifests(item['manifest']):
+            objs[_object_id(obj)] = (obj, ns, _object_hash(obj, ns))
+
+    res = {'applied': {}, 'skipped': 0, 'errors': {}}
+    if not objs:
+        return res
+
+    cluster_id = _request('GET', '/api/v1/namespaces/kube-system')['metadata']['uid']
+    applied = _load_applied_cache(cluster_id) if not force else {}
+
+    # discover all the resources before using them from many threads
+    # (some APIs could not exist yet, ie, for the CRDs in this batch)
+    for api_version in set(v[0]['apiVersion'] for v in objs.values()):
+        try:
+            _discover(api_version)
+        except KubeApiException as e:
+            debug('could not discover %s: %s', api_version, e)
+
+    # objects we have applied (with the same content) in the
+    # past are skipped if they have not changed in the cluster
+    cached = dict((obj_id, (v[0], v[1])) for (obj_id, v) in objs.items()
+                  if applied.get(obj_id) == v[2])
+    unchanged = _live_unchanged(cached) if cached else set()
+    for obj_id in set(cached) - unchanged:
+        debug('%s has changed in the cluster: applying it again', obj_id)
+
+    pending = dict((obj_id, v) for (obj_id, v) in objs.items() if obj_id not in unchanged)
+    res['skipped'] = len(objs) - len(pending)
+    debug('applying %d objects (%d unchanged)', len(pending), res['skipped'])
+    if not pending:
+        return res
+
+    def apply_one(obj_id):
+        obj, ns, digest = pending[obj_id]
+        try:
+            return obj_id, apply_object(obj, namespace=ns), None
+        except KubeApiException as e:
+            return obj_id, None, str(e)
+
+    waves = {}
+    for obj_id, (obj, _, _) in pending.items():
+        waves.setdefault(_apply_wave(obj['kind']), []).append(obj_id)
+
+    pool = ThreadPool(max(1, min(len(pending), int(concurrency))))
+    try:
+        for wave in sorted(waves):
+            for (obj_id, action, error) in pool.map(apply_one, sorted(waves[wave])):
+                if error:
+                    res['errors'][obj_id] = error
+                    applied.pop(obj_id, None)
+                else:
+                    res['applied'][obj_id] = action
+                    applied[obj_id] = pending[obj_id][2]
+    finally:
+        pool.close()
+        _save_applied_cache(cluster_id, applied)
+
+    return res
+
+
+def _pod_id(pod):
+    return '{}/{}'.format(pod['metadata']['namespace'], pod['metadata']['name'])
+
+
+def _skip_pod(pod):
+    # pods we do not evict (like `kubectl drain --ignore-daemonsets`)
+    metadata = pod['metadata']
+    if 'kubernetes.io/config.mirror' in (metadata.get('annotations') or {}):
+        return 'mirror pod'
+    for owner in metadata.get('ownerReferences') or []:
+        if owner.get('kind') == 'DaemonSet':
+            return 'managed by a DaemonSet'
+    if pod.get('status', {}).get('phase') in ('Succeeded', 'Failed'):
+        return 'terminated'
+    return None
+
+
+def _evict_pod(pod, expire, grace_period):
+    # evict a pod (retrying while a PodDisruptionBudget does not allow
+    # it) and wait until it is gone, returning some progress info
+    namespace, name = pod['metadata']['namespace'], pod['metadata']['name']
+    uid = pod['metadata'].get('uid')
+    start = time.time()
+    res = {'attempts': 0, 'blocked': 0}
+    interval = EVICTION_INTERVAL
+
+    def backoff():
+        delay = min(interval / 2.0 + random.uniform(0, interval / 2.0), expire - time.time())
+        if delay <= 0:
+            return False
+        time.sleep(delay)
+        return True
+
+    while True:
+        res['attempts'] += 1
+        try:
+            evict(name, namespace, grace_period=grace_period)
+            break
+        except KubeApiException as e:
+            if e.status != 429:
+                res['error'] = str(e)
+                return res
+            # a PodDisruptionBudget does not allow the eviction right now
+            debug('eviction of %s/%s refused (attempt %d): %s', namespace, name, res['attempts'], e)
+            blocked = time.time()
+            if not backoff():
+                res['blocked'] += time.time() - blocked
+                res['error'] = 'eviction not allowed by a disruption budget after {} attempts'.format(
+                    res['attempts'])
+                return res
+            res['blocked'] += time.time() - blocked
+            interval = min(interval * 2, EVICTION_MAX_INTERVAL)
+
+    res['evicted'] = time.time() - start
+    info('pod %s/%s evicted after %.2fs (%d attempts): waiting for it to be gone',
+         namespace, name, res['evicted'], res['attempts'])
+
+    interval = EVICTION_INTERVAL
+    path = '/api/v1/namespaces/{}/pods/{}'.format(namespace, name)
+    while True:
+        try:
+            current = _request('GET', path)
+            if current['metadata'].get('uid') != uid:
+                break
+        except KubeApiException as e:
+            if e.status == 404:
+                break
+            debug('could not get pod %s/%s: %s', namespace, name, e)
+        if not backoff():
+            res['error'] = 'evicted, but still terminating'
+            return res
+        interval = min(interval * 2, EVICTION_MAX_INTERVAL)
+
+    res['gone'] = time.time() - start
+    info('pod %s/%s gone after %.2fs', namespace, name, res['gone'])
+    return res
+
+
+def drain(name, timeout=DEFAULT_DRAIN_TIMEOUT, concurrency=DEFAULT_DRAIN_CONCURRENCY,
+          grace_period=None):
+    '''
+    Drain the node `name`: cordon it and evict all its pods (but mirror
+    pods, pods managed by a DaemonSet and terminated pods), with up to
+    `concurrency` evictions in parallel, waiting until they are gone
+    or `timeout` seconds.
+
+    Evictions refused because of a PodDisruptionBudget are retried (with
+    some backoff). The progress of every pod is logged, and the result
+    includes, for every pod, the number of `attempts`, the time it was
+    `blocked` by a disruption budget, when it was `evicted` and when it
+    was `gone` (in seconds since we started), or some `error`.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' caasp_kubectl.drain node1 timeout=300
+    '''
+    start = time.time()
+    expire = start + float(timeout)
+    cordon(name)
+
+    pods = _request('GET', _path('/api/v1/pods', fieldSelector='spec.nodeName=' + name))
+    res = {'pods': {}, 'skipped': {}}
+    evicted = []
+    for pod in pods.get('items', []):
+        reason = _skip_pod(pod)
+        if reason:
+            res['skipped'][_pod_id(pod)] = reason
+        else:
+            evicted.append(pod)
+
+    info('draining %s: evicting %d pods (%d skipped)', name, len(evicted), len(res['skipped']))
+
+    def evict_one(pod):
+        return _pod_id(pod), _evict_pod(pod, expire, grace_period)
+
+    if evicted:
+        pool = ThreadPool(max(1, min(len(evicted), int(concurrency))))
+        try:
+            res['pods'] = dict(pool.map(evict_one, evicted))
+        finally:
+            pool.close()
+
+    res['drained'] = not any('error' in p for p in res['pods'].values())
+    res['time'] = time.time() - start
+    return res
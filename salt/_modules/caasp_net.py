@@ -5,15 +5,28 @@
 
 from __future__ import absolute_import
 
+import errno
+import socket
+import time
+from multiprocessing.pool import ThreadPool
 
 # note: do not import caasp modules other than caasp_log
-from caasp_log import error
+from caasp_log import debug, error
 
 
 DEFAULT_INTERFACE = 'eth0'
 
 NODENAME_GRAIN = 'nodename'
 
+# port used for measuring the RTT between nodes (see `peer_rtts()`)
+# note: an accepted connection (or a "connection refused") takes one
+#       RTT, so anything can be listening there, but the port must not be
+#       filtered (probes would time out): sshd is reachable in all the nodes
+DEFAULT_PROBE_PORT = 22
+
+# maximum number of peers probed in parallel
+MAX_PROBE_THREADS = 16
+
 
 def __virtual__():
     return "caasp_net"
@@ -92,3 +105,53 @@ def get_nodename(host=None, **kwargs):
     except Exception as e:
         error('could not get nodename: %s', e)
         return ''
+
+
+def _tcp_rtt(host, port, timeout):
+    # a TCP handshake (or a RST) takes one round trip
+    start = time.time()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((host, port))
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            return None
+    finally:
+        sock.close()
+    return (time.time() - start) * 1000.0
+
+
+def peer_rtts(port=None, timeout=1, samples=3):
+    '''
+    Measure the round-trip time (in milliseconds) from this node to all
+    the other nodes in the cluster, returning a map of <id>:<RTT>
+    (with `None` for unreachable nodes).
+
+    This is meant to be used as a mine function (see pillar/mine.sls):
+    every peer is probed (in parallel) with `samples` TCP connections
+    to `port` (default: the `hw:probe_port` pillar), keeping the
+    lowest time.
+    '''
+    port = int(port or __salt__['caasp_pillar.get']('hw:probe_port', DEFAULT_PROBE_PORT))
+    this_id = __opts__['id']
+    peers = [(node_id, nodename)
+             for (node_id, nodename) in __salt__['caasp_grains.get']('*', type='glob').items()
+             if node_id != this_id]
+    if not peers:
+        return {}
+
+    def probe(peer):
+        node_id, nodename = peer
+        rtts = [_tcp_rtt(nodename, port, timeout) for _ in range(samples)]
+        rtts = [rtt for rtt in rtts if rtt is not None]
+        return (node_id, min(rtts) if rtts else None)
+
+    pool = ThreadPool(min(len(peers), MAX_PROBE_THREADS))
+    try:
+        res = dict(pool.map(probe, peers))
+    finally:
+        pool.close()
+
+    debug('RTTs to peers: %s', res)
+    return res
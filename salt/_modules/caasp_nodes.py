@@ -22,6 +22,13 @@ IN_PROGRESS_GRAINS = ['bootstrap_in_progress',
 USE_UNASSIGNED = False
 
 
+class UnsupportedPrioRules(Exception):
+    '''
+    Some priority rules cannot be evaluated locally (see `rank_with_prio()`)
+    '''
+    pass
+
+
 def __virtual__():
     return "caasp_nodes"
 
@@ -120,6 +127,107 @@ _PRIO_FUN = {
 }
 
 
+class ClusterView(object):
+    '''
+    A compact view of all the nodes in the cluster, built from one
+    snapshot of the targeting grains (see `caasp_grains.get_snapshot()`).
+
+    Nodes are kept in a (sorted) array, and roles and flags (`booted`,
+    `in_progress` and each one of the `*_in_progress` grains) are stored
+    as integer masks, where bit `i` is the node at position `i`. So
+    membership tests are O(1) and sets of nodes can be combined
+    with bitwise operations. For example, masters not bootstrapped yet:
+
+        view.nodes(view.mask('kube-master') & ~view.mask('booted'))
+    '''
+
+    def __init__(self, snapshot):
+        self.ids = sorted(snapshot.keys())
+        self.all = (1 << len(self.ids)) - 1
+        self._index = dict((node, i) for (i, node) in enumerate(self.ids))
+        self._masks = {}
+
+        def is_true(value):
+            return str(value).lower() == 'true'
+
+        for (i, node) in enumerate(self.ids):
+            grains = snapshot[node] or {}
+            flags = list(grains.get('roles') or [])
+            if is_true(grains.get('bootstrap_complete')):
+                flags.append('booted')
+            in_progress = [g for g in IN_PROGRESS_GRAINS if is_true(grains.get(g))]
+            if in_progress:
+                flags += in_progress + ['in_progress']
+            for flag in flags:
+                self._masks[flag] = self._masks.get(flag, 0) | (1 << i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def mask(self, *flags):
+        '''
+        Get the mask for the nodes with any of the `flags`
+        '''
+        res = 0
+        for flag in flags:
+            res |= self._masks.get(flag, 0)
+        return res
+
+    def mask_of(self, nodes):
+        '''
+        Get the mask for some list of `nodes` (ignoring unknown nodes)
+        '''
+        res = 0
+        for node in nodes:
+            if node in self._index:
+                res |= 1 << self._index[node]
+        return res
+
+    def has(self, node, mask):
+        '''
+        Check if `node` is in `mask`
+        '''
+        i = self._index.get(node)
+        return i is not None and bool(mask & (1 << i))
+
+    def nodes(self, mask):
+        '''
+        Get the (sorted) list of nodes in `mask`
+        '''
+        res = []
+        i = 0
+        mask &= self.all
+        while mask:
+            if mask & 1:
+                res.append(self.ids[i])
+            mask >>= 1
+            i += 1
+        return res
+
+
+# lists of nodes that can be obtained from a `ClusterView`
+# (see `get_from_args_or_with_expr()`)
+_VIEW_LISTS = {
+    'forbidden': lambda v: v.mask('admin', 'ca'),
+    'masters': lambda v: v.mask('kube-master'),
+    'minions': lambda v: v.mask('kube-minion'),
+    'etcd_members': lambda v: v.mask('etcd'),
+    'booted_masters': lambda v: v.mask('kube-master') & v.mask('booted'),
+    'booted_minions': lambda v: v.mask('kube-minion') & v.mask('booted'),
+    'booted_etcd_members': lambda v: v.mask('etcd') & v.mask('booted'),
+}
+
+
+def get_cluster_view():
+    '''
+    Get a `ClusterView` of the cluster, that can be passed (as `view`)
+    to most of the functions in this module, as well as to
+    `caasp_etcd.get_cluster_size()` and `caasp_etcd.get_additional_etcd_members()`,
+    instead of the lists of masters, minions, etcd members, etc.
+    '''
+    return ClusterView(__salt__['caasp_grains.get_snapshot']())
+
+
 # for a list `lst`, filter out empty/None, remove duplicates and sort it
 def _sanitize_list(lst):
     res = [x for x in lst if x]
@@ -160,7 +268,7 @@ def get_with_expr(expr, **kwargs):
         excluded_grains += IN_PROGRESS_GRAINS
 
     if excluded:
-        expr_items.append('not L@' + '|'.join(excluded))
+        expr_items.append('not L@' + ','.join(excluded))
 
     excluded_roles = _sanitize_list(excluded_roles)
     if excluded_roles:
@@ -178,16 +286,64 @@ def get_with_expr(expr, **kwargs):
 
 def get_from_args_or_with_expr(arg_name, args_dict, *args, **kwargs):
     '''
-    Utility function for getting a list of nodes from either the kwargs
-    or from an expression.
+    Utility function for getting a list of nodes from either the kwargs,
+    a `ClusterView` in the kwargs (as `view`) or from an expression.
     '''
     if arg_name in args_dict:
         debug('using argument "%s": %s', arg_name, args_dict[arg_name])
         return _sanitize_list(args_dict[arg_name])
+    elif args_dict.get('view') is not None and arg_name in _VIEW_LISTS:
+        view = args_dict['view']
+        return view.nodes(_VIEW_LISTS[arg_name](view))
     else:
         return get_with_expr(*args, **kwargs)
 
 
+def rank_with_prio(num, description, prio_rules, **kwargs):
+    '''
+    Get a list of (up to) `num` (<id>, <rule>) pairs for the best
+    candidates for running some role, where <rule> is the
+    priority rule that selected that node.
+
+    The candidates are obtained (and filtered as in `get_with_prio()`)
+    only once, and then every node is scored against all the `prio_rules`
+    in a single pass, using the targeting grains in the mine. Nodes
+    are returned by rule priority and then by id.
+
+    An `UnsupportedPrioRules` is raised when some rule cannot be
+    evaluated locally (see `caasp_grains.is_supported()`).
+    '''
+    unsupported = [expr for expr in prio_rules
+                   if not __salt__['caasp_grains.is_supported'](expr)]
+    if unsupported:
+        raise UnsupportedPrioRules('cannot match {} locally'.format(
+            ', '.join('"{}"'.format(expr) for expr in unsupported)))
+
+    candidates = get_with_expr('*',
+                               exclude_admin=True, exclude_in_progress=True,
+                               **kwargs)
+    snapshot = __salt__['caasp_grains.get_snapshot']()
+
+    ranked = []
+    for node in candidates:
+        grains = snapshot.get(node)
+        if grains is None:
+            continue
+        for (prio, expr) in enumerate(prio_rules):
+            if __salt__['caasp_grains.match'](expr, grains, node):
+                ranked.append((prio, node, expr))
+                break
+
+    ranked.sort()
+    res = [(node, expr) for (_, node, expr) in ranked[:num]]
+    for (node, expr) in res:
+        debug('%s selected for %s with "%s"', node, description, expr)
+
+    info('we were looking for %d candidates for %s and %d found (out of %d ranked)',
+         num, description, len(res), len(ranked))
+    return res
+
+
 def get_with_prio(num, description, prio_rules, **kwargs):
     '''
     Get a list of `num` nodes that could be used for
@@ -198,8 +354,21 @@ def get_with_prio(num, description, prio_rules, **kwargs):
       1) is not the `admin` or `ca`
       2) dopes not currently have that role
       2) is not being removed/added/updated
+
+    When the `targeting:local` pillar is enabled, all the candidates
+    are ranked in one pass with `rank_with_prio()` (unless some rule
+    cannot be evaluated locally: then we query for every rule).
     '''
+    if __salt__['caasp_pillar.get']('targeting:local', False) and \
+       __salt__['caasp_grains.get_snapshot']():
+        try:
+            return [node for (node, _) in rank_with_prio(num, description, prio_rules, **kwargs)]
+        except UnsupportedPrioRules as e:
+            warn('cannot rank candidates for %s locally (%s): querying for every rule',
+                 description, e)
+
     new_nodes = []
+    seen = set()
     remaining = num
     for expr in prio_rules:
         debug('trying to find candidates for "%s" with "%s"',
@@ -210,11 +379,12 @@ def get_with_prio(num, description, prio_rules, **kwargs):
                                    exclude_admin=True, exclude_in_progress=True,
                                    **kwargs)
         debug('... %d candidates', len(candidates))
-        ids = [x for x in candidates if x not in new_nodes]
+        ids = [x for x in candidates if x not in seen]
         if len(ids) > 0:
             debug('... new candidates: %s (we need %d)', candidates, remaining)
             new_ids = ids[:remaining]
             new_nodes = new_nodes + new_ids
+            seen.update(new_ids)
             remaining -= len(new_ids)
             debug('... %d new candidates (%s) for %s: %d remaining',
                   len(ids), str(ids), description, remaining, )
@@ -299,7 +469,7 @@ def get_replacement_for(target, replacement='', **kwargs):
         # check if the replacement provided is valid
         if etcd_replacement:
             bootstrapped_etcd_members = get_from_args_or_with_expr(
-                'booted_etcd_members', kwargs, 'G@roles:kube-master', booted=True)
+                'booted_etcd_members', kwargs, 'G@roles:etcd', booted=True)
 
             if etcd_replacement in bootstrapped_etcd_members:
                 warn_or_abort_on_replacement_provided('the replacement for the etcd server %s cannot be %s: another etcd server is already running there',
@@ -449,55 +619,128 @@ def get_replacement_for(target, replacement='', **kwargs):
     return replacement, replacement_roles
 
 
-def get_expr_affected_by(target, **kwargs):
+def get_replacements_for(targets, replacements=None, **kwargs):
     '''
-    Get an expression for matching nodes that are affected by the
-    addition/removal of `target`. Those affected nodes should
-    be highstated in order to update their configuration.
+    When removing all the nodes in `targets` at once, get a replacement
+    (and the new roles that must be assigned) for each one of them.
 
-    Some notes:
+    This is like calling `get_replacement_for()` for each target, but
 
-      * we only consider bootstraped nodes.
-      * we ignore nodes where some oither operation is in progress (ie, an update)
+      * no target will be used as a replacement of another target
+      * the same node will not be chosen as a replacement twice
+      * the minimum number of nodes per role is checked against what
+        will remain in the cluster after removing all the `targets`
 
     Optional arguments:
 
-      * `exclude_in_progress`: (default=True) exclude any node with *_in_progress
-      * `excluded`: list of nodes to exclude
-      * `excluded_roles`: list of roles to exclude
+      * `replacements`: map of user-provided <target>:<replacement>
+      * all the arguments supported by `get_replacement_for()`
+
+    Returns a map of <target>:(<replacement>, <roles>)
+    '''
+    targets = _sanitize_list(targets)
+    replacements = replacements or {}
+
+    # the targets cannot be used as replacements
+    excluded = _sanitize_list(kwargs.pop('excluded', []) + targets)
+
+    # preparations: get the lists we will keep updating while
+    # we plan the removal of the targets
+    for (arg_name, expr) in [('forbidden', 'P@roles:(admin|ca)'),
+                             ('masters', 'G@roles:kube-master'),
+                             ('minions', 'G@roles:kube-minion'),
+                             ('etcd_members', 'G@roles:etcd')]:
+        kwargs[arg_name] = get_from_args_or_with_expr(arg_name, kwargs, expr)
+
+    roles_lists = {'etcd': 'etcd_members',
+                   'kube-master': 'masters',
+                   'kube-minion': 'minions'}
+
+    res = {}
+    for target in targets:
+        replacement, replacement_roles = get_replacement_for(target,
+                                                             replacements.get(target, ''),
+                                                             excluded=excluded,
+                                                             **kwargs)
+        res[target] = (replacement, replacement_roles)
+
+        # the target will not be there anymore...
+        for arg_name in roles_lists.values():
+            kwargs[arg_name] = [x for x in kwargs[arg_name] if x != target]
+
+        # ... but the replacement will (with some new roles)
+        if replacement:
+            debug('%s will be replaced by %s (with roles %s)',
+                  target, replacement, ','.join(replacement_roles))
+            excluded.append(replacement)
+            for role in replacement_roles:
+                kwargs[roles_lists[role]].append(replacement)
+
+    return res
+
+
+def _get_roles_affected_by(targets, **kwargs):
+    '''
+    Get the (sorted) list of roles affected by the addition/removal
+    of all the nodes in `targets`
     '''
-    affected_items = []
     affected_roles = []
 
     etcd_members = get_from_args_or_with_expr('etcd_members', kwargs, 'G@roles:etcd')
     masters = get_from_args_or_with_expr('masters', kwargs, 'G@roles:kube-master')
     minions = get_from_args_or_with_expr('minions', kwargs, 'G@roles:kube-minion')
 
-    if target in etcd_members:
+    if any(t in etcd_members for t in targets):
         # we must highstate:
         # * etcd members (ie, peers list in /etc/sysconfig/etcd)
         affected_roles.append('etcd')
         # * api servers (ie, etcd endpoints in /etc/kubernetes/apiserver
         affected_roles.append('kube-master')
 
-    if target in masters:
+    if any(t in masters for t in targets):
         # we must highstate:
         # * admin (ie, haproxy)
         affected_roles.append('admin')
         # * minions (ie, haproxy)
         affected_roles.append('kube-minion')
 
-    if target in minions:
+    if any(t in minions for t in targets):
         # ok, ok, /etc/hosts will contain the old node, but who cares!
         pass
 
     if not affected_roles:
-        debug('no roles affected by the removal/addition of %s', target)
+        debug('no roles affected by the removal/addition of %s', ','.join(targets))
+
+    return _sanitize_list(affected_roles)
+
+
+def get_expr_affected_by(target, **kwargs):
+    '''
+    Get an expression for matching nodes that are affected by the
+    addition/removal of `target`. Those affected nodes should
+    be highstated in order to update their configuration.
+
+    Some notes:
+
+      * we only consider bootstraped nodes.
+      * we ignore nodes where some oither operation is in progress (ie, an update)
+      * `target` can also be a list of nodes (ie, when removing many nodes at once)
+
+    Optional arguments:
+
+      * `exclude_in_progress`: (default=True) exclude any node with *_in_progress
+      * `excluded`: list of nodes to exclude
+      * `excluded_roles`: list of roles to exclude
+    '''
+    affected_items = []
+
+    targets = target if isinstance(target, list) else [target]
+
+    affected_roles = _get_roles_affected_by(targets, **kwargs)
+    if not affected_roles:
         return ''
 
     affected_items.append('G@bootstrap_complete:true')
-
-    affected_roles.sort()
     affected_items.append('P@roles:(' + '|'.join(affected_roles) + ')')
 
     # exclude some roles
@@ -509,7 +752,7 @@ def get_expr_affected_by(target, **kwargs):
         affected_items.append('not G@node_removal_in_progress:true')
         affected_items.append('not G@node_addition_in_progress:true')
 
-    excluded_nodes = _sanitize_list([target] + kwargs.get('excluded', []))
+    excluded_nodes = _sanitize_list(targets + kwargs.get('excluded', []))
     if excluded_nodes:
         affected_items.append('not L@' + ','.join(excluded_nodes))
 
@@ -520,6 +763,78 @@ def get_expr_affected_by(target, **kwargs):
     return ' and '.join(affected_items)
 
 
+def get_affected_by(target, **kwargs):
+    '''
+    Like `get_expr_affected_by()`, but get the resolved (and sorted)
+    list of ids of the affected nodes, so they can be targeted with
+    a `list` (and we can see what will be affected before running anything).
+
+    The nodes are resolved with a `ClusterView`, the one provided in
+    `view` or a new one otherwise.
+
+    Optional arguments:
+
+      * `view`: the `ClusterView` used for resolving the nodes
+      * all the arguments supported by `get_expr_affected_by()`
+    '''
+    targets = target if isinstance(target, list) else [target]
+
+    view = kwargs.get('view')
+    if view is None:
+        view = kwargs['view'] = get_cluster_view()
+
+    affected_roles = _get_roles_affected_by(targets, **kwargs)
+    if not affected_roles:
+        return []
+
+    mask = view.mask(*affected_roles) & view.mask('booted') & ~view.mask('ca')
+
+    if kwargs.get('exclude_in_progress', True):
+        mask &= ~view.mask('in_progress')
+
+    mask &= ~view.mask_of(targets + kwargs.get('excluded', []))
+    mask &= ~view.mask(*kwargs.get('excluded_roles', []))
+
+    res = view.nodes(mask)
+    info('nodes affected by the removal/addition of %s: %s',
+         ','.join(targets), ','.join(res))
+    return res
+
+
+def get_target_affected_by(target, **kwargs):
+    '''
+    Get a `(expr, tgt_type)` for targeting the nodes affected by the
+    addition/removal of `target`: the resolved `list` of nodes (see
+    `get_affected_by()`) when local targeting is enabled, or a `compound`
+    expression (see `get_expr_affected_by()`) otherwise.
+
+    The `ClusterView` is only trusted when it knows about all the
+    targets: with an empty (or outdated) snapshot we would get
+    no affected nodes, so we fall back to the `compound` expression.
+
+    Optional arguments:
+
+      * `view`: the `ClusterView` used for resolving the nodes
+      * all the arguments supported by `get_expr_affected_by()`
+    '''
+    if __salt__['caasp_pillar.get']('targeting:local', False):
+        targets = target if isinstance(target, list) else [target]
+
+        view = kwargs.get('view')
+        if view is None:
+            view = kwargs['view'] = get_cluster_view()
+
+        missing = [t for t in targets if not view.has(t, view.all)]
+        if not missing:
+            return ','.join(get_affected_by(target, **kwargs)), 'list'
+
+        warn('%s not found in the cluster view: falling back to a compound target',
+             ','.join(missing))
+
+    kwargs.pop('view', None)
+    return get_expr_affected_by(target, **kwargs), 'compound'
+
+
 def get_super_master(**kwargs):
     '''
     Get one random master that can be used as super-master
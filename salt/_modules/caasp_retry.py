@@ -0,0 +1,224 @@
+from __future__ import absolute_import
+
+import random
+import time
+
+# note: do not import caasp modules other than caasp_log
+from caasp_log import debug, warn
+
+# default maximum interval (in seconds) between attempts
+# when using an exponential backoff
+DEFAULT_MAX_INTERVAL = 30
+
+# key in the `__context__` for the retries left in this run
+_BUDGET_KEY = 'caasp_retry.budget'
+
+# key in the `__context__` for the telemetry of all the calls in this run
+_TELEMETRY_KEY = 'caasp_retry.telemetry'
+
+# key in state returns where we leave the telemetry
+TELEMETRY_RET_KEY = 'retries'
+
+
+def __virtual__():
+    return "caasp_retry"
+
+
+def _get_retcode(ret):
+    # states like `cmd.run` return the exit code in the changes
+    changes = ret.get('changes')
+    if isinstance(changes, dict):
+        return changes.get('retcode')
+    return None
+
+
+def budget_left():
+    '''
+    Get the number of retries left in the budget for this run (the
+    `retry:budget` pillar), or `None` when there is no limit.
+    '''
+    if _BUDGET_KEY not in __context__:
+        budget = __salt__['caasp_pillar.get']('retry:budget', 0)
+        __context__[_BUDGET_KEY] = int(budget) if budget else None
+    return __context__[_BUDGET_KEY]
+
+
+def _take_from_budget():
+    left = budget_left()
+    if left is None:
+        return True
+    if left <= 0:
+        return False
+    __context__[_BUDGET_KEY] = left - 1
+    return True
+
+
+def call(fun, name='', attempts=None, interval=1, backoff=1, max_interval=DEFAULT_MAX_INTERVAL,
+         jitter=False, deadline=None, non_retriable=None, budget=True):
+    '''
+    Call `fun` (a function returning a state return) until it succeeds,
+    returning a `(ret, attempts, reason)` tuple, with the last state return,
+    the number of attempts and the reason why we gave up (or `None`).
+
+    Some telemetry about all the attempts (see `telemetry()`) is left
+    in the `retries` key of the state return, and it is also recorded
+    for the report of this run (see `report()`).
+
+    Arguments (usually provided in a `retry` dictionary in states):
+
+      * `attempts`: maximum number of attempts (default: 1, or unlimited
+                    when a `deadline` is provided).
+      * `interval`: seconds between attempts (the first one, with a backoff).
+      * `backoff`: multiply the interval by this after every attempt
+                   (default: 1, a fixed interval), up to `max_interval`.
+      * `jitter`: sleep a random time between `interval/2` and `interval`.
+      * `deadline`: give up after this number of seconds.
+      * `non_retriable`: list of exit codes we should not retry.
+      * `budget`: take every retry from the budget of retries for the
+                  whole run (see `retry:budget` in the pillar).
+    '''
+    if attempts is None:
+        attempts = 1 if deadline is None else float('inf')
+    start = time.time()
+    expire = start + deadline if deadline is not None else None
+    non_retriable = non_retriable or []
+
+    records = []
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.time()
+        ret = fun()
+        retcode = _get_retcode(ret)
+        records.append({'start': started,
+                        'duration': time.time() - started,
+                        'retcode': retcode,
+                        'result': bool(ret['result']),
+                        'slept': 0})
+        if ret['result']:
+            reason = None
+            break
+
+        if retcode is not None and retcode in non_retriable:
+            reason = 'non-retriable exit code {}'.format(retcode)
+            break
+
+        if attempt >= attempts:
+            reason = 'no more attempts'
+            break
+
+        delay = interval
+        if jitter:
+            delay = interval / 2.0 + random.uniform(0, interval / 2.0)
+        if expire is not None and time.time() + delay > expire:
+            reason = 'deadline of {}s reached'.format(deadline)
+            break
+
+        if budget and not _take_from_budget():
+            reason = 'retry budget exhausted'
+            warn('%s: retry budget exhausted: giving up', name)
+            break
+
+        debug('%s: attempt %d failed: retrying in %.2fs', name, attempt, delay)
+        if delay > 0:
+            time.sleep(delay)
+        records[-1]['slept'] = delay
+        interval = min(interval * backoff, max(max_interval, interval))
+
+    if reason:
+        debug('%s: giving up after %d attempts (%s)', name, attempt, reason)
+
+    ret[TELEMETRY_RET_KEY] = _record(name, start, records, reason)
+    return ret, attempt, reason
+
+
+def _record(name, start, records, reason):
+    summary = {'name': name,
+               'start': start,
+               'elapsed': time.time() - start,
+               'attempts': records,
+               'slept': sum(r['slept'] for r in records),
+               'reason': reason}
+    __context__.setdefault(_TELEMETRY_KEY, []).append(summary)
+    return summary
+
+
+def telemetry():
+    '''
+    Get the telemetry of all the calls done in this run, as a list of:
+
+      * `name`: the name of the state
+      * `start` and `elapsed`: when we started and how long (in seconds)
+                               it took, including all the attempts
+      * `attempts`: a list with the `start`, `duration`, exit code
+                    (`retcode`), `result` and the time spent sleeping
+                    after that (`slept`) for every attempt
+      * `slept`: total time spent sleeping between attempts
+      * `reason`: why we gave up (or `None` if we succeeded)
+    '''
+    return list(__context__.get(_TELEMETRY_KEY, []))
+
+
+def _iter_state_returns(returns):
+    # accept both the output of `state.apply` in a minion and the
+    # output of `salt <tgt> state.apply` (ie, <minion>:<state returns>)
+    for key, value in returns.items():
+        if not isinstance(value, dict):
+            continue
+        if 'result' in value and 'comment' in value:
+            yield key, value
+        else:
+            for state, ret in _iter_state_returns(value):
+                yield '{}: {}'.format(key, state), ret
+
+
+def report(returns=None, top=10):
+    '''
+    Aggregate the retries telemetry into a report with the `slowest`
+    and the `most_retried` states (up to `top` entries each), as
+    well as the total number of `retries` and the time spent sleeping
+    between attempts (`slept`).
+
+    By default, it uses the telemetry recorded in the current run
+    (ie, when used from a state at the end of a highstate), but it
+    can also process the `returns` of a (previous) state run, where
+    the Salt `duration` (in ms) of any state is also considered.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' state.apply --out=json > run.json
+        salt-call caasp_retry.report returns="$(cat run.json)"
+    '''
+    entries = []
+    if returns is None:
+        for summary in telemetry():
+            entries.append({'state': summary['name'],
+                            'duration': summary['elapsed'],
+                            'attempts': len(summary['attempts']),
+                            'slept': summary['slept'],
+                            'reason': summary['reason']})
+    else:
+        for state, ret in _iter_state_returns(returns):
+            summary = ret.get(TELEMETRY_RET_KEY) or {}
+            duration = ret.get('duration')
+            if duration is not None:
+                duration = float(duration) / 1000.0
+            else:
+                duration = summary.get('elapsed', 0)
+            entries.append({'state': state,
+                            'duration': duration,
+                            'attempts': len(summary.get('attempts', [])) or 1,
+                            'slept': summary.get('slept', 0),
+                            'reason': summary.get('reason')})
+
+    top = int(top)
+    slowest = sorted(entries, key=lambda e: e['duration'], reverse=True)[:top]
+    most_retried = sorted([e for e in entries if e['attempts'] > 1],
+                          key=lambda e: (e['attempts'], e['slept']), reverse=True)[:top]
+    return {'states': len(entries),
+            'retries': sum(e['attempts'] - 1 for e in entries),
+            'slept': sum(e['slept'] for e in entries),
+            'slowest': slowest,
+            'most_retried': most_retried}
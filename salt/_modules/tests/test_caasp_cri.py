@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+
+import json
+import unittest
+
+import caasp_cri
+from caasp_cri import (_pb_bytes, _pb_decode, _pb_decode_map, _pb_map,
+                       _pb_uint, get_container_id, stop_containers,
+                       wait_for_container_running, wait_for_containers)
+
+try:
+    from mock import patch, MagicMock
+except ImportError:
+    _mocking_lib_available = False
+else:
+    _mocking_lib_available = True
+
+
+caasp_cri.__salt__ = {
+    'pillar.get': lambda name, default='': default,
+    'grains.get': lambda name, default='': default,
+}
+caasp_cri.__pillar__ = {'cri': {'docker': {'socket': '/var/run/dockershim.sock'}}}
+caasp_cri.__context__ = {}
+
+
+def _container(container_id, name, namespace):
+    labels = {'io.kubernetes.container.name': name,
+              'io.kubernetes.pod.namespace': namespace}
+    return _pb_bytes(1, container_id) + _pb_bytes(3, _pb_bytes(1, name) + _pb_uint(2, 0)) + \
+        _pb_uint(6, 1) + _pb_map(8, labels)
+
+
+class TestProtobuf(unittest.TestCase):
+    '''
+    Some basic tests for the protobuf encoding/decoding
+    '''
+
+    def test_roundtrip(self):
+        msg = _pb_uint(2, 300) + _pb_bytes(1, 'some-id') + _pb_map(4, {'a': 'b', 'c': ''})
+        fields = _pb_decode(msg)
+        self.assertEqual(fields[1], [b'some-id'])
+        self.assertEqual(fields[2], [300])
+        self.assertEqual(_pb_decode_map(fields, 4), {'a': 'b', 'c': ''})
+
+
+class TestGetContainerId(unittest.TestCase):
+    '''
+    Some basic tests for get_container_id()
+    '''
+
+    def setUp(self):
+        caasp_cri.__context__.clear()
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_container_id_grpc(self):
+        containers = [_container('1234', 'haproxy-sidecar', 'kube-system'),
+                      _container('5678', 'haproxy', 'kube-system'),
+                      _container('9012', 'haproxy', 'default')]
+
+        def mocked_call(method, request, **kwargs):
+            self.assertEqual(method, 'ListContainers')
+            container_filter = _pb_decode(_pb_decode(request)[1][0])
+            # only running containers...
+            self.assertEqual(_pb_decode(container_filter[2][0])[1], [1])
+            # ... with the right labels
+            selector = _pb_decode_map(container_filter, 4)
+            self.assertEqual(sorted(selector.keys()),
+                             ['io.kubernetes.container.name', 'io.kubernetes.pod.namespace'])
+            matching = [c for c in containers
+                        if all(item in _pb_decode_map(_pb_decode(c), 8).items()
+                               for item in selector.items())]
+            return _pb_decode(b''.join(_pb_bytes(1, c) for c in matching))
+
+        with patch('caasp_cri._grpc_available', True), \
+                patch('caasp_cri._probe_CRI_socket', MagicMock(return_value=None)), \
+                patch('caasp_cri._call', mocked_call):
+            self.assertEqual(get_container_id('haproxy', 'kube-system'), '5678')
+            self.assertEqual(get_container_id('haproxy', 'default'), '9012')
+            self.assertEqual(get_container_id('ldap', 'kube-system'), None)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_container_id_crictl(self):
+        ps = {'containers': [{'id': '5678',
+                              'metadata': {'name': 'haproxy'},
+                              'labels': {'io.kubernetes.pod.namespace': 'kube-system'}}]}
+        mock = MagicMock(return_value={'retcode': 0, 'stdout': json.dumps(ps), 'stderr': ''})
+        with patch('caasp_cri._grpc_available', False), \
+                patch('caasp_cri._probe_CRI_socket', MagicMock(return_value=None)), \
+                patch.dict(caasp_cri.__salt__, {'cmd.run_all': mock}):
+            self.assertEqual(get_container_id('haproxy', 'kube-system'), '5678')
+            # the CRI runtime does the filtering
+            cmd = mock.call_args[0][0]
+            self.assertIn('--label io.kubernetes.pod.namespace=kube-system', cmd)
+            self.assertIn('--label io.kubernetes.container.name=haproxy', cmd)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_socket_ready_cached(self):
+        probe = MagicMock(side_effect=['connection refused', None])
+        ps = {'containers': []}
+        mock = MagicMock(return_value={'retcode': 0, 'stdout': json.dumps(ps), 'stderr': ''})
+        with patch('caasp_cri._grpc_available', False), \
+                patch('caasp_cri._probe_CRI_socket', probe), \
+                patch.dict(caasp_cri.__salt__, {'cmd.run_all': mock}):
+            for _ in range(3):
+                get_container_id('haproxy', 'kube-system')
+            # checked until ready, and then never again
+            self.assertEqual(probe.call_count, 2)
+            # no 'crictl info'
+            self.assertEqual(mock.call_count, 3)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_container_id_unimplemented(self):
+        class RpcError(Exception):
+            def code(self):
+                return 'UNIMPLEMENTED'
+
+        grpc = MagicMock(RpcError=RpcError)
+        grpc.StatusCode.UNIMPLEMENTED = 'UNIMPLEMENTED'
+        stub = MagicMock(side_effect=RpcError('unknown service runtime.v1alpha2.RuntimeService'))
+        grpc.insecure_channel.return_value.unary_unary.return_value = stub
+
+        ps = {'containers': [{'id': '5678',
+                              'metadata': {'name': 'haproxy'},
+                              'labels': {'io.kubernetes.pod.namespace': 'kube-system'}}]}
+        mock = MagicMock(return_value={'retcode': 0, 'stdout': json.dumps(ps), 'stderr': ''})
+        with patch('caasp_cri._grpc_available', True), \
+                patch('caasp_cri.grpc', grpc, create=True), \
+                patch('caasp_cri._probe_CRI_socket', MagicMock(return_value=None)), \
+                patch.dict(caasp_cri.__salt__, {'cmd.run_all': mock}):
+            # the runtime does not implement our version of the
+            # API: use crictl now and for the rest of the run
+            for _ in range(2):
+                self.assertEqual(get_container_id('haproxy', 'kube-system'), '5678')
+            self.assertEqual(stub.call_count, 1)
+            self.assertEqual(mock.call_count, 2)
+
+
+class TestWaitForContainer(unittest.TestCase):
+    '''
+    Some basic tests for wait_for_container_running()
+    '''
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_wait_backoff(self):
+        sleeps = []
+        ids = [None] * 6 + ['1234']
+        with patch('caasp_cri.get_container_id', MagicMock(side_effect=ids)), \
+                patch('caasp_cri.time.sleep', sleeps.append):
+            res = wait_for_container_running('haproxy', 'kube-system', 60)
+
+        self.assertTrue(res['running'])
+        self.assertEqual(res['id'], '1234')
+        self.assertEqual(res['checks'], 7)
+        self.assertEqual(len(sleeps), 6)
+        # exponential backoff, with some jitter
+        for (i, interval) in enumerate([0.1, 0.2, 0.4, 0.8, 1.6, 2.0]):
+            self.assertTrue(interval / 2 <= sleeps[i] <= interval,
+                            'unexpected sleep {}: {}'.format(i, sleeps))
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_wait_timeout(self):
+        with patch('caasp_cri.get_container_id', MagicMock(return_value=None)):
+            res = wait_for_container_running('haproxy', 'kube-system', 0.5)
+
+        self.assertFalse(res['running'])
+        self.assertGreaterEqual(res['time'], 0.5)
+        self.assertLess(res['checks'], 6)
+
+
+class TestBulkOperations(unittest.TestCase):
+    '''
+    Some basic tests for stop_containers() and wait_for_containers()
+    '''
+
+    def setUp(self):
+        self.running = [
+            {'id': '1', 'name': 'haproxy', 'labels': {'io.kubernetes.pod.namespace': 'kube-system'}},
+            {'id': '2', 'name': 'openldap', 'labels': {'io.kubernetes.pod.namespace': 'kube-system'}},
+            {'id': '3', 'name': 'dex', 'labels': {'io.kubernetes.pod.namespace': 'kube-system'}},
+        ]
+        self.selectors = [{'name': 'haproxy', 'namespace': 'kube-system'},
+                          ('openldap', 'kube-system'),
+                          {'name': 'velum', 'namespace': 'default'}]
+
+        def mocked_list(labels):
+            return [dict(c) for c in self.running]
+
+        self.list_mock = MagicMock(side_effect=mocked_list)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_stop_containers(self):
+        stop_mock = MagicMock(side_effect=lambda container_id: 'boom' if container_id == '2' else None)
+        with patch('caasp_cri._grpc_available', True), \
+                patch('caasp_cri._probe_CRI_socket', MagicMock(return_value=None)), \
+                patch('caasp_cri._list_running_containers', self.list_mock), \
+                patch('caasp_cri._stop_container_id', stop_mock):
+            res = stop_containers(self.selectors)
+
+            # just one listing for all the containers
+            self.assertEqual(self.list_mock.call_count, 1)
+            self.assertEqual(sorted(c[0][0] for c in stop_mock.call_args_list), ['1', '2'])
+
+            self.assertTrue(res['kube-system.haproxy']['stopped'])
+            self.assertFalse(res['kube-system.openldap']['stopped'])
+            self.assertEqual(res['kube-system.openldap']['error'], 'boom')
+            self.assertFalse(res['default.velum']['stopped'])
+            self.assertIsNone(res['default.velum']['id'])
+
+            with self.assertRaises(Exception):
+                stop_containers(self.selectors, ignore_errors=False)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_wait_for_containers(self):
+        def restarted(seconds):
+            # the velum container appears after the first check
+            self.running.append({'id': '4', 'name': 'velum',
+                                 'labels': {'io.kubernetes.pod.namespace': 'default'}})
+
+        with patch('caasp_cri._grpc_available', True), \
+                patch('caasp_cri._probe_CRI_socket', MagicMock(return_value=None)), \
+                patch('caasp_cri._list_running_containers', self.list_mock), \
+                patch('caasp_cri.time.sleep', MagicMock(side_effect=restarted)):
+            res = wait_for_containers(self.selectors, 60)
+
+            self.assertEqual(self.list_mock.call_count, 2)
+            self.assertTrue(all(r['running'] for r in res.values()))
+            self.assertEqual(res['default.velum']['id'], '4')
+
+
+if __name__ == '__main__':
+    unittest.main()
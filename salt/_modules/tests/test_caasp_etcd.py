@@ -1,9 +1,19 @@
 from __future__ import absolute_import
 
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import caasp_etcd
-from caasp_etcd import ETCD_CLIENT_PORT, get_endpoints
+from caasp_etcd import (ETCD_CLIENT_PORT, EtcdApiException,
+                        _place_by_latency, _quorum_rtt, compact, defragment,
+                        get_additional_etcd_members, get_endpoints,
+                        get_member_id, health_report, member_list,
+                        member_remove, members, snapshot)
 
 try:
     from mock import patch, MagicMock
@@ -13,7 +23,10 @@ else:
     _mocking_lib_available = True
 
 
-caasp_etcd.__salt__ = {}
+caasp_etcd.__salt__ = {
+    'pillar.get': lambda name, default='': default
+}
+caasp_etcd.__context__ = {}
 
 
 class TestGetEndpoints(unittest.TestCase):
@@ -52,3 +65,401 @@ class TestGetEndpoints(unittest.TestCase):
             mock.assert_called_once_with('G@roles:etcd and not G@node_removal_in_progress:true')
 
             mock.reset_mock()
+
+
+class TestEtcdApi(unittest.TestCase):
+    '''
+    Some basic tests for the etcd API client
+    '''
+
+    def setUp(self):
+        caasp_etcd.__context__.clear()
+
+        self.nodes = {
+            'AAA': 'node1',
+            'BBB': 'node2',
+        }
+        self.members = {
+            'members': [
+                {'ID': '1234', 'name': 'AAA',
+                 'peerURLs': ['https://node1:2380'],
+                 'clientURLs': ['https://node1:2379']},
+                {'ID': '65535', 'name': 'BBB',
+                 'peerURLs': ['https://node2:2380'],
+                 'clientURLs': ['https://node2:2379']},
+            ]
+        }
+
+        self.salt_mocks = {
+            'caasp_grains.get': MagicMock(return_value=self.nodes),
+            'pillar.get': MagicMock(return_value='etcd3'),
+            'caasp_net.get_nodename': MagicMock(return_value='node1'),
+        }
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_member_list(self):
+        request_mock = MagicMock(return_value=self.members)
+        with patch.dict(caasp_etcd.__salt__, self.salt_mocks), \
+                patch('caasp_etcd._request', request_mock):
+            members = member_list()
+            self.assertEqual(members[0]['id'], '4d2')
+            self.assertEqual(members[1]['id'], 'ffff')
+            self.assertEqual(members[1]['client_urls'], ['https://node2:2379'])
+
+            self.assertEqual(get_member_id(), '4d2')
+            self.assertEqual(get_member_id('node2'), 'ffff')
+            self.assertEqual(get_member_id('node3'), '')
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_members_table(self):
+        request_mock = MagicMock(return_value=self.members)
+        with patch.dict(caasp_etcd.__salt__, self.salt_mocks), \
+                patch('caasp_etcd._request', request_mock):
+            table = members()
+            self.assertEqual(table['by_id']['4d2']['name'], 'AAA')
+            self.assertEqual(table['by_name']['BBB']['id'], 'ffff')
+            self.assertEqual(table['by_peer_url']['https://node2:2380']['id'], 'ffff')
+            self.assertEqual(table['by_client_url']['https://node1:2379']['id'], '4d2')
+
+            # the table is cached...
+            self.assertEqual(get_member_id(), '4d2')
+            self.assertEqual(get_member_id('node2'), 'ffff')
+            self.assertEqual(request_mock.call_count, 1)
+
+            # ... until some member is removed
+            member_remove('ffff')
+            members()
+            self.assertEqual(request_mock.call_count, 3)
+
+            args, kwargs = request_mock.call_args_list[1]
+            self.assertEqual(kwargs['body'], {'ID': '65535'})
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_members_table_etcd2(self):
+        members_v2 = {
+            'members': [
+                {'id': '4d2', 'name': 'AAA',
+                 'peerURLs': ['https://node1:2380'],
+                 'clientURLs': ['https://node1:2379']},
+            ]
+        }
+        request_mock = MagicMock(return_value=members_v2)
+        self.salt_mocks['pillar.get'] = MagicMock(return_value='etcd2')
+        with patch.dict(caasp_etcd.__salt__, self.salt_mocks), \
+                patch('caasp_etcd._request', request_mock):
+            self.assertEqual(get_member_id(), '4d2')
+            args, kwargs = request_mock.call_args
+            self.assertEqual(args[1], '/v2/members')
+            self.assertEqual(kwargs['method'], 'GET')
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_api_failover(self):
+        calls = []
+
+        def mocked_request(endpoint, path, **kwargs):
+            calls.append(endpoint)
+            if endpoint == 'https://node1:{}'.format(ETCD_CLIENT_PORT):
+                raise EtcdApiException('connection refused')
+            return self.members
+
+        with patch.dict(caasp_etcd.__salt__, self.salt_mocks), \
+                patch('caasp_etcd._request', mocked_request):
+            self.assertEqual(len(member_list()), 2)
+            self.assertEqual(len(calls), 2)
+
+        with patch.dict(caasp_etcd.__salt__, self.salt_mocks), \
+                patch('caasp_etcd._request', MagicMock(side_effect=EtcdApiException('error'))):
+            with self.assertRaises(EtcdApiException):
+                member_list()
+
+
+class TestHealthReport(unittest.TestCase):
+    '''
+    Some basic tests for health_report()
+    '''
+
+    def setUp(self):
+        self.nodes = {'AAA': 'node1', 'BBB': 'node2', 'CCC': 'node3'}
+        self.endpoint = 'https://{}:{}'
+
+        def mocked_request(endpoint, path, **kwargs):
+            node = endpoint.split(':')[1][2:]
+            if node == 'node3':
+                time.sleep(1)
+            elif node == 'node2' and self.node2_broken:
+                raise EtcdApiException('connection refused')
+            return {'header': {'member_id': str(len(node) * 100 + int(node[-1]))},
+                    'leader': '501',
+                    'raftIndex': '1000'}
+
+        self.mocked_request = mocked_request
+        self.node2_broken = False
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_health_report_quorum(self):
+        with patch.dict(caasp_etcd.__salt__, {'caasp_grains.get': MagicMock(return_value=self.nodes)}), \
+                patch('caasp_etcd._request', self.mocked_request):
+            start = time.time()
+            report = health_report(timeout=5)
+            self.assertLess(time.time() - start, 0.9, 'did not return as soon as we had a quorum')
+
+            self.assertTrue(report['healthy'])
+            self.assertEqual(report['quorum'], 2)
+
+            members = report['members']
+            node1 = members[self.endpoint.format('node1', ETCD_CLIENT_PORT)]
+            self.assertTrue(node1['healthy'])
+            self.assertTrue(node1['leader'])
+            self.assertEqual(node1['raft_index'], 1000)
+            self.assertIsNotNone(node1['rtt'])
+            self.assertFalse(members[self.endpoint.format('node2', ETCD_CLIENT_PORT)]['leader'])
+            self.assertTrue(members[self.endpoint.format('node3', ETCD_CLIENT_PORT)]['pending'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_health_report_deadline(self):
+        self.node2_broken = True
+        with patch.dict(caasp_etcd.__salt__, {'caasp_grains.get': MagicMock(return_value=self.nodes)}), \
+                patch('caasp_etcd._request', self.mocked_request):
+            report = health_report(timeout=0.3)
+            self.assertFalse(report['healthy'])
+
+            members = report['members']
+            self.assertIn('connection refused',
+                          members[self.endpoint.format('node2', ETCD_CLIENT_PORT)]['error'])
+            self.assertTrue(members[self.endpoint.format('node3', ETCD_CLIENT_PORT)]['pending'])
+
+            report = health_report(timeout=5, wait_all=True)
+            self.assertTrue(report['healthy'])
+            self.assertTrue(members[self.endpoint.format('node3', ETCD_CLIENT_PORT)]['pending'])
+            self.assertTrue(report['members'][self.endpoint.format('node3', ETCD_CLIENT_PORT)]['healthy'])
+
+
+class TestPlacement(unittest.TestCase):
+    '''
+    Some basic tests for the latency-aware placement of etcd members
+    '''
+
+    def setUp(self):
+        # two racks: A* and B*, with a slow link between them
+        nodes = ['A1', 'A2', 'A3', 'B1', 'B2']
+        self.rtts = {}
+        for a in nodes:
+            self.rtts[a] = {}
+            for b in nodes:
+                if a != b:
+                    self.rtts[a][b] = 0.2 if a[0] == b[0] else 5.0
+
+    def test_quorum_rtt(self):
+        self.assertEqual(_quorum_rtt(['A1'], self.rtts), 0)
+        self.assertEqual(_quorum_rtt(['A1', 'A2', 'A3'], self.rtts), 0.2)
+        # B1 needs a slow link for reaching a quorum
+        self.assertEqual(_quorum_rtt(['A1', 'A2', 'B1'], self.rtts), 5.0)
+        # no measurements for some node
+        self.assertEqual(_quorum_rtt(['A1', 'X1', 'X2'], self.rtts), float('inf'))
+
+    def test_place_by_latency(self):
+        # candidates are in priority order
+        res = _place_by_latency(2, ['A1'], ['B1', 'A2', 'B2', 'A3'], self.rtts)
+        self.assertEqual(res, ['A2', 'A3'])
+
+        # no RTTs: just use the priority order
+        res = _place_by_latency(2, ['A1'], ['B1', 'A2', 'B2', 'A3'], {})
+        self.assertEqual(res, ['B1', 'A2'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_additional_etcd_members(self):
+        pillar = {'etcd:placement:latency_aware': True,
+                  'etcd:placement:spare_candidates': 2}
+        prio_mock = MagicMock(return_value=['B1', 'A2', 'B2', 'A3'])
+        salt_mocks = {
+            'caasp_pillar.get': lambda name, default='': pillar.get(name, default),
+            'caasp_nodes.get_from_args_or_with_expr': lambda name, kwargs, *args: kwargs[name],
+            'caasp_nodes.get_with_prio_for_role': prio_mock,
+            'caasp_grains.get': MagicMock(return_value=self.rtts),
+        }
+        with patch.dict(caasp_etcd.__salt__, salt_mocks):
+            res = get_additional_etcd_members(num_wanted=3, etcd_members=['A1'])
+            self.assertEqual(res, ['A2', 'A3'])
+            self.assertEqual(prio_mock.call_args[0][0], 4)
+
+            pillar['etcd:placement:latency_aware'] = False
+            prio_mock.return_value = ['B1', 'A2']
+            res = get_additional_etcd_members(num_wanted=3, etcd_members=['A1'])
+            self.assertEqual(res, ['B1', 'A2'])
+            self.assertEqual(prio_mock.call_args[0][0], 2)
+
+
+class TestMaintenance(unittest.TestCase):
+    '''
+    Some basic tests for the compaction and defragmentation of etcd
+    '''
+
+    def setUp(self):
+        self.nodes = {'AAA': 'node1', 'BBB': 'node2', 'CCC': 'node3'}
+        self.db_sizes = {'node1': 3000, 'node2': 2000, 'node3': 1000}
+        self.broken = set()
+        # nodes that will be broken after their defragmentation
+        self.broken_after_defrag = set()
+        self.defragmented = []
+        self.compacted = []
+
+        def mocked_request(endpoint, path, body=None, **kwargs):
+            node = endpoint.split(':')[1][2:]
+            if node in self.broken:
+                raise EtcdApiException('connection refused')
+            if path.endswith('/maintenance/defragment'):
+                self.defragmented.append(node)
+                self.db_sizes[node] //= 2
+                if node in self.broken_after_defrag:
+                    self.broken.add(node)
+                return {}
+            if path.endswith('/kv/compaction'):
+                if body['revision'] in self.compacted:
+                    raise EtcdApiException('required revision has been compacted')
+                self.compacted.append(body['revision'])
+                return {}
+            # node1 is the leader
+            return {'header': {'member_id': str(len(node) * 100 + int(node[-1])),
+                               'revision': '15000'},
+                    'leader': '501',
+                    'raftIndex': '1000',
+                    'dbSize': str(self.db_sizes[node])}
+
+        self.mocked_request = mocked_request
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_compact(self):
+        with patch.dict(caasp_etcd.__salt__, {'caasp_grains.get': MagicMock(return_value=self.nodes)}), \
+                patch('caasp_etcd._request', self.mocked_request):
+            self.assertEqual(compact(keep_revisions=20000)['compacted'], None)
+            self.assertEqual(compact(keep_revisions=10000)['compacted'], 5000)
+            self.assertEqual(compact(keep_revisions=10000)['compacted'], None)
+            self.assertEqual(self.compacted, [5000])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_defragment(self):
+        with patch.dict(caasp_etcd.__salt__, {'caasp_grains.get': MagicMock(return_value=self.nodes)}), \
+                patch('caasp_etcd._request', self.mocked_request):
+            res = defragment()
+            self.assertTrue(res['result'])
+            # followers first, the leader last
+            self.assertEqual(self.defragmented, ['node2', 'node3', 'node1'])
+            self.assertEqual(res['reclaimed'], 3000)
+
+            leader = res['members'][-1]
+            self.assertTrue(leader['leader'])
+            self.assertEqual(leader['db_size_before'], 3000)
+            self.assertEqual(leader['db_size_after'], 1500)
+            self.assertEqual(leader['reclaimed'], 1500)
+            self.assertIsNotNone(leader['time'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_defragment_unhealthy(self):
+        self.broken.add('node3')
+        with patch.dict(caasp_etcd.__salt__, {'caasp_grains.get': MagicMock(return_value=self.nodes)}), \
+                patch('caasp_etcd._request', self.mocked_request):
+            res = defragment(timeout=1)
+            self.assertFalse(res['result'])
+            # node2 cannot be blocked (we would lose the quorum),
+            # and the leader cannot be touched with node3 down
+            self.assertEqual(self.defragmented, [])
+            skipped = sorted(m['endpoint'] for m in res['members'] if 'skipped' in m)
+            self.assertEqual(len(skipped), 3)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_defragment_unhealthy_after_defrag(self):
+        self.broken_after_defrag.add('node2')
+        with patch.dict(caasp_etcd.__salt__, {'caasp_grains.get': MagicMock(return_value=self.nodes)}), \
+                patch('caasp_etcd._request', self.mocked_request):
+            res = defragment(timeout=1)
+            self.assertFalse(res['result'])
+            # node2 does not recover: node3 would leave the
+            # cluster with no quorum, so we stop there
+            self.assertEqual(self.defragmented, ['node2'])
+            self.assertFalse(res['members'][0]['healthy'])
+            skipped = sorted(m['endpoint'] for m in res['members'] if 'skipped' in m)
+            self.assertEqual(skipped, ['https://node1:2379', 'https://node3:2379'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_etcd2(self):
+        salt_mocks = {'caasp_grains.get': MagicMock(return_value=self.nodes),
+                      'pillar.get': MagicMock(return_value='etcd2')}
+        with patch.dict(caasp_etcd.__salt__, salt_mocks), \
+                patch('caasp_etcd._request', self.mocked_request):
+            for fun in (compact, defragment, health_report):
+                with self.assertRaises(EtcdApiException):
+                    fun()
+            self.assertEqual(self.compacted + self.defragmented, [])
+
+
+class TestSnapshot(unittest.TestCase):
+    '''
+    Some basic tests for snapshot()
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.report = {'healthy': True, 'quorum': 2, 'members': {
+            'https://node1:2379': {'endpoint': 'https://node1:2379', 'healthy': True,
+                                   'leader': True, 'raft_index': 10, 'rtt': 0.1},
+            'https://node2:2379': {'endpoint': 'https://node2:2379', 'healthy': True,
+                                   'leader': False, 'raft_index': 10, 'rtt': 0.2},
+            'https://node3:2379': {'endpoint': 'https://node3:2379', 'healthy': True,
+                                   'leader': False, 'raft_index': 9, 'rtt': 0.1},
+        }}
+
+        data = b'some etcd database' * 1000
+        self.snapshot = data + hashlib.sha256(data).digest()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stream(self, contents):
+        def mocked_stream_request(endpoint, path, **kwargs):
+            self.endpoint = endpoint
+            for i in range(0, len(contents), 1000):
+                blob = base64.b64encode(contents[i:i + 1000]).decode('ascii')
+                yield {'result': {'blob': blob}}
+        return mocked_stream_request
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_snapshot(self):
+        for old in ['etcd-snapshot-20180101000000.db', 'etcd-snapshot-20180102000000.db']:
+            open(os.path.join(self.directory, old), 'w').close()
+
+        with patch('caasp_etcd.health_report', MagicMock(return_value=self.report)), \
+                patch('caasp_etcd._stream_request', self.stream(self.snapshot)):
+            res = snapshot(directory=self.directory, keep=2)
+
+            # the most up-to-date follower
+            self.assertEqual(self.endpoint, 'https://node2:2379')
+            self.assertEqual(res['size'], len(self.snapshot))
+            with open(res['path'], 'rb') as f:
+                self.assertEqual(f.read(), self.snapshot)
+
+            self.assertEqual([os.path.basename(x) for x in res['removed']],
+                             ['etcd-snapshot-20180101000000.db'])
+            self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_snapshot_corrupted(self):
+        corrupted = b'X' + self.snapshot[1:]
+        with patch('caasp_etcd.health_report', MagicMock(return_value=self.report)), \
+                patch('caasp_etcd._stream_request', self.stream(corrupted)):
+            with self.assertRaises(EtcdApiException):
+                snapshot(directory=self.directory)
+            self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+
+import unittest
+
+import caasp_grains
+from caasp_grains import (UnsupportedExpression, cache_stats, clear_cache,
+                          get, is_supported, match)
+
+try:
+    from mock import patch, MagicMock
+except ImportError:
+    _mocking_lib_available = False
+else:
+    _mocking_lib_available = True
+
+
+caasp_grains.__salt__ = {
+    'caasp_pillar.get': lambda name, default='': default
+}
+caasp_grains.__opts__ = {'__role': 'minion'}
+caasp_grains.__context__ = {}
+
+
+class TestGetCached(unittest.TestCase):
+    '''
+    Some basic tests for the mine cache in caasp_grains.get()
+    '''
+
+    def setUp(self):
+        caasp_grains.__context__.clear()
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_cached(self):
+        nodes = {'AAA': 'node1', 'BBB': 'node2'}
+
+        mock = MagicMock(return_value=nodes)
+        with patch.dict(caasp_grains.__salt__, {'mine.get': mock}):
+            res = get('G@roles:etcd')
+            self.assertEqual(res, nodes)
+
+            # same query (modulo some whitespace): no new mine.get
+            res = get('G@roles:etcd ')
+            res = get(' G@roles:etcd')
+            self.assertEqual(res, nodes)
+            mock.assert_called_once_with('G@roles:etcd', 'nodename',
+                                         expr_form='compound')
+
+            stats = cache_stats()
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['misses'], 1)
+
+            # a different grain is a different query
+            get('G@roles:etcd', grain='network.interfaces')
+            self.assertEqual(mock.call_count, 2)
+
+            # callers cannot modify the cached data
+            res = get('G@roles:etcd')
+            res.pop('AAA')
+            self.assertEqual(get('G@roles:etcd'), nodes)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_invalidation(self):
+        mock = MagicMock(return_value={'AAA': 'node1'})
+        update_mock = MagicMock(return_value=True)
+        with patch.dict(caasp_grains.__salt__, {'mine.get': mock,
+                                                'mine.update': update_mock}):
+            get('G@roles:etcd')
+            clear_cache()
+            get('G@roles:etcd')
+            self.assertEqual(mock.call_count, 2)
+
+            caasp_grains.update_mine()
+            get('G@roles:etcd')
+            self.assertEqual(mock.call_count, 3)
+            update_mock.assert_called_once_with(clear=False, mine_functions=None)
+
+            get('G@roles:etcd', cached=False)
+            self.assertEqual(mock.call_count, 4)
+            self.assertEqual(cache_stats()['misses'], 3)
+
+
+class TestMatch(unittest.TestCase):
+    '''
+    Some basic tests for the compound expressions evaluator
+    '''
+
+    def setUp(self):
+        self.master = {'roles': ['kube-master', 'etcd'],
+                       'bootstrap_complete': True,
+                       'update_in_progress': ''}
+        self.minion = {'roles': ['kube-minion'],
+                       'bootstrap_complete': '',
+                       'update_in_progress': True}
+
+    def test_match_grains(self):
+        self.assertTrue(match('G@roles:etcd', self.master, 'master_1'))
+        self.assertFalse(match('G@roles:etcd', self.minion, 'minion_1'))
+        self.assertTrue(match('G@bootstrap_complete:true', self.master, 'master_1'))
+        self.assertFalse(match('G@bootstrap_complete:true', self.minion, 'minion_1'))
+        self.assertFalse(match('G@unknown:true', self.minion, 'minion_1'))
+        self.assertTrue(match('G@roles:kube-*', self.minion, 'minion_1'))
+
+        expr = 'P@roles:(kube-master|kube-minion)'
+        self.assertTrue(match(expr, self.master, 'master_1'))
+        self.assertTrue(match(expr, self.minion, 'minion_1'))
+        self.assertFalse(match('P@roles:(admin|ca)', self.minion, 'minion_1'))
+
+    def test_match_ids(self):
+        self.assertTrue(match('L@master_1,master_2', self.master, 'master_1'))
+        self.assertFalse(match('L@master_2,master_3', self.master, 'master_1'))
+        self.assertTrue(match('E@master_[0-9]', self.master, 'master_1'))
+        self.assertTrue(match('master_*', self.master, 'master_1'))
+        self.assertFalse(match('minion_*', self.master, 'master_1'))
+
+    def test_match_operators(self):
+        expr = 'G@roles:etcd and not P@roles:(kube-master|kube-minion) and not G@bootstrap_complete:true'
+        self.assertFalse(match(expr, self.master, 'master_1'))
+
+        expr = 'G@roles:kube-master and not G@update_in_progress:true and not L@master_2'
+        self.assertTrue(match(expr, self.master, 'master_1'))
+
+        expr = 'G@roles:etcd or G@roles:kube-minion and not G@update_in_progress:true'
+        self.assertTrue(match(expr, self.master, 'master_1'))
+        self.assertFalse(match(expr, self.minion, 'minion_1'))
+
+        expr = '( G@roles:etcd or G@roles:kube-minion ) and not G@update_in_progress:true'
+        self.assertFalse(match(expr, self.minion, 'minion_1'))
+        self.assertTrue(match('not not G@roles:etcd', self.master, 'master_1'))
+
+    def test_match_unsupported(self):
+        for expr in ['I@some:pillar', 'G@roles:etcd and', '( G@roles:etcd', 'and G@roles:etcd']:
+            with self.assertRaises(UnsupportedExpression):
+                match(expr, self.master, 'master_1')
+            self.assertFalse(is_supported(expr))
+        self.assertTrue(is_supported('G@roles:etcd or ( E@master_.* and not L@master_1 )'))
+
+
+class TestGetLocal(unittest.TestCase):
+    '''
+    Some basic tests for caasp_grains.get() with local evaluation
+    '''
+
+    def setUp(self):
+        caasp_grains.__context__.clear()
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_local(self):
+        mine = {
+            'targeting_grains': {
+                'AAA': {'roles': ['etcd', 'kube-master'], 'bootstrap_complete': True},
+                'BBB': {'roles': ['kube-minion'], 'bootstrap_complete': True},
+                'CCC': {'roles': ['kube-minion'], 'bootstrap_complete': ''},
+                'DDD': {'roles': ['admin'], 'bootstrap_complete': ''},
+            },
+            'nodename': {'AAA': 'node1', 'BBB': 'node2', 'CCC': 'node3'},
+        }
+
+        def mocked_mine_get(expr, grain, expr_form):
+            self.assertEqual((expr, expr_form), ('*', 'glob'))
+            return mine[grain]
+
+        mock = MagicMock(side_effect=mocked_mine_get)
+        with patch.dict(caasp_grains.__salt__, {'mine.get': mock}):
+            res = get('G@roles:kube-minion', local=True)
+            self.assertEqual(res, {'BBB': 'node2', 'CCC': 'node3'})
+
+            res = get('G@roles:kube-minion and G@bootstrap_complete:true', local=True)
+            self.assertEqual(res, {'BBB': 'node2'})
+
+            # DDD has no 'nodename' in the mine
+            res = get('not L@AAA,BBB', local=True)
+            self.assertEqual(res, {'CCC': 'node3'})
+
+            # just two queries: all the targeting grains and all the nodenames
+            self.assertEqual(mock.call_count, 2)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_local_fallback(self):
+        mock = MagicMock(return_value={})
+        with patch.dict(caasp_grains.__salt__, {'mine.get': mock}):
+            # nothing in the mine for the targeting grains: use the mine
+            get('G@roles:kube-minion', local=True)
+            mock.assert_called_with('G@roles:kube-minion', 'nodename',
+                                    expr_form='compound')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+import threading
+import time
+import unittest
+
+import caasp_http
+from caasp_http import pooled_query, query, wait_for_all, wait_for_successful_query
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    from mock import patch, MagicMock
+except ImportError:
+    _mocking_lib_available = False
+else:
+    _mocking_lib_available = True
+
+
+caasp_http.__opts__ = {'http_request_timeout': 3600}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path == '/slow':
+            time.sleep(0.5)
+        if self.path == '/missing':
+            status, body = 404, b'not found'
+        elif self.path.startswith('/echo'):
+            status, body = 200, '{} {}'.format(self.path, self.headers.get('Authorization')).encode('utf-8')
+        elif self.server.requests <= self.server.failures:
+            status, body = 503, b'not yet'
+        else:
+            status, body = 200, b'{"status": "ok"}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledQuery(unittest.TestCase):
+    '''
+    Some basic tests for pooled_query() and wait_for_successful_query()
+    '''
+
+    def setUp(self):
+        caasp_http._pool.clear()
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.failures = 0
+        self.url = 'http://127.0.0.1:{}/healthz'.format(self.server.server_port)
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        for connections in caasp_http._pool.values():
+            for connection in connections:
+                connection.close()
+        caasp_http._pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pooled_query(self):
+        for _ in range(3):
+            res = pooled_query(self.url, timeout=5)
+            self.assertEqual(res['status'], 200)
+            self.assertEqual(res['text'], '{"status": "ok"}')
+            self.assertNotIn('error', res)
+            self.assertIsNotNone(res['time'])
+
+        # all the requests in the same connection
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_pooled_query_error(self):
+        self.server.failures = 1
+        res = pooled_query(self.url, timeout=5)
+        self.assertEqual(res['status'], 503)
+        self.assertIn('error', res)
+
+        # nobody listening
+        res = pooled_query('http://127.0.0.1:1/healthz', timeout=5)
+        self.assertIn('error', res)
+        self.assertNotIn('status', res)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_wait_for_successful_query(self):
+        self.server.failures = 3
+        sleeps = []
+        with patch('caasp_http.time.sleep', sleeps.append):
+            res = wait_for_successful_query(self.url, wait_for=60, expected_status=200,
+                                            match='ok', interval=1, max_interval=3)
+
+        self.assertEqual(res['status'], 200)
+        self.assertEqual([a['status'] for a in res['attempts']], [503, 503, 503, 200])
+        # exponential backoff (with jitter)
+        self.assertEqual(len(sleeps), 3)
+        for (i, interval) in enumerate([1, 2, 3]):
+            self.assertTrue(interval / 2.0 <= sleeps[i] <= interval,
+                            'unexpected sleep {}: {}'.format(i, sleeps))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_pooled_query_args(self):
+        res = pooled_query(self.url.replace('/healthz', '/echo?a=1'), timeout=5,
+                           params={'b': '2'}, username='admin', password='secret')
+        self.assertEqual(res['text'], '/echo?a=1&b=2 Basic YWRtaW46c2VjcmV0')
+
+        res = pooled_query(self.url.replace('/healthz', '/echo'), timeout=5,
+                           auth=('admin', 'secret'))
+        self.assertEqual(res['text'], '/echo Basic YWRtaW46c2VjcmV0')
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_wait_for_successful_query_fallback(self):
+        mock = MagicMock(side_effect=[{'Error': 'HTTP 503'}, {'status': 200, 'text': 'ok'}])
+        with patch('salt.utils.http.query', mock), \
+                patch('caasp_http.time.sleep'):
+            res = wait_for_successful_query(self.url, wait_for=60, expected_status=200,
+                                            cookies=True, status=True, opts={'http_request_timeout': 30})
+
+        # `cookies` are not supported in pooled queries
+        self.assertEqual(self.server.requests, 0)
+        self.assertEqual(res['status'], 200)
+        self.assertEqual([a['error'] for a in res['attempts']], ['HTTP 503', None])
+        self.assertTrue(mock.call_args[1]['cookies'])
+        self.assertEqual(mock.call_args[1]['opts']['http_request_timeout'], 30)
+
+    def test_wait_for_all(self):
+        base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        start = time.time()
+        res = wait_for_all([base + '/slow',
+                            {'url': base + '/slow2', 'match': 'ok'},
+                            {'url': base + '/missing', 'interval': 0.1}],
+                           wait_for=1, expected_status=200)
+
+        # in parallel: we do not wait for the sum of the waits
+        self.assertLess(time.time() - start, 2.5)
+        self.assertTrue(res[base + '/slow']['ok'])
+        self.assertTrue(res[base + '/slow2']['ok'])
+        self.assertGreaterEqual(res[base + '/slow']['latency'], 0.5)
+        self.assertEqual(res[base + '/slow']['attempts'], 1)
+
+        self.assertFalse(res[base + '/missing']['ok'])
+        self.assertEqual(res[base + '/missing']['status'], 404)
+        self.assertGreater(res[base + '/missing']['attempts'], 1)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_query_opts(self):
+        mock = MagicMock(return_value={})
+        with patch('salt.utils.http.query', mock):
+            query(self.url, opts={'http_request_timeout': 30})
+
+        self.assertEqual(mock.call_args[1]['opts']['http_request_timeout'], 30)
+        # the global configuration has not been modified
+        self.assertEqual(caasp_http.__opts__['http_request_timeout'], 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,427 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import caasp_kubectl
+from caasp_kubectl import (KubeApiException, apply, apply_batch, cordon, deployment_status,
+                           drain, evict, is_cordoned, label_node, taint_node, wait_for_deployment,
+                           wait_for_deployments)
+
+try:
+    from mock import patch, MagicMock
+except ImportError:
+    _mocking_lib_available = False
+else:
+    _mocking_lib_available = True
+
+
+caasp_kubectl.__salt__ = {}
+caasp_kubectl.__context__ = {}
+
+
+def _deployment(replicas=2, ready=2, available=2, updated=2, version='1', generation=1):
+    return {'metadata': {'name': 'dex', 'resourceVersion': version, 'generation': generation},
+            'spec': {'replicas': replicas},
+            'status': {'readyReplicas': ready, 'availableReplicas': available,
+                       'updatedReplicas': updated, 'observedGeneration': 1}}
+
+
+class TestWaitForDeployment(unittest.TestCase):
+    '''
+    Some basic tests for waiting for deployments
+    '''
+
+    def test_deployment_status(self):
+        self.assertTrue(deployment_status(_deployment())['complete'])
+        self.assertFalse(deployment_status(_deployment(ready=1))['complete'])
+        self.assertFalse(deployment_status(_deployment(updated=1))['complete'])
+        # the controller has not seen the last change yet
+        self.assertFalse(deployment_status(_deployment(generation=2))['complete'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_ready(self):
+        request = MagicMock(return_value=_deployment())
+        watch = MagicMock()
+        with patch('caasp_kubectl._request', request), patch('caasp_kubectl._watch', watch):
+            res = wait_for_deployment('dex')
+            self.assertTrue(res['ready'])
+            self.assertEqual(res['events'], 0)
+            self.assertFalse(watch.called)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_watch(self):
+        request = MagicMock(return_value=_deployment(ready=0, available=0))
+        events = [{'type': 'MODIFIED', 'object': _deployment(ready=1, available=1, version='2')},
+                  {'type': 'MODIFIED', 'object': _deployment(version='3')},
+                  {'type': 'MODIFIED', 'object': _deployment(version='4')}]
+        watch = MagicMock(return_value=iter(events))
+        with patch('caasp_kubectl._request', request), patch('caasp_kubectl._watch', watch):
+            res = wait_for_deployment('dex', timeout=60)
+            self.assertTrue(res['ready'])
+            # we stop as soon as the rollout is complete
+            self.assertEqual(res['events'], 2)
+            self.assertEqual(request.call_count, 1)
+            self.assertEqual(watch.call_args[1]['resourceVersion'], '1')
+            self.assertEqual(watch.call_args[1]['fieldSelector'], 'metadata.name=dex')
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_not_found_and_errors(self):
+        request = MagicMock(side_effect=[KubeApiException('not found', status=404),
+                                         _deployment()])
+        # the API server goes away once, and then the deployment is created
+        watch = MagicMock(side_effect=[KubeApiException('connection refused'),
+                                       iter([{'type': 'ADDED', 'object': _deployment(ready=0)}])])
+        with patch('caasp_kubectl._request', request), \
+                patch('caasp_kubectl._watch', watch), \
+                patch('caasp_kubectl.time.sleep', MagicMock()):
+            res = wait_for_deployment('dex', timeout=60)
+            self.assertTrue(res['ready'])
+            self.assertEqual(watch.call_args_list[0][1]['resourceVersion'], None)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_timeout(self):
+        now = [1000.0]
+
+        def watch(path, timeout, **kwargs):
+            now[0] += timeout
+            return iter([])
+
+        request = MagicMock(return_value=_deployment(ready=1))
+        with patch('caasp_kubectl._request', request), \
+                patch('caasp_kubectl._watch', watch), \
+                patch('caasp_kubectl.time.time', lambda: now[0]):
+            res = wait_for_deployment('dex', timeout=30)
+            self.assertFalse(res['ready'])
+            self.assertTrue(res['error'].startswith('timeout'))
+            self.assertEqual(res['status']['ready'], 1)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_wait_for_deployments(self):
+        def wait(name, namespace, timeout):
+            return {'ready': name != 'dex', 'time': 1, 'error': 'timeout'}
+
+        with patch('caasp_kubectl.wait_for_deployment', MagicMock(side_effect=wait)), \
+                patch('caasp_kubectl._get_config', MagicMock()):
+            res = wait_for_deployments(['kube-dns', 'other/dex',
+                                        {'name': 'tiller-deploy', 'namespace': 'ns'}])
+            self.assertEqual(sorted(res.keys()),
+                             ['kube-system/kube-dns', 'ns/tiller-deploy', 'other/dex'])
+            self.assertFalse(res['other/dex']['ready'])
+            self.assertTrue(res['ns/tiller-deploy']['ready'])
+
+            self.assertEqual(wait_for_deployments([]), {})
+
+
+class _FakeApi(object):
+    '''
+    A fake API server (for `caasp_kubectl._request`), with some objects by path
+    '''
+
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+        self.calls = []
+
+    def __call__(self, method, path, body=None, content_type=None, timeout=None):
+        self.calls.append((method, path))
+        if path == '/api/v1':
+            return {'resources': [{'name': 'nodes', 'kind': 'Node', 'namespaced': False},
+                                  {'name': 'namespaces', 'kind': 'Namespace', 'namespaced': False},
+                                  {'name': 'services', 'kind': 'Service', 'namespaced': True},
+                                  {'name': 'pods/eviction', 'kind': 'Eviction', 'namespaced': True}]}
+        if method == 'GET':
+            if path.rsplit('/', 1)[1] in ('nodes', 'namespaces', 'services'):
+                # a LIST
+                return {'items': [o for (p, o) in sorted(self.objects.items())
+                                  if p.rsplit('/', 1)[0] == path]}
+            if path not in self.objects:
+                raise KubeApiException('not found', status=404)
+            return self.objects[path]
+        if method == 'POST':
+            self.objects[path + '/' + body['metadata']['name']] = body
+        elif method == 'PATCH':
+            self.objects[path] = _merge(self.objects[path], body)
+        return {}
+
+    def changes(self):
+        return [c for c in self.calls if c[0] != 'GET']
+
+
+def _merge(obj, patch):
+    res = dict(obj)
+    for k, v in patch.items():
+        if v is None:
+            res.pop(k, None)
+        elif isinstance(v, dict) and isinstance(res.get(k), dict):
+            res[k] = _merge(res[k], v)
+        else:
+            res[k] = v
+    return res
+
+
+class TestApi(unittest.TestCase):
+    '''
+    Some basic tests for the API operations
+    '''
+
+    def setUp(self):
+        caasp_kubectl.__context__.clear()
+        self.node = {'metadata': {'name': 'node1', 'labels': {'a': 'b'}},
+                     'spec': {'taints': [{'key': 'x', 'effect': 'NoExecute'}]}}
+        self.api = _FakeApi({'/api/v1/nodes/node1': self.node})
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_apply(self):
+        service = {'apiVersion': 'v1', 'kind': 'Service', 'metadata': {'name': 'dex'}}
+        with patch('caasp_kubectl._request', self.api):
+            res = apply([service], namespace='kube-system')
+            self.assertEqual(res, {'Service/dex': 'created'})
+            self.assertIn('/api/v1/namespaces/kube-system/services/dex', self.api.objects)
+            self.assertEqual(self.api.calls.count(('GET', '/api/v1')), 1)
+
+            # nothing has changed: nothing is sent
+            self.api.calls = []
+            self.assertEqual(apply([service], namespace='kube-system'), {'Service/dex': 'unchanged'})
+            self.assertEqual(self.api.changes(), [])
+
+            service['spec'] = {'type': 'ClusterIP'}
+            self.assertEqual(apply([service], namespace='kube-system'), {'Service/dex': 'configured'})
+            self.assertEqual(self.api.changes(),
+                             [('PATCH', '/api/v1/namespaces/kube-system/services/dex')])
+            # the discovery is done just once
+            self.assertNotIn(('GET', '/api/v1'), self.api.calls)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_apply_removed_keys(self):
+        path = '/api/v1/namespaces/kube-system/services/dex'
+        service = {'apiVersion': 'v1', 'kind': 'Service',
+                   'metadata': {'name': 'dex', 'labels': {'app': 'dex', 'old': 'yes'}},
+                   'spec': {'selector': {'app': 'dex'}}}
+        with patch('caasp_kubectl._request', self.api):
+            apply([service], namespace='kube-system')
+            # some keys set by someone else
+            self.api.objects[path]['spec']['clusterIP'] = '10.0.0.1'
+
+            # the label and the selector are removed from the manifest
+            del service['metadata']['labels']['old']
+            del service['spec']['selector']
+            self.assertEqual(apply([service], namespace='kube-system'), {'Service/dex': 'configured'})
+
+            current = self.api.objects[path]
+            self.assertEqual(current['metadata']['labels'], {'app': 'dex'})
+            self.assertNotIn('selector', current['spec'])
+            # ... but we do not touch what we did not apply
+            self.assertEqual(current['spec']['clusterIP'], '10.0.0.1')
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_nodes(self):
+        with patch('caasp_kubectl._request', self.api):
+            self.assertTrue(cordon('node1'))
+            self.assertFalse(cordon('node1'))
+            self.assertTrue(self.api.objects['/api/v1/nodes/node1']['spec']['unschedulable'])
+
+            self.assertEqual(label_node('node1', {'a': 'b', 'c': ''}), {'c': ''})
+            self.assertEqual(label_node('node1', {'a': 'b', 'c': ''}), {})
+
+            self.assertTrue(taint_node('node1', 'node-role.kubernetes.io/master'))
+            self.assertFalse(taint_node('node1', 'node-role.kubernetes.io/master'))
+            taints = self.api.objects['/api/v1/nodes/node1']['spec']['taints']
+            self.assertEqual(sorted(t['key'] for t in taints), ['node-role.kubernetes.io/master', 'x'])
+            self.assertTrue(taint_node('node1', 'node-role.kubernetes.io/master', present=False))
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_evict(self):
+        request = MagicMock(side_effect=[{}, KubeApiException('not found', status=404),
+                                         KubeApiException('disruption budget', status=429)])
+        with patch('caasp_kubectl._request', request):
+            self.assertTrue(evict('pod1', 'default'))
+            self.assertFalse(evict('pod1', 'default'))
+            with self.assertRaises(KubeApiException):
+                evict('pod1', 'default')
+            self.assertEqual(request.call_args[0][1], '/api/v1/namespaces/default/pods/pod1/eviction')
+
+    def test_config_errors(self):
+        directory = tempfile.mkdtemp()
+        kubeconfig = os.path.join(directory, 'kubeconfig')
+        caasp_kubectl.__salt__['pillar.get'] = lambda name, default='': kubeconfig
+        try:
+            # no current context
+            with open(kubeconfig, 'w') as f:
+                f.write('clusters: []\n')
+            with self.assertRaises(KubeApiException):
+                is_cordoned('node1')
+            self.assertFalse(is_cordoned('node1', ignore_errors=True))
+
+            # the certificates do not exist
+            with open(kubeconfig, 'w') as f:
+                f.write('''
+current-context: default
+contexts: [{name: default, context: {cluster: local, user: admin}}]
+clusters: [{name: local, cluster: {server: 'https://127.0.0.1:1', certificate-authority: /missing/ca.crt}}]
+users: [{name: admin, user: {client-certificate: /missing/admin.crt, client-key: /missing/admin.key}}]
+''')
+            caasp_kubectl.__context__.clear()
+            with self.assertRaises(KubeApiException):
+                is_cordoned('node1')
+            self.assertFalse(is_cordoned('node1', ignore_errors=True))
+        finally:
+            del caasp_kubectl.__salt__['pillar.get']
+            shutil.rmtree(directory)
+
+
+_MANIFEST = """
+apiVersion: v1
+kind: Service
+metadata:
+  name: dex
+---
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: other
+"""
+
+
+class TestApplyBatch(unittest.TestCase):
+    '''
+    Some basic tests for the batched apply
+    '''
+
+    def setUp(self):
+        caasp_kubectl.__context__.clear()
+        self.tmp = tempfile.mkdtemp()
+        caasp_kubectl.__opts__ = {'cachedir': os.path.join(self.tmp, 'cache')}
+        self.manifest = os.path.join(self.tmp, 'manifest.yaml')
+        with open(self.manifest, 'w') as f:
+            f.write(_MANIFEST)
+        self.kube_system = {'metadata': {'name': 'kube-system', 'uid': 'uid-1'}}
+        self.api = _FakeApi({'/api/v1/namespaces/kube-system': self.kube_system})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_apply_batch(self):
+        with patch('caasp_kubectl._request', self.api):
+            res = apply_batch([{'manifest': self.manifest, 'namespace': 'kube-system'}])
+            self.assertEqual(res['applied'], {'Service/dex': 'created', 'Namespace/other': 'created'})
+            self.assertEqual(res['errors'], {})
+            # namespaces go first
+            self.assertEqual(self.api.changes(), [('POST', '/api/v1/namespaces'),
+                                                  ('POST', '/api/v1/namespaces/kube-system/services')])
+
+            # nothing has changed: just a LIST for every kind
+            caasp_kubectl.__context__.clear()
+            self.api.calls = []
+            res = apply_batch([{'manifest': self.manifest, 'namespace': 'kube-system'}])
+            self.assertEqual(res['skipped'], 2)
+            self.assertEqual(self.api.changes(), [])
+            self.assertEqual(sorted(self.api.calls), [('GET', '/api/v1'),
+                                                      ('GET', '/api/v1/namespaces'),
+                                                      ('GET', '/api/v1/namespaces/kube-system'),
+                                                      ('GET', '/api/v1/namespaces/kube-system/services')])
+
+            # objects deleted (or changed) in the cluster are applied again
+            del self.api.objects['/api/v1/namespaces/kube-system/services/dex']
+            self.api.objects['/api/v1/namespaces/other']['metadata']['annotations'][
+                caasp_kubectl.LAST_APPLIED_ANNOTATION] = '{}'
+            res = apply_batch([{'manifest': self.manifest, 'namespace': 'kube-system'}])
+            self.assertEqual(res['skipped'], 0)
+            self.assertEqual(res['applied'], {'Service/dex': 'created', 'Namespace/other': 'configured'})
+
+            # ... unless forced
+            res = apply_batch([self.manifest], namespace='kube-system', force=True)
+            self.assertEqual(res['applied'], {'Service/dex': 'unchanged', 'Namespace/other': 'unchanged'})
+
+            # a new cluster: the cache is not used
+            self.kube_system['metadata']['uid'] = 'uid-2'
+            res = apply_batch([self.manifest], namespace='kube-system')
+            self.assertEqual(res['skipped'], 0)
+
+
+def _pod(name, owner=None, annotations=None, phase='Running'):
+    return {'metadata': {'name': name, 'namespace': 'default', 'uid': name + '-uid',
+                         'ownerReferences': [{'kind': owner}] if owner else [],
+                         'annotations': annotations or {}},
+            'status': {'phase': phase}}
+
+
+class TestDrain(unittest.TestCase):
+    '''
+    Some basic tests for draining nodes
+    '''
+
+    def setUp(self):
+        caasp_kubectl.__context__.clear()
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_drain(self):
+        pods = {'items': [_pod('web'), _pod('db'), _pod('ds', owner='DaemonSet'),
+                          _pod('static', annotations={'kubernetes.io/config.mirror': 'x'}),
+                          _pod('job', phase='Succeeded')]}
+        # "db" is protected by a disruption budget for a while
+        refused = {'db': 2}
+
+        def request(method, path, body=None, **kwargs):
+            if path.startswith('/api/v1/pods?'):
+                self.assertIn('fieldSelector=spec.nodeName%3Dnode1', path)
+                return pods
+            if path.endswith('/eviction'):
+                name = body['metadata']['name']
+                if refused.get(name):
+                    refused[name] -= 1
+                    raise KubeApiException('disruption budget', status=429)
+                return {}
+            # evicted pods are gone
+            raise KubeApiException('not found', status=404)
+
+        with patch('caasp_kubectl._request', MagicMock(side_effect=request)), \
+                patch('caasp_kubectl.cordon', MagicMock(return_value=True)) as cordon_mock, \
+                patch('caasp_kubectl.time.sleep', MagicMock()):
+            res = drain('node1', concurrency=2)
+            cordon_mock.assert_called_once_with('node1')
+            self.assertTrue(res['drained'])
+            self.assertEqual(sorted(res['pods']), ['default/db', 'default/web'])
+            self.assertEqual(sorted(res['skipped']), ['default/ds', 'default/job', 'default/static'])
+            self.assertEqual(res['pods']['default/db']['attempts'], 3)
+            self.assertEqual(res['pods']['default/web']['attempts'], 1)
+            self.assertIn('gone', res['pods']['default/db'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_drain_blocked(self):
+        now = [1000.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        def request(method, path, body=None, **kwargs):
+            if path.startswith('/api/v1/pods?'):
+                return {'items': [_pod('db')]}
+            raise KubeApiException('disruption budget', status=429)
+
+        with patch('caasp_kubectl._request', MagicMock(side_effect=request)), \
+                patch('caasp_kubectl.cordon', MagicMock(return_value=True)), \
+                patch('caasp_kubectl.time.sleep', sleep), \
+                patch('caasp_kubectl.time.time', lambda: now[0]):
+            res = drain('node1', timeout=30)
+            self.assertFalse(res['drained'])
+            self.assertIn('disruption budget', res['pods']['default/db']['error'])
+            self.assertEqual(res['pods']['default/db']['blocked'], 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
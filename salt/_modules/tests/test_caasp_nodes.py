@@ -2,9 +2,12 @@ from __future__ import absolute_import
 
 import unittest
 
+import caasp_grains
+import caasp_nodes
 from caasp_log import ExecutionAborted
-from caasp_nodes import (get_expr_affected_by, get_from_args_or_with_expr,
-                         get_replacement_for, get_with_prio)
+from caasp_nodes import (ClusterView, get_affected_by, get_expr_affected_by, get_from_args_or_with_expr,
+                         get_replacement_for, get_replacements_for, get_target_affected_by,
+                         get_with_prio, rank_with_prio)
 
 try:
     from mock import patch, MagicMock
@@ -14,6 +17,11 @@ else:
     _mocking_lib_available = True
 
 
+caasp_nodes.__salt__ = {
+    'caasp_pillar.get': lambda name, default='': default
+}
+
+
 class TestGetFromArgsOrWithExpr(unittest.TestCase):
     '''
     Some basic tests for get_from_args_or_with_expr()
@@ -34,6 +42,65 @@ class TestGetFromArgsOrWithExpr(unittest.TestCase):
                          'did not get the masters with the expresion: {}'.format(res))
 
 
+class TestClusterView(unittest.TestCase):
+    '''
+    Some basic tests for the ClusterView
+    '''
+
+    def setUp(self):
+        self.view = ClusterView({
+            'ca': {'roles': ['ca']},
+            'admin': {'roles': ['admin']},
+            'master_1': {'roles': ['kube-master', 'etcd'], 'bootstrap_complete': True},
+            'master_2': {'roles': ['kube-master'], 'bootstrap_complete': 'true'},
+            'master_3': {'roles': ['kube-master'], 'bootstrap_complete': ''},
+            'minion_1': {'roles': ['kube-minion'], 'bootstrap_complete': True,
+                         'update_in_progress': True},
+            'other_node': {'roles': [], 'bootstrap_complete': ''},
+        })
+
+    def test_masks(self):
+        view = self.view
+        self.assertEqual(len(view), 7)
+        self.assertEqual(view.nodes(view.mask('kube-master')),
+                         ['master_1', 'master_2', 'master_3'])
+        self.assertEqual(view.nodes(view.mask('kube-master') & ~view.mask('booted')),
+                         ['master_3'])
+        self.assertEqual(view.nodes(view.mask('admin', 'ca')), ['admin', 'ca'])
+        self.assertEqual(view.nodes(view.mask('in_progress')), ['minion_1'])
+        self.assertEqual(view.nodes(view.mask('update_in_progress')), ['minion_1'])
+        self.assertEqual(view.nodes(view.all & ~view.mask('kube-master', 'kube-minion', 'admin', 'ca')),
+                         ['other_node'])
+        self.assertEqual(view.nodes(view.mask('unknown')), [])
+
+        self.assertTrue(view.has('master_1', view.mask('etcd')))
+        self.assertFalse(view.has('master_2', view.mask('etcd')))
+        self.assertFalse(view.has('unknown', view.all))
+
+        mask = view.mask_of(['master_1', 'minion_1', 'unknown'])
+        self.assertEqual(view.nodes(mask & view.mask('booted')), ['master_1', 'minion_1'])
+
+    def test_get_from_args_or_with_expr(self):
+        with patch('caasp_nodes.get_with_expr', MagicMock(return_value=[])):
+            res = get_from_args_or_with_expr('booted_masters', {'view': self.view},
+                                             'G@roles:kube-master', booted=True)
+            self.assertEqual(res, ['master_1', 'master_2'])
+
+            # explicit lists have precedence
+            res = get_from_args_or_with_expr('masters', {'view': self.view, 'masters': ['a']},
+                                             'G@roles:kube-master')
+            self.assertEqual(res, ['a'])
+
+    def test_get_replacement_for_with_view(self):
+        replacement, roles = get_replacement_for('master_1', replacement='other_node',
+                                                 view=self.view)
+        self.assertEqual(replacement, 'other_node')
+        self.assertEqual(roles, ['etcd', 'kube-master'])
+
+        with self.assertRaises(ExecutionAborted):
+            get_replacement_for('master_1', replacement='admin', view=self.view)
+
+
 class TestGetWithPrio(unittest.TestCase):
     '''
     Some basic tests for get_with_prio()
@@ -110,6 +177,55 @@ class TestGetWithPrio(unittest.TestCase):
             self.assertEqual(counter['value'], 3,
                              'unexpected number of calls ({}) to get_with_expr()'.format(counter['value']))
 
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_rank_with_prio_for_etcd(self):
+        '''
+        Check rank_with_prio() scores all the candidates with
+        just one query, in a deterministic order.
+        '''
+        from caasp_nodes import _get_prio_etcd
+        etcd_prio = _get_prio_etcd()
+
+        snapshot = {
+            'master_1': {'roles': ['kube-master'], 'bootstrap_complete': True},
+            'master_2': {'roles': ['kube-master'], 'bootstrap_complete': ''},
+            'minion_1': {'roles': ['kube-minion'], 'bootstrap_complete': True},
+            'etcd_1': {'roles': ['etcd'], 'bootstrap_complete': ''},
+            'etcd_2': {'roles': ['etcd', 'kube-master'], 'bootstrap_complete': True},
+        }
+
+        salt_mocks = {
+            'caasp_grains.get_snapshot': MagicMock(return_value=snapshot),
+            'caasp_grains.match': caasp_grains.match,
+            'caasp_grains.is_supported': caasp_grains.is_supported,
+        }
+
+        get_with_expr_mock = MagicMock(return_value=sorted(snapshot.keys(), reverse=True))
+        with patch.dict(caasp_nodes.__salt__, salt_mocks), \
+                patch('caasp_nodes.get_with_expr', get_with_expr_mock):
+            res = rank_with_prio(3, 'etcd', etcd_prio)
+            get_with_expr_mock.assert_called_once_with('*', exclude_admin=True,
+                                                       exclude_in_progress=True)
+
+            # etcd_2 is already a bootstrapped etcd member: it matches no rule
+            self.assertEqual([node for (node, _) in res],
+                             ['etcd_1', 'master_2', 'master_1'])
+            self.assertEqual(res[0][1], etcd_prio[0])
+
+            # with the 'targeting:local' pillar, get_with_prio() uses rank_with_prio()
+            with patch.dict(caasp_nodes.__salt__, {'caasp_pillar.get': MagicMock(return_value=True)}):
+                nodes = get_with_prio(4, 'etcd', etcd_prio)
+                self.assertEqual(nodes, ['etcd_1', 'master_2', 'master_1', 'minion_1'])
+
+                # some rule cannot be matched locally: one query per rule
+                get_with_expr_mock.reset_mock()
+                get_with_expr_mock.side_effect = lambda expr, **kwargs: \
+                    {'*': sorted(snapshot.keys()), 'I@some:pillar:value': ['minion_1']}.get(expr, [])
+                nodes = get_with_prio(1, 'etcd', ['I@some:pillar:value'] + etcd_prio)
+                self.assertEqual(nodes, ['minion_1'])
+                self.assertEqual(get_with_expr_mock.call_args[0][0], 'I@some:pillar:value')
+
 
 class TestGetReplacementFor(unittest.TestCase):
     '''
@@ -297,6 +413,98 @@ class TestGetReplacementFor(unittest.TestCase):
                              'unexpected replacement ' + replacement)
 
 
+class TestGetReplacementsFor(unittest.TestCase):
+    '''
+    Some basic tests for get_replacements_for()
+    '''
+
+    def setUp(self):
+        self.ca = 'ca'
+        self.master_1 = 'master_1'
+        self.master_2 = 'master_2'
+        self.master_3 = 'master_3'
+        self.minion_1 = 'minion_1'
+        self.minion_2 = 'minion_2'
+        self.other_node_1 = 'other_node_1'
+        self.other_node_2 = 'other_node_2'
+
+        self.masters = [self.master_1, self.master_2, self.master_3]
+        self.etcd_members = [self.master_1, self.master_2, self.master_3]
+        self.minions = [self.minion_1, self.minion_2]
+
+        self.kwargs = {
+            'forbidden': [self.ca],
+            'etcd_members': self.etcd_members,
+            'masters': self.masters,
+            'minions': self.minions,
+            'booted_etcd_members': self.etcd_members,
+            'booted_masters': self.masters,
+            'booted_minions': self.minions
+        }
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_no_replacement_used_twice(self):
+        '''
+        Check the same node is not chosen twice, and targets
+        are not used as replacements.
+        '''
+        def mocked_get_one_for_role(role, excluded=[], **kwargs):
+            for node in [self.master_2, self.other_node_1, self.other_node_2]:
+                if node not in excluded:
+                    return node
+            return ''
+
+        with patch('caasp_nodes._get_one_for_role', mocked_get_one_for_role):
+            res = get_replacements_for([self.master_2, self.master_1], **self.kwargs)
+
+        self.assertEqual(res[self.master_1][0], self.other_node_1)
+        self.assertEqual(res[self.master_2][0], self.other_node_2)
+        for target in [self.master_1, self.master_2]:
+            self.assertIn('etcd', res[target][1])
+            self.assertIn('kube-master', res[target][1])
+
+    def test_user_provided(self):
+        '''
+        Check user-provided replacements are used, but not twice
+        '''
+        res = get_replacements_for([self.minion_1],
+                                   {self.minion_1: self.other_node_1},
+                                   **self.kwargs)
+        self.assertEqual(res[self.minion_1], (self.other_node_1, ['kube-minion']))
+
+        # one target cannot be the replacement for another target
+        with self.assertRaises(ExecutionAborted):
+            get_replacements_for([self.minion_1, self.minion_2],
+                                 {self.minion_1: self.minion_2},
+                                 **self.kwargs)
+
+        with self.assertRaises(ExecutionAborted):
+            get_replacements_for([self.master_1, self.minion_1],
+                                 {self.master_1: self.other_node_1,
+                                  self.minion_1: self.other_node_1},
+                                 **self.kwargs)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_min_nodes_after_removal(self):
+        '''
+        Check the minimum number of nodes is checked against what
+        remains after removing all the targets.
+        '''
+        with patch('caasp_nodes._get_one_for_role', MagicMock(return_value='')):
+            # removing one minion is fine: the other one remains
+            res = get_replacements_for([self.minion_1], **self.kwargs)
+            self.assertEqual(res[self.minion_1], ('', []))
+
+            # ... but we cannot remove both
+            with self.assertRaises(ExecutionAborted):
+                get_replacements_for([self.minion_1, self.minion_2], **self.kwargs)
+
+            with self.assertRaises(ExecutionAborted):
+                get_replacements_for(self.masters, **self.kwargs)
+
+
 class TestGetExprAffectedBy(unittest.TestCase):
     '''
     Some basic tests for get_expr_affected_by()
@@ -384,6 +592,89 @@ class TestGetExprAffectedBy(unittest.TestCase):
             self.assertIn(expr, affected_items,
                           '{} is not in affected in expr: {}'.format(expr, affected_expr))
 
+    def test_get_expr_affected_by_many_removals(self):
+        '''
+        Calculate the expression for matching nodes affected by
+        the removal of an etcd-only node and a minion
+        '''
+        affected_expr = get_expr_affected_by([self.only_etcd_1, self.minion_1],
+                                             excluded=[self.master_2],
+                                             masters=self.masters,
+                                             minions=self.minions,
+                                             etcd_members=self.etcd_members)
+
+        affected_items = affected_expr.split(' and ')
+        expected_matches = self.common_expected_affected_matches + [
+            'P@roles:(etcd|kube-master)',
+            'not L@master_2,minion_1,only_etcd_1']
+
+        for expr in expected_matches:
+            self.assertIn(expr, affected_items,
+                          '{} is not in affected in expr: {}'.format(expr, affected_expr))
+
+    def test_get_affected_by(self):
+        '''
+        Get the resolved list of nodes affected by a master removal
+        '''
+        view = ClusterView({
+            self.ca: {'roles': ['ca'], 'bootstrap_complete': True},
+            'admin': {'roles': ['admin'], 'bootstrap_complete': True},
+            self.master_1: {'roles': ['kube-master', 'etcd'], 'bootstrap_complete': True},
+            self.master_2: {'roles': ['kube-master', 'etcd'], 'bootstrap_complete': True},
+            self.master_3: {'roles': ['kube-master', 'etcd'], 'bootstrap_complete': True,
+                            'update_in_progress': True},
+            self.only_etcd_1: {'roles': ['etcd'], 'bootstrap_complete': True},
+            self.minion_1: {'roles': ['kube-minion'], 'bootstrap_complete': True},
+            self.minion_2: {'roles': ['kube-minion'], 'bootstrap_complete': ''},
+            self.minion_3: {'roles': ['kube-minion'], 'bootstrap_complete': True},
+        })
+
+        affected = get_affected_by(self.master_1,
+                                   excluded=[self.minion_3],
+                                   view=view)
+        self.assertEqual(affected, ['admin', self.master_2, self.minion_1, self.only_etcd_1])
+
+        affected = get_affected_by(self.only_etcd_1,
+                                   exclude_in_progress=False,
+                                   view=view)
+        self.assertEqual(affected, [self.master_1, self.master_2, self.master_3])
+
+        affected = get_affected_by(self.minion_1, view=view)
+        self.assertEqual(affected, [])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_get_target_affected_by(self):
+        '''
+        Get a list with local targeting, unless the view does not know the targets
+        '''
+        view = ClusterView({
+            'admin': {'roles': ['admin'], 'bootstrap_complete': True},
+            self.master_1: {'roles': ['kube-master', 'etcd'], 'bootstrap_complete': True},
+            self.master_2: {'roles': ['kube-master', 'etcd'], 'bootstrap_complete': True},
+            self.minion_1: {'roles': ['kube-minion'], 'bootstrap_complete': True},
+        })
+        nodes = {'masters': self.masters,
+                 'minions': self.minions,
+                 'etcd_members': self.etcd_members}
+
+        with patch.dict(caasp_nodes.__salt__, {'caasp_pillar.get': MagicMock(return_value=True)}):
+            expr, tgt_type = get_target_affected_by(self.master_1, view=view, **nodes)
+            self.assertEqual(tgt_type, 'list')
+            self.assertEqual(expr, ','.join(['admin', self.master_2, self.minion_1]))
+
+            # an empty (or outdated) snapshot: use a compound expression
+            for view_ in [ClusterView({}), view]:
+                expr, tgt_type = get_target_affected_by([self.master_1, self.master_3], view=view_, **nodes)
+                self.assertEqual(tgt_type, 'compound')
+                self.assertEqual(expr, get_expr_affected_by([self.master_1, self.master_3], **nodes))
+                self.assertIn('P@roles:', expr)
+
+        # no local targeting
+        expr, tgt_type = get_target_affected_by(self.master_1, view=view, **nodes)
+        self.assertEqual(tgt_type, 'compound')
+        self.assertEqual(expr, get_expr_affected_by(self.master_1, **nodes))
+
 
 if __name__ == '__main__':
     unittest.main()
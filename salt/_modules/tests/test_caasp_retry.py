@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+
+import unittest
+
+import caasp_retry
+from caasp_retry import budget_left, call, report, telemetry
+
+try:
+    from mock import patch, MagicMock
+except ImportError:
+    _mocking_lib_available = False
+else:
+    _mocking_lib_available = True
+
+
+caasp_retry.__salt__ = {
+    'caasp_pillar.get': lambda name, default='': default
+}
+caasp_retry.__context__ = {}
+
+
+def _results(*results):
+    # a function returning state returns (with some exit codes)
+    rets = [{'result': retcode == 0, 'changes': {'retcode': retcode}, 'comment': ''}
+            for retcode in results]
+    return MagicMock(side_effect=rets)
+
+
+class TestCall(unittest.TestCase):
+    '''
+    Some basic tests for the retries engine
+    '''
+
+    def setUp(self):
+        caasp_retry.__context__.clear()
+        self.sleeps = []
+        self.now = [1000.0]
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now[0] += seconds
+
+        self.patches = [patch('caasp_retry.time.sleep', sleep),
+                        patch('caasp_retry.time.time', lambda: self.now[0])]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_attempts(self):
+        ret, attempts, reason = call(_results(1, 1, 0), attempts=5, interval=2)
+        self.assertTrue(ret['result'])
+        self.assertEqual(attempts, 3)
+        self.assertIsNone(reason)
+        self.assertEqual(self.sleeps, [2, 2])
+
+        ret, attempts, reason = call(_results(1, 1, 1), attempts=3, interval=2)
+        self.assertFalse(ret['result'])
+        self.assertEqual(attempts, 3)
+        self.assertEqual(reason, 'no more attempts')
+
+        # by default, just one attempt
+        ret, attempts, reason = call(_results(1, 0))
+        self.assertEqual(attempts, 1)
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_backoff_and_deadline(self):
+        fun = _results(*([1] * 100))
+        ret, attempts, reason = call(fun, interval=1, backoff=2, max_interval=8, deadline=40)
+        self.assertFalse(ret['result'])
+        self.assertEqual(self.sleeps, [1, 2, 4, 8, 8, 8, 8])
+        self.assertTrue(reason.startswith('deadline'))
+        self.assertEqual(attempts, 8)
+
+        self.sleeps = []
+        call(_results(1, 1, 1, 0), interval=4, jitter=True, deadline=60)
+        self.assertEqual(len(self.sleeps), 3)
+        self.assertTrue(all(2 <= s <= 4 for s in self.sleeps))
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_non_retriable(self):
+        ret, attempts, reason = call(_results(1, 127, 0), attempts=10, non_retriable=[126, 127])
+        self.assertEqual(attempts, 2)
+        self.assertEqual(reason, 'non-retriable exit code 127')
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_budget(self):
+        with patch.dict(caasp_retry.__salt__, {'caasp_pillar.get': lambda name, default='': 3}):
+            self.assertEqual(budget_left(), 3)
+            ret, attempts, reason = call(_results(1, 1, 0), attempts=10, interval=0)
+            self.assertTrue(ret['result'])
+            self.assertEqual(budget_left(), 1)
+
+            ret, attempts, reason = call(_results(1, 1, 1, 1), attempts=10, interval=0)
+            self.assertEqual(attempts, 2)
+            self.assertEqual(reason, 'retry budget exhausted')
+            self.assertEqual(budget_left(), 0)
+
+            # some states can ignore the budget
+            ret, attempts, reason = call(_results(1, 0), attempts=10, interval=0, budget=False)
+            self.assertTrue(ret['result'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_telemetry(self):
+        ret, attempts, reason = call(_results(1, 2, 0), name='some-state',
+                                     attempts=5, interval=1, backoff=2)
+        summary = ret['retries']
+        self.assertEqual(summary['name'], 'some-state')
+        self.assertEqual([a['retcode'] for a in summary['attempts']], [1, 2, 0])
+        self.assertEqual([a['slept'] for a in summary['attempts']], [1, 2, 0])
+        self.assertEqual([a['start'] for a in summary['attempts']], [1000, 1001, 1003])
+        self.assertEqual(summary['slept'], 3)
+        self.assertEqual(summary['elapsed'], 3)
+        self.assertIsNone(summary['reason'])
+
+        call(_results(0), name='other-state')
+        self.assertEqual([t['name'] for t in telemetry()], ['some-state', 'other-state'])
+
+    @unittest.skipIf(not _mocking_lib_available,
+                     "no mocking library available (install rpm:python-mock)")
+    def test_report(self):
+        call(_results(1, 1, 0), name='flaky', attempts=5, interval=5)
+        call(_results(0), name='fast')
+        call(_results(1, 0), name='slow', attempts=5, interval=20)
+
+        res = report(top=2)
+        self.assertEqual(res['states'], 3)
+        self.assertEqual(res['retries'], 3)
+        self.assertEqual(res['slept'], 30)
+        self.assertEqual([e['state'] for e in res['slowest']], ['slow', 'flaky'])
+        self.assertEqual([e['state'] for e in res['most_retried']], ['flaky', 'slow'])
+
+        # the returns of a (previous) run, from `salt <tgt> state.apply`
+        returns = {'node1': {
+            'cmd_|-a_|-a_|-run': {'result': True, 'comment': '', 'duration': 500.0},
+            'caasp_cmd_|-b_|-b_|-run': {'result': True, 'comment': '', 'duration': 9000.0,
+                                        'retries': {'attempts': [{}, {}, {}], 'slept': 8}},
+        }}
+        res = report(returns=returns)
+        self.assertEqual(res['states'], 2)
+        self.assertEqual(res['slowest'][0]['state'], 'node1: caasp_cmd_|-b_|-b_|-run')
+        self.assertEqual(res['slowest'][0]['duration'], 9)
+        self.assertEqual(res['most_retried'][0]['attempts'], 3)
+        self.assertEqual(res['slept'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,5 @@
 from __future__ import absolute_import
 
-import time
-
 
 def run(name,
         onlyif=None,
@@ -153,7 +151,9 @@ def run(name,
         This allows you to provide `attempts` and `interval`, what will retry the command as much
         ``attempts`` times, separated by `interval` seconds. If 'until' is provided,
         verify we must not try again after running the command successfully
-        by runing the `until` condition.
+        by runing the `until` condition. See ``caasp_retry.call`` for other
+        options (ie, ``backoff``, ``jitter``, ``deadline`` or ``non_retriable``
+        exit codes, by default 126 and 127).
 
     '''
     # NOTE: The keyword arguments in **kwargs are passed directly to the
@@ -163,12 +163,13 @@ def run(name,
 
     retry_ = {'attempts': 1,
               'interval': 1,
-              'until': None}
+              'until': None,
+              # "permission denied"/"command not found" will not fix themselves
+              'non_retriable': [126, 127]}
     retry_.update(retry)
+    until = retry_.pop('until')
 
-    ret = None
-
-    for attempt in range(retry_['attempts']):
+    def run_once():
         ret = __states__['cmd.run'](name=name,
                                     onlyif=onlyif,
                                     unless=unless,
@@ -186,18 +187,9 @@ def run(name,
                                     use_vt=use_vt,
                                     **kwargs)
 
-        if ret['result']:
-            ret_success = {'name': name,
-                           'changes': ret['changes'],
-                           'result': True,
-                           'comment': "Command executed succesfully after {0} retries. Last output: {1}".format(attempt + 1, ret['comment'])}
-
-            # command run successful
-            if not retry_['until']:
-                return ret_success
-
-            # check if we are really done
-            retry_until_ret = __states__['cmd.run'](name=retry_['until'],
+        # command run successful: check if we are really done
+        if ret['result'] and until:
+            retry_until_ret = __states__['cmd.run'](name=until,
                                                     cwd=cwd,
                                                     runas=runas,
                                                     shell=shell,
@@ -209,20 +201,24 @@ def run(name,
                                                     ignore_timeout=ignore_timeout,
                                                     use_vt=use_vt,
                                                     **kwargs)
-            if retry_until_ret['result']:
-                return ret_success
-
-            # append the 'until' command output, so we can have some debugging info...
-            ret['comment'] = ret['comment'] + \
-                "(until: " + retry_until_ret['comment'] + ")"
-
-        if attempt + 1 == retry_['attempts']:
-            break
-
-        if retry_['interval'] > 0:
-            time.sleep(retry_['interval'])
+            if not retry_until_ret['result']:
+                # append the 'until' command output, so we can have some debugging info...
+                ret['result'] = False
+                ret['comment'] = ret['comment'] + \
+                    "(until: " + retry_until_ret['comment'] + ")"
+        return ret
+
+    ret, attempts, reason = __salt__['caasp_retry.call'](run_once, name=name, **retry_)
+
+    if ret['result']:
+        return {'name': name,
+                'changes': ret['changes'],
+                'retries': ret['retries'],
+                'result': True,
+                'comment': "Command executed succesfully after {0} retries. Last output: {1}".format(attempts, ret['comment'])}
 
     return {'name': name,
             'changes': ret['changes'],
+            'retries': ret['retries'],
             'result': False,
-            'comment': "Command failed after {0} retries. Last output: {1}".format(retry_['attempts'], ret['comment'])}
+            'comment': "Command failed after {0} retries ({1}). Last output: {2}".format(attempts, reason, ret['comment'])}
@@ -75,20 +75,117 @@ def wait_for_container(name, namespace, timeout=60, **kwargs):
            'result': False,
            'comment': ''}
 
-    running = __salt__['caasp_cri.wait_for_container'](name,
-                                                       namespace,
-                                                       timeout,
-                                                       **kwargs)
+    res = __salt__['caasp_cri.wait_for_container_running'](name,
+                                                           namespace,
+                                                           timeout)
 
-    if running:
+    if res['running']:
         ret['result'] = True
-        ret['comment'] = '{namespace}.{container} successfully restarted'.format(
+        ret['comment'] = '{namespace}.{container} successfully restarted in {time:.2f}s'.format(
             namespace=namespace,
-            container=name
+            container=name,
+            time=res['time']
         )
     else:
         ret['comment'] = '{namespace}.{container} was not restarted by kubelet within the given time'.format(
             namespace=namespace,
             container=name)
 
+    debug('CaaS: {namespace}.{container}: {checks} checks in {time:.2f}s'.format(
+          namespace=namespace,
+          container=name,
+          checks=res['checks'],
+          time=res['time']))
+
+    return ret
+
+
+def _wait_for_containers(name, containers, timeout, verb):
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+
+    results = __salt__['caasp_cri.wait_for_containers'](containers, timeout)
+
+    summary = []
+    for (container, result) in sorted(results.items()):
+        if result['running']:
+            summary.append('{container}: {verb} in {time:.2f}s'.format(
+                container=container, verb=verb, time=result['time']))
+        else:
+            summary.append('{container}: not {verb} within the given time'.format(
+                container=container, verb=verb))
+
+    ret['result'] = all(result['running'] for result in results.values())
+    ret['comment'] = '; '.join(summary)
+    return ret
+
+
+def wait_for_containers(name, containers, timeout=60, **kwargs):
+    '''
+    Wait for some containers to be up and running.
+
+    containers
+        List of ``name``/``namespace`` selectors for the containers.
+
+    timeout
+        If some container is not running after ``timeout`` seconds, return
+        with a failure.
+
+        By default a 60 seconds timeout is applied.
+
+    .. code-block:: yaml
+
+    wait_for_kube_system:
+      caasp_cri.wait_for_containers:
+        - containers:
+          - name: haproxy
+            namespace: kube-system
+          - name: openldap
+            namespace: kube-system
+        - timeout: 120
+    '''
+
+    return _wait_for_containers(name, containers, timeout, 'running')
+
+
+def stop_containers_and_wait(name, containers, timeout=60, **kwargs):
+    '''
+    Stop some running containers, and then wait for kubelet to bring
+    up new instances of all of them.
+
+    containers
+        List of ``name``/``namespace`` selectors for the containers.
+
+    timeout
+        If some container has not been restarted after timeout seconds,
+        return with a failure.
+
+        By default a 60 seconds timeout is applied.
+
+    .. code-block:: yaml
+
+    restart_kube_system:
+      caasp_cri.stop_containers_and_wait:
+        - containers:
+          - name: haproxy
+            namespace: kube-system
+          - name: openldap
+            namespace: kube-system
+        - timeout: 120
+    '''
+
+    stopped = __salt__['caasp_cri.stop_containers'](
+        containers, ignore_errors=kwargs.get('ignore_errors', True))
+    for (container, result) in stopped.items():
+        if not result['stopped']:
+            debug('CaaS: {container} container was not stopped: {error}'.format(
+                  container=container,
+                  error=result['error'] or 'not found running'))
+
+    ret = _wait_for_containers(name, containers, timeout, 'restarted')
+    ret['changes'] = dict((container, {'stop_time': result['time']})
+                          for (container, result) in stopped.items()
+                          if result['stopped'])
     return ret
@@ -50,12 +50,82 @@ def etcdctl(name, retry={}, **kwargs):
                                        **kwargs)
 
 
-def healthy(name, **kwargs):
+def _api_call(name, fun, retry={}):
+    '''
+    Run `fun` (some call to the etcd API) with retries, returning
+    the state return. `fun` must return a (changes, comment) tuple,
+    or raise an exception when it fails.
+    '''
+    retry_ = {'attempts': DEFAULT_ATTEMPTS,
+              'interval': DEFAULT_ATTEMPTS_INTERVAL}
+    retry_.update(retry)
+
+    if __opts__['test']:
+        return {'name': name,
+                'changes': {},
+                'result': None,
+                'comment': '{} would be done with the etcd API'.format(name)}
+
+    def call_once():
+        try:
+            changes, comment = fun()
+            return {'result': True, 'changes': changes, 'comment': comment}
+        except Exception as e:
+            log.debug('CaaS: %s failed: %s', name, e)
+            return {'result': False, 'changes': {}, 'comment': str(e)}
+
+    ret, attempts, reason = __salt__['caasp_retry.call'](call_once, name=name, **retry_)
+
+    if ret['result']:
+        comment = "{} succeeded after {} attempts: {}".format(name, attempts, ret['comment'])
+    else:
+        comment = "{} failed after {} attempts ({}): {}".format(name, attempts, reason, ret['comment'])
+
+    return {'name': name,
+            'changes': ret['changes'],
+            'retries': ret['retries'],
+            'result': ret['result'],
+            'comment': comment}
+
+
+def healthy(name, all_members=False, **kwargs):
+    '''
+    Check the etcd cluster is healthy
+
+    With etcd3, all the members are probed in parallel and we succeed
+    as soon as a quorum of healthy members is confirmed.
+
+    Arguments:
+
+    * `all_members`: (optional) wait for all the members, and succeed
+                     only if all of them are healthy.
+    '''
     log.debug('CaaS: checking etcd health')
     if api_version() == 'etcd2':
         return etcdctl(name='cluster-health', **kwargs)
-    else:
-        return etcdctl(name='endpoint health', **kwargs)
+
+    def check_health():
+        report = __salt__['caasp_etcd.health_report'](wait_all=all_members)
+        summary = []
+        for (endpoint, member) in sorted(report['members'].items()):
+            if member.get('pending'):
+                summary.append('{}: pending'.format(endpoint))
+            elif member['healthy']:
+                summary.append('{}: healthy{} (rtt: {:.3f}s, raft index: {})'.format(
+                    endpoint, ' leader' if member['leader'] else '',
+                    member['rtt'], member['raft_index']))
+            else:
+                summary.append('{}: unhealthy ({})'.format(endpoint, member['error']))
+
+        if not report['healthy']:
+            raise Exception('no quorum of {} healthy members: {}'.format(
+                report['quorum'], '; '.join(summary)))
+        if all_members and not all(m.get('healthy') for m in report['members'].values()):
+            raise Exception('some members are not healthy: {}'.format('; '.join(summary)))
+        return {}, '; '.join(summary)
+
+    return _api_call('healthy.{}'.format(name), check_health,
+                     retry=kwargs.get('retry', {}))
 
 
 def member_add(name, **kwargs):
@@ -68,12 +138,21 @@ def member_add(name, **kwargs):
     this_nodename = __salt__['caasp_net.get_nodename']()
     this_peer_url = 'https://{}:{}'.format(this_nodename, port)
 
+    log.debug('CaaS: adding etcd member')
     if api_version() == 'etcd2':
         name = 'member add {} {}'.format(this_id, this_peer_url)
-    else:
-        name = 'member add {} --peer-urls={}'.format(this_id, this_peer_url)
-    log.debug('CaaS: adding etcd member')
-    return etcdctl(name=name, skip_this=True, **kwargs)
+        return etcdctl(name=name, skip_this=True, **kwargs)
+
+    def add():
+        members = __salt__['caasp_etcd.members'](skip_this=True)
+        if this_peer_url in members['by_peer_url']:
+            return {}, '{} is already a member'.format(this_peer_url)
+
+        member = __salt__['caasp_etcd.member_add']([this_peer_url], skip_this=True)
+        return {'member': member}, '{} added as member {}'.format(this_peer_url, member['id'])
+
+    return _api_call('member_add.{}'.format(name), add,
+                     retry=kwargs.get('retry', {}))
 
     # once the member has been added to the cluster, we
     # must make sure etcd joins an "existing" cluster.
@@ -100,6 +179,95 @@ def member_remove(name, nodename=None, **kwargs):
             'changes': {}
         }
 
-    name = 'member remove {}'.format(target_member_id)
     log.debug('CaaS: removing etcd member %s', target_member_id)
-    return etcdctl(name=name, **kwargs)
+    if api_version() == 'etcd2':
+        name = 'member remove {}'.format(target_member_id)
+        return etcdctl(name=name, **kwargs)
+
+    def remove():
+        __salt__['caasp_etcd.member_remove'](target_member_id)
+        return {'removed': target_member_id}, 'member {} removed'.format(target_member_id)
+
+    return _api_call('member_remove.{}'.format(name), remove,
+                     retry=kwargs.get('retry', {}))
+
+
+def compacted(name, keep_revisions=None, **kwargs):
+    '''
+    Compact the etcd revision history (etcd3 only)
+
+    Arguments:
+
+    * `keep_revisions`: (optional) number of revisions to keep.
+    '''
+    def compact():
+        args = {}
+        if keep_revisions is not None:
+            args['keep_revisions'] = keep_revisions
+        res = __salt__['caasp_etcd.compact'](**args)
+        if res['compacted'] is None:
+            return {}, 'nothing to compact at revision {}'.format(res['revision'])
+        return ({'compacted': res['compacted']},
+                'history compacted at revision {} (current: {})'.format(
+                    res['compacted'], res['revision']))
+
+    return _api_call('compacted.{}'.format(name), compact,
+                     retry=kwargs.get('retry', {}))
+
+
+def defragmented(name, **kwargs):
+    '''
+    Defragment the database of all the etcd members, one at a time,
+    reporting the bytes reclaimed and the time taken for each member
+    (etcd3 only)
+    '''
+    def defragment():
+        res = __salt__['caasp_etcd.defragment']()
+        summary = []
+        changes = {}
+        for member in res['members']:
+            if 'skipped' in member:
+                summary.append('{}: skipped ({})'.format(member['endpoint'], member['skipped']))
+                continue
+            changes[member['endpoint']] = {'reclaimed': member['reclaimed'],
+                                           'time': member['time']}
+            summary.append('{}: {} bytes reclaimed in {:.3f}s{}'.format(
+                member['endpoint'], member['reclaimed'], member['time'],
+                ' (leader)' if member['leader'] else ''))
+
+        if not res['result']:
+            raise Exception('could not defragment all the members: {}'.format('; '.join(summary)))
+        return changes, '{} bytes reclaimed: {}'.format(res['reclaimed'], '; '.join(summary))
+
+    # do not repeat the defragmentation of all the members by default
+    retry = {'attempts': 1}
+    retry.update(kwargs.get('retry', {}))
+    return _api_call('defragmented.{}'.format(name), defragment, retry=retry)
+
+
+def snapshot(name, directory=None, keep=None, **kwargs):
+    '''
+    Save a snapshot of the etcd database, streamed from the healthiest member
+    (etcd3 only)
+
+    Arguments:
+
+    * `directory`: (optional) where snapshots are saved.
+    * `keep`: (optional) number of snapshots to keep.
+    '''
+    def save():
+        args = {}
+        if directory:
+            args['directory'] = directory
+        if keep:
+            args['keep'] = keep
+        res = __salt__['caasp_etcd.snapshot'](**args)
+        changes = {'path': res['path'], 'sha256': res['sha256']}
+        if res['removed']:
+            changes['removed'] = res['removed']
+        return changes, 'snapshot from {} saved at {} ({} bytes in {:.3f}s)'.format(
+            res['endpoint'], res['path'], res['size'], res['time'])
+
+    retry = {'attempts': 3}
+    retry.update(kwargs.get('retry', {}))
+    return _api_call('snapshot.{}'.format(name), save, retry=retry)
@@ -91,7 +91,11 @@ def query(name, match=None, match_type='string', status=None, wait_for=None, **k
         kwargs['test'] = True
 
     if wait_for:
-        data = __salt__['caasp_http.wait_for_successful_query'](name, wait_for=wait_for, **kwargs)
+        data = __salt__['caasp_http.wait_for_successful_query'](name, wait_for=wait_for,
+                                                                expected_status=status,
+                                                                match=match,
+                                                                match_type=match_type,
+                                                                **kwargs)
     else:
         data = __salt__['caasp_http.query'](name, **kwargs)
 
@@ -135,22 +139,83 @@ def wait_for_successful_query(name, wait_for=300, **kwargs):
     '''
     Like query but, repeat and wait until match/match_type or status is fulfilled. State returns result from last
     query state in case of success or if no successful query was made within wait_for timeout.
+
+    Queries are separated by an exponential backoff (see the ``interval`` and ``max_interval``
+    arguments of the ``caasp_http.wait_for_successful_query`` module function), and every
+    query has a ``timeout``.
     '''
     starttime = time.time()
+    ret = query(name, wait_for=wait_for, **kwargs)
+
+    attempts = ret['data'].get('attempts', [])
+    if attempts:
+        ret['comment'] += ' ({0} attempts in {1:.2f}s, last one took {2:.3f}s)'.format(
+            len(attempts),
+            time.time() - starttime,
+            attempts[-1]['time'])
+    return ret
+
+
+def wait_for_all(name, urls, wait_for=300, status=None, match=None, match_type='string', **kwargs):
+    '''
+    Wait (in parallel) until all the ``urls`` fulfill their match/match_type and/or
+    status, or ``wait_for`` seconds have elapsed.
+
+    urls
+        A list of URLs, or dictionaries with the ``url`` and some (optional)
+        ``status``, ``match``, ``match_type``, ``ca_bundle``, ``verify_ssl``,
+        ``header_dict`` or ``opts``, overriding the values given for all the URLs.
+
+    The comment reports the latency and the number of attempts for every URL.
+
+    .. code-block:: yaml
+
+        wait-for-services:
+          caasp_http.wait_for_all:
+            - urls:
+              - http://localhost:10248/healthz
+              - url: https://localhost:444/_health
+                verify_ssl: False
+            - status: 200
+            - wait_for: 300
+    '''
+    ret = {'name': name,
+           'result': False,
+           'comment': '',
+           'changes': {},
+           'data': {}}
 
-    while True:
-        caught_exception = None
-        ret = None
-        try:
-            ret = query(name, wait_for=wait_for, **kwargs)
-            if ret['result']:
-                return ret
-        except Exception as exc:
-            caught_exception = exc
-
-        if time.time() > starttime + wait_for:
-            if not ret and caught_exception:
-                # workaround pylint bug https://www.logilab.org/ticket/3207
-                raise caught_exception  # pylint: disable=E0702
-
-            return ret
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Would wait for {0}'.format(', '.join(
+            u['url'] if isinstance(u, dict) else u for u in urls))
+        return ret
+
+    def to_args(conditions):
+        args = dict((k, v) for (k, v) in conditions.items()
+                    if k in ('url', 'match', 'match_type', 'ca_bundle',
+                             'verify_ssl', 'header_dict', 'opts',
+                             'interval', 'max_interval', 'timeout'))
+        if 'status' in conditions:
+            args['expected_status'] = conditions['status']
+        return args
+
+    defaults = dict(kwargs, status=status, match=match, match_type=match_type)
+    results = __salt__['caasp_http.wait_for_all'](
+        [to_args(url) if isinstance(url, dict) else url for url in urls],
+        wait_for=wait_for,
+        **to_args(defaults))
+
+    summary = []
+    for (url, result) in sorted(results.items()):
+        if result['ok']:
+            summary.append('{0}: ready in {1:.2f}s ({2} attempts, latency {3:.3f}s)'.format(
+                url, result['time'], result['attempts'], result['latency'] or 0))
+        else:
+            summary.append('{0}: not ready after {1} attempts (last status: {2}, error: {3})'.format(
+                url, result['attempts'], result['status'], result['error']))
+
+    ret['result'] = all(result['ok'] for result in results.values())
+    ret['comment'] = '; '.join(summary)
+    ret['data'] = results
+    return ret
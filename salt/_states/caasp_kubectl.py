@@ -0,0 +1,398 @@
+from __future__ import absolute_import
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# default number of attempts for calls to the API server
+DEFAULT_ATTEMPTS = 10
+
+# ... and the interval between them
+DEFAULT_ATTEMPTS_INTERVAL = 1
+
+
+def _api_call(name, fun, retry={}):
+    '''
+    Run `fun` (some call to the API server) with retries, returning
+    the state return. `fun` must return a (changes, comment) tuple,
+    or raise an exception when it fails.
+    '''
+    retry_ = {'attempts': DEFAULT_ATTEMPTS,
+              'interval': DEFAULT_ATTEMPTS_INTERVAL}
+    retry_.update(retry)
+
+    def call_once():
+        try:
+            changes, comment = fun()
+            return {'result': True, 'changes': changes, 'comment': comment}
+        except Exception as e:
+            log.debug('CaaS: %s failed: %s', name, e)
+            return {'result': False, 'changes': {}, 'comment': str(e)}
+
+    ret, attempts, reason = __salt__['caasp_retry.call'](call_once, name=name, **retry_)
+
+    if not ret['result']:
+        ret['comment'] = "{} failed after {} attempts ({}): {}".format(
+            name, attempts, reason, ret['comment'])
+
+    return {'name': name,
+            'changes': ret['changes'],
+            'retries': ret['retries'],
+            'result': ret['result'],
+            'comment': ret['comment']}
+
+
+def _test_ret(name, comment):
+    return {'name': name,
+            'changes': {},
+            'result': None,
+            'comment': comment}
+
+
+def apply(name, manifest=None, namespace=None, batch=False, retry={}, **kwargs):
+    '''
+    Apply a manifest (a file or a directory with some manifests)
+    with a connection to the API server (instead of `kubectl apply`).
+
+    name
+        The manifest (unless ``manifest`` is provided).
+
+    namespace
+        Namespace for objects with no namespace.
+
+    batch
+        Do not apply the manifest now: queue it, so it is applied
+        with all the other manifests queued in this run (see
+        ``apply_queued``).
+
+    .. code-block:: yaml
+
+    /etc/kubernetes/addons/dns/:
+      caasp_kubectl.apply:
+        - namespace: kube-system
+    '''
+    manifest = manifest or name
+    if __opts__['test']:
+        return _test_ret(name, '{} would be applied'.format(manifest))
+
+    if batch:
+        __salt__['caasp_kubectl.queue_apply'](manifest, namespace=namespace)
+        return {'name': name,
+                'changes': {},
+                'result': True,
+                'comment': '{} queued for a batched apply'.format(manifest)}
+
+    def fun():
+        res = __salt__['caasp_kubectl.apply'](manifest, namespace=namespace)
+        changes = dict((obj, action) for (obj, action) in res.items() if action != 'unchanged')
+        return changes, '{} objects applied from {} ({} changed)'.format(
+            len(res), manifest, len(changes))
+
+    return _api_call(name, fun, retry=retry)
+
+
+def apply_queued(name, concurrency=8, force=False, retry={}, **kwargs):
+    '''
+    Apply (in one batch) all the manifests queued in this run by
+    ``apply`` states with ``batch: True``. Objects that have not changed
+    since they were applied (in the manifests and in the cluster) are
+    skipped (unless ``force``-d).
+
+    This state should run after all the ``apply`` states.
+
+    .. code-block:: yaml
+
+    kubectl-apply-queued-manifests:
+      caasp_kubectl.apply_queued:
+        - order: last
+    '''
+    manifests = __salt__['caasp_kubectl.pop_queue']()
+    if not manifests:
+        return {'name': name,
+                'changes': {},
+                'result': True,
+                'comment': 'no manifests queued'}
+
+    if __opts__['test']:
+        return _test_ret(name, '{} manifests would be applied'.format(len(manifests)))
+
+    def fun():
+        # objects applied in a previous attempt will be skipped
+        res = __salt__['caasp_kubectl.apply_batch'](manifests,
+                                                    concurrency=concurrency,
+                                                    force=force)
+        if res['errors']:
+            raise Exception('could not apply ' + ', '.join(
+                '{} ({})'.format(o, e) for (o, e) in sorted(res['errors'].items())))
+        changes = dict((obj, action) for (obj, action) in res['applied'].items()
+                       if action != 'unchanged')
+        return changes, '{} manifests applied: {} objects changed, {} skipped'.format(
+            len(manifests), len(changes), res['skipped'])
+
+    return _api_call(name, fun, retry=retry)
+
+
+def absent(name, path, retry={}, **kwargs):
+    '''
+    Make sure some object does not exist.
+
+    path
+        The path of the object in the API
+        (ie, ``/apis/rbac.authorization.k8s.io/v1/clusterrolebindings/system:dex``).
+    '''
+    if __opts__['test']:
+        return _test_ret(name, '{} would be removed'.format(path))
+
+    def fun():
+        if __salt__['caasp_kubectl.delete'](path):
+            return {'deleted': path}, '{} removed'.format(path)
+        return {}, '{} does not exist'.format(path)
+
+    return _api_call(name, fun, retry=retry)
+
+
+def node_labels(name, labels, node=None, retry={}, **kwargs):
+    '''
+    Set some labels in a node (labels with a ``None`` value are removed).
+
+    node
+        The node name (default: this node).
+
+    .. code-block:: yaml
+
+    set-master-label:
+      caasp_kubectl.node_labels:
+        - labels:
+            node-role.kubernetes.io/master: ""
+    '''
+    node = node or __salt__['grains.get']('nodename')
+    if __opts__['test']:
+        return _test_ret(name, 'labels {} would be set in {}'.format(labels, node))
+
+    def fun():
+        changed = __salt__['caasp_kubectl.label_node'](node, labels)
+        return changed, '{} labels changed in {}'.format(len(changed), node)
+
+    return _api_call(name, fun, retry=retry)
+
+
+def node_taint(name, key, value='', effect='NoSchedule', present=True, node=None, retry={}, **kwargs):
+    '''
+    Add (or remove, with ``present: False``) a taint in a node.
+
+    node
+        The node name (default: this node).
+
+    .. code-block:: yaml
+
+    set-master-taint:
+      caasp_kubectl.node_taint:
+        - key: node-role.kubernetes.io/master
+        - effect: NoSchedule
+    '''
+    node = node or __salt__['grains.get']('nodename')
+    taint = '{}={}:{}'.format(key, value, effect)
+    if __opts__['test']:
+        return _test_ret(name, 'taint {} would be {} in {}'.format(
+            taint, 'set' if present else 'removed', node))
+
+    def fun():
+        if __salt__['caasp_kubectl.taint_node'](node, key, value=value,
+                                                effect=effect, present=present):
+            return {'taint': taint, 'present': present}, 'taints changed in {}'.format(node)
+        return {}, 'taints already up to date in {}'.format(node)
+
+    return _api_call(name, fun, retry=retry)
+
+
+def cordoned(name, node=None, retry={}, **kwargs):
+    '''
+    Mark a node as unschedulable.
+
+    node
+        The node name (default: this node).
+    '''
+    return _cordon(name, node, True, retry)
+
+
+def uncordoned(name, node=None, retry={}, **kwargs):
+    '''
+    Mark a node as schedulable.
+
+    node
+        The node name (default: this node).
+    '''
+    return _cordon(name, node, False, retry)
+
+
+def _cordon(name, node, unschedulable, retry):
+    node = node or __salt__['grains.get']('nodename')
+    verb = 'cordoned' if unschedulable else 'uncordoned'
+    if __opts__['test']:
+        return _test_ret(name, '{} would be {}'.format(node, verb))
+
+    def fun():
+        if __salt__['caasp_kubectl.cordon'](node, unschedulable=unschedulable):
+            return {'unschedulable': unschedulable}, '{} {}'.format(node, verb)
+        return {}, '{} already {}'.format(node, verb)
+
+    return _api_call(name, fun, retry=retry)
+
+
+def wait_for_deployment(name, namespace='kube-system', timeout=600, **kwargs):
+    '''
+    Wait for the rollout of a deployment to be complete (ie, all
+    the replicas are ready, available and updated).
+
+    name
+        Name of the deployment.
+
+    namespace
+        Namespace of the deployment (default: ``kube-system``).
+
+    timeout
+        If the rollout is not complete after ``timeout`` seconds, return
+        with a failure.
+
+        By default a 600 seconds timeout is applied.
+
+    .. code-block:: yaml
+
+    wait-for-kube-dns-deployment:
+      caasp_kubectl.wait_for_deployment:
+        - name: kube-dns
+        - namespace: kube-system
+        - timeout: 600
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'would wait for deployment {}/{}'.format(namespace, name)
+        return ret
+
+    res = __salt__['caasp_kubectl.wait_for_deployment'](name,
+                                                        namespace=namespace,
+                                                        timeout=timeout)
+    ret['result'] = res['ready']
+    if res['ready']:
+        ret['comment'] = 'deployment {}/{} ready after {:.2f}s ({} replicas)'.format(
+            namespace, name, res['time'], res['status']['replicas'])
+    else:
+        ret['comment'] = 'deployment {}/{} not ready: {}'.format(
+            namespace, name, res['error'])
+    return ret
+
+
+def wait_for_deployments(name, deployments, namespace='kube-system', timeout=600, **kwargs):
+    '''
+    Wait (in parallel) for the rollout of some deployments to be
+    complete, so we only wait as long as the slowest one.
+
+    name
+        A user-defined name.
+
+    deployments
+        A list of deployment names (in ``namespace``), ``namespace/name``
+        strings or dictionaries with the ``name`` and ``namespace``.
+
+    namespace
+        Default namespace (default: ``kube-system``).
+
+    timeout
+        If some rollout is not complete after ``timeout`` seconds, return
+        with a failure, reporting which deployments were not ready.
+
+    .. code-block:: yaml
+
+    wait-for-addons:
+      caasp_kubectl.wait_for_deployments:
+        - deployments:
+          - kube-dns
+          - name: dex
+            namespace: kube-system
+        - timeout: 600
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'would wait for deployments {}'.format(deployments)
+        return ret
+
+    res = __salt__['caasp_kubectl.wait_for_deployments'](deployments,
+                                                         namespace=namespace,
+                                                         timeout=timeout)
+    blocked = sorted(d for d in res if not res[d]['ready'])
+    ret['result'] = not blocked
+    ret['deployments'] = res
+    if blocked:
+        ret['comment'] = 'deployments not ready after {}s: '.format(timeout) + \
+            ', '.join('{} ({})'.format(d, res[d]['error']) for d in blocked)
+    else:
+        ret['comment'] = 'all the deployments are ready: ' + \
+            ', '.join('{} after {:.2f}s'.format(d, res[d]['time']) for d in sorted(res))
+    return ret
+
+
+def drained(name, node=None, timeout=600, concurrency=8, grace_period=None, **kwargs):
+    '''
+    Drain a node: cordon it and evict its pods (respecting the
+    PodDisruptionBudgets), with some evictions in parallel.
+
+    node
+        The node name (default: this node).
+
+    timeout
+        Fail if the pods are not gone after ``timeout`` seconds.
+
+    concurrency
+        Maximum number of pods evicted in parallel.
+
+    The progress of every pod (when it was evicted, for how long it
+    was blocked by a disruption budget...) is included in the ``pods``
+    of the state return.
+
+    .. code-block:: yaml
+
+    drain-kubelet:
+      caasp_kubectl.drained:
+        - timeout: 600
+        - concurrency: 8
+    '''
+    node = node or __salt__['grains.get']('nodename')
+    if __opts__['test']:
+        return _test_ret(name, '{} would be drained'.format(node))
+
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+    try:
+        res = __salt__['caasp_kubectl.drain'](node,
+                                              timeout=timeout,
+                                              concurrency=concurrency,
+                                              grace_period=grace_period)
+    except Exception as e:
+        ret['comment'] = 'could not drain {}: {}'.format(node, e)
+        return ret
+
+    ret['result'] = res['drained']
+    ret['pods'] = res['pods']
+    if res['pods']:
+        ret['changes'] = {'evicted': sorted(p for p in res['pods'] if 'error' not in res['pods'][p])}
+
+    if res['drained']:
+        ret['comment'] = '{} drained after {:.2f}s ({} pods evicted, {} skipped)'.format(
+            node, res['time'], len(res['pods']), len(res['skipped']))
+    else:
+        ret['comment'] = 'could not drain {} after {:.2f}s: '.format(node, res['time']) + \
+            ', '.join('{} ({})'.format(p, r['error'])
+                      for (p, r) in sorted(res['pods'].items()) if 'error' in r)
+    return ret
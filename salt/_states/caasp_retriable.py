@@ -1,7 +1,5 @@
 from __future__ import absolute_import
 
-import time
-
 
 def retry(name, target, retry={}, **kwargs):
     '''
@@ -17,6 +15,8 @@ def retry(name, target, retry={}, **kwargs):
         This allows you to provide `attempts` and `interval`, what will retry
         the command as much ``attempts`` times, separated by `interval`
         seconds. By default performs 1 attempt with a 1 second interval.
+        See ``caasp_retry.call`` for other options (ie, ``backoff``,
+        ``jitter``, ``deadline`` or ``non_retriable`` exit codes).
 
     All other arguments are passed to the orginal salt state.
 
@@ -25,35 +25,32 @@ def retry(name, target, retry={}, **kwargs):
     retry_ = {'attempts': 1, 'interval': 1}
     retry_.update(retry)
 
-    ret = None
-
-    for attempt in range(retry_['attempts']):
+    def run_once():
         try:
-            ret = __states__[target](name=name, **kwargs)
+            return __states__[target](name=name, **kwargs)
         except BaseException as e:
-            ret = {'result': False, 'changes': False, 'comment': 'Exception raised: {0}'.format(e)}
-
-        if ret['result']:
-            return {
-                'name': "caasp_retriable.{0}.{1}".format(name, target),
-                'changes': ret['changes'],
-                'result': True,
-                'comment': "Command executed succesfully after {0} attempts. "
-                "Last output: {1}".format(attempt + 1, ret['comment'])}
+            return {'result': False, 'changes': False, 'comment': 'Exception raised: {0}'.format(e)}
 
-        if attempt + 1 == retry_['attempts']:
-            break
+    ret, attempts, reason = __salt__['caasp_retry.call'](run_once, name=name, **retry_)
 
-        if retry_['interval'] > 0:
-            time.sleep(retry_['interval'])
+    if ret['result']:
+        return {
+            'name': "caasp_retriable.{0}.{1}".format(name, target),
+            'changes': ret['changes'],
+            'retries': ret['retries'],
+            'result': True,
+            'comment': "Command executed succesfully after {0} attempts. "
+            "Last output: {1}".format(attempts, ret['comment'])}
 
     return {
         'name': "caasp_retriable.{0}.{1}".format(name, target),
         'changes': ret['changes'],
+        'retries': ret['retries'],
         'result': False,
-        'comment': "Command failed after {0} attempts. "
-                   "Last output: {1} "
-                   "Params: {2}".format(
-                       retry_['attempts'],
+        'comment': "Command failed after {0} attempts ({1}). "
+                   "Last output: {2} "
+                   "Params: {3}".format(
+                       attempts,
+                       reason,
                        ret['comment'],
                        kwargs)}